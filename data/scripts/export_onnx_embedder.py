@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+import torch
+from transformers import AutoModel, AutoTokenizer
+from onnxruntime.quantization import QuantType, quantize_dynamic
+
+
+MODEL_NAME = "BAAI/bge-base-en-v1.5"
+
+
+def export(output_dir):
+    output_dir.mkdir(parents = True, exist_ok = True)
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    model = AutoModel.from_pretrained(MODEL_NAME).eval()
+    tokenizer.backend_tokenizer.save(str(output_dir / "tokenizer.json"))
+
+    sample = tokenizer(["np.float is deprecated"], return_tensors = "pt")
+    fp32_path = output_dir / "model.onnx"
+    torch.onnx.export(
+        model,
+        (sample["input_ids"], sample["attention_mask"], sample["token_type_ids"]),
+        str(fp32_path),
+        input_names = ["input_ids", "attention_mask", "token_type_ids"],
+        output_names = ["last_hidden_state"],
+        dynamic_axes = {
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "token_type_ids": {0: "batch", 1: "sequence"},
+            "last_hidden_state": {0: "batch", 1: "sequence"},
+        },
+        opset_version = 17
+    )
+    print(f"Exported {fp32_path}")
+
+    int8_path = output_dir / "model_int8.onnx"
+    quantize_dynamic(str(fp32_path), str(int8_path), weight_type = QuantType.QInt8)
+    print(f"Quantized {int8_path}")
+
+
+if __name__ == "__main__":
+    target = Path(sys.argv[1]) if len(sys.argv) > 1 else Path("data/models/bge-base-en-v1.5-onnx")
+    export(target)
+    print("Serve it with LIBSMART_EMBEDDING_BACKEND=onnx; the server logs its parity with the stored vectors at startup")
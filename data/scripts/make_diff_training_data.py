@@ -0,0 +1,42 @@
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "server"))
+from patches import CHANGES_HEADER, apply_patch, make_patch, parse_patch
+
+
+# Converts fine-tuning samples ({"input", "output", "context"}) to the diff output mode used with
+# LIBSMART_OUTPUT_MODE=diff. The assistant turn for a converted sample is:
+#
+#   ### Changes
+#   {patch}
+#   ### Deprecation Context
+#   {context}
+
+def convert(samples):
+    converted = []
+    for sample in samples:
+        patch = make_patch(sample['input'], sample['output'])
+        # Same round trip the server performs on model output
+        if apply_patch(sample['input'], parse_patch(f"{CHANGES_HEADER}\n{patch}") or []).rstrip() != sample['output'].rstrip():
+            print(f"Skipping sample whose patch does not reproduce the output: {sample['input'][:60]!r}")
+            continue
+        converted.append({
+            'input': sample['input'],
+            'patch': patch,
+            'context': sample['context']
+        })
+    return converted
+
+
+if __name__ == "__main__":
+    source = Path(sys.argv[1]) if len(sys.argv) > 1 else Path("training_data.json")
+    target = Path(sys.argv[2]) if len(sys.argv) > 2 else source.with_name(f"{source.stem}_diff.json")
+    with open(source, 'r', encoding='utf-8') as f:
+        samples = json.load(f)
+    converted = convert(samples)
+    with open(target, 'w', encoding='utf-8') as f:
+        json.dump(converted, f, indent=2)
+    unchanged = sum(1 for s in converted if s['patch'] == "None")
+    print(f"Wrote {len(converted)}/{len(samples)} samples to {target} ({unchanged} without changes)")
@@ -1,4 +1,4 @@
-import re
+import sys
 from pathlib import Path
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_huggingface import HuggingFaceEmbeddings
@@ -6,6 +6,11 @@ from langchain_chroma import Chroma
 from langchain.schema import Document
 import torch
 
+# Chunk metadata is read back by the server, so it is computed with the server's helpers
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "server"))
+from versions import version_number
+from deprecations import function_key, heading_functions
+
 
 class NumpyDocProcessor:
 
@@ -53,13 +58,18 @@ class NumpyDocProcessor:
                         chunk_text += f"\nReplacement: {replacement}"
                     if context:
                         chunk_text += f"\nContext: {context}"
+                    metadata = {
+                        'version': current_version,
+                        'function': func_name,
+                        'has_replacement': bool(replacement)
+                    }
+                    if version_number(current_version) is not None:
+                        metadata['version_num'] = version_number(current_version)
+                    for name in heading_functions(func_name):
+                        metadata[function_key(name)] = True
                     chunks.append({
                         'content': chunk_text,
-                        'metadata': {
-                            'version': current_version,
-                            'function': func_name,
-                            'has_replacement': bool(replacement)
-                        }
+                        'metadata': metadata
                     })
                 continue
             i += 1
@@ -0,0 +1,223 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from pathlib import Path
+
+import httpx
+
+# Replays the fine-tuning datasets against a running server and reports latency percentiles,
+# throughput and error rates. Without GGUF weights, start the server with the stub model:
+#
+#   LIBSMART_ENABLE_STUB=1 LIBSMART_MODEL=stub LIBSMART_STUB_DECODE_TPS=25 python server/main.py
+#   python evaluation/scripts/load_benchmark.py --concurrency 8 --requests 400
+#
+# Closed loop (default): --concurrency clients send back to back. Open loop (--rate): requests
+# arrive as a Poisson process at --rate per second, with at most --concurrency in flight. Latency
+# is measured from the scheduled arrival, so time spent waiting for a free client counts
+
+DATASETS_DIR = Path(__file__).parent.parent.parent / "data" / "datasets"
+DATASETS = {
+    "validation": DATASETS_DIR / "validation_data.json",
+    "training": DATASETS_DIR / "training_data.json",
+}
+RESULTS_PATH = Path(__file__).parent.parent / "load_benchmark.json"
+
+
+def load_samples(names):
+    samples = []
+    for name in names:
+        with open(DATASETS[name], 'r') as f:
+            samples.extend({"code": s['input'], "numpy_version": s['version']} for s in json.load(f))
+    return samples
+
+
+def build_requests(samples, count, model, bust_cache, explain, rng):
+    requests = []
+    order = list(range(len(samples)))
+    rng.shuffle(order)
+    for i in range(count):
+        sample = samples[order[i % len(order)]]
+        body = {"code": sample["code"], "numpy_version": sample["numpy_version"], "explain": explain}
+        if bust_cache:
+            # A trailing comment changes the response cache key without changing the analysis
+            body["code"] = f"{sample['code'].rstrip()}\n# load-benchmark {i}\n"
+        if model:
+            body["model"] = model
+        requests.append(body)
+    return requests
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+async def wait_until_ready(client, url):
+    while True:
+        health = (await client.get(f"{url}/health")).json()
+        if health.get("status") != "starting":
+            return health
+        print("Waiting for the server to finish loading...")
+        await asyncio.sleep(5)
+
+
+async def send(client, url, body, scheduled):
+    result = {"scheduled": scheduled}
+    try:
+        response = await client.post(f"{url}/analyze", json=body)
+        result["status"] = response.status_code
+        if response.status_code == 200:
+            data = response.json()
+            if data.get("error"):
+                result["error"] = "analysis_error"
+            if data.get("usage"):
+                result["completion_tokens"] = data["usage"]["completion_tokens"]
+        else:
+            result["error"] = f"http_{response.status_code}"
+    except httpx.TimeoutException:
+        result["error"] = "timeout"
+    except httpx.HTTPError as e:
+        result["error"] = type(e).__name__
+    result["finished"] = time.perf_counter()
+    result["latency"] = result["finished"] - scheduled
+    return result
+
+
+async def closed_loop(client, url, requests, concurrency):
+    pending = iter(requests)
+    results = []
+
+    async def worker():
+        for body in pending:
+            results.append(await send(client, url, body, time.perf_counter()))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+
+async def open_loop(client, url, requests, rate, concurrency, rng):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def limited(body, scheduled):
+        async with slots:
+            return await send(client, url, body, scheduled)
+
+    tasks = []
+    next_arrival = time.perf_counter()
+    for body in requests:
+        next_arrival += rng.expovariate(rate)
+        delay = next_arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(limited(body, next_arrival)))
+    return await asyncio.gather(*tasks)
+
+
+def summarize(results, wall_seconds):
+    ok = [r for r in results if "error" not in r]
+    errors = {}
+    for r in results:
+        if "error" in r:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    latencies = [r["latency"] * 1000 for r in ok]
+    tokens = sum(r.get("completion_tokens", 0) for r in ok)
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "errors": errors,
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(len(ok) / wall_seconds, 3) if wall_seconds else 0.0,
+        "completion_tokens_per_second": round(tokens / wall_seconds, 2) if wall_seconds else 0.0,
+        "latency_ms": latency_summary(latencies),
+    }
+
+
+def latency_summary(latencies):
+    if not latencies:
+        return {"mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+    return {
+        "mean": round(sum(latencies) / len(latencies), 2),
+        "p50": round(percentile(latencies, 50), 2),
+        "p95": round(percentile(latencies, 95), 2),
+        "p99": round(percentile(latencies, 99), 2),
+        "max": round(max(latencies), 2),
+    }
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    samples = load_samples(args.datasets)
+    total = args.requests or len(samples)
+    requests = build_requests(samples, args.warmup + total, args.model, args.bust_cache, not args.no_explain, rng)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        health = await wait_until_ready(client, args.url)
+        if health.get("status") != "ready":
+            raise SystemExit(f"Server is not ready: {health}")
+        print(f"Server ready (model {health.get('model')}); {args.warmup} warm-up + {total} requests")
+        for body in requests[:args.warmup]:
+            await send(client, args.url, body, time.perf_counter())
+
+        started = time.perf_counter()
+        if args.rate:
+            results = await open_loop(client, args.url, requests[args.warmup:], args.rate, args.concurrency, rng)
+        else:
+            results = await closed_loop(client, args.url, requests[args.warmup:], args.concurrency)
+        wall = max(r["finished"] for r in results) - started if results else 0.0
+        stats = (await client.get(f"{args.url}/stats")).json()
+
+    return {
+        "config": {
+            "url": args.url,
+            "datasets": args.datasets,
+            "mode": "open" if args.rate else "closed",
+            "rate": args.rate,
+            "concurrency": args.concurrency,
+            "requests": total,
+            "warmup": args.warmup,
+            "model": args.model or health.get("model"),
+            "bust_cache": args.bust_cache,
+            "explain": not args.no_explain,
+            "seed": args.seed,
+        },
+        "summary": summarize(results, wall),
+        "server_stats": stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the /analyze endpoint")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--datasets", nargs="+", choices=sorted(DATASETS), default=["validation", "training"])
+    parser.add_argument("--requests", type=int, default=0, help="Measured requests (default: one pass over the datasets)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Clients (closed loop) or in-flight cap (open loop)")
+    parser.add_argument("--rate", type=float, default=0, help="Poisson arrival rate in requests/s (open loop)")
+    parser.add_argument("--warmup", type=int, default=4, help="Sequential requests sent first and not measured")
+    parser.add_argument("--model", help="Model to request, e.g. 'stub' (default: the server's model)")
+    parser.add_argument("--bust-cache", action="store_true", help="Make every request miss the response cache")
+    parser.add_argument("--no-explain", action="store_true", help="Request code only (explain=false)")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=RESULTS_PATH)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    summary = report["summary"]
+    latency = summary["latency_ms"]
+    print(f"{summary['succeeded']}/{summary['requests']} succeeded in {summary['wall_seconds']}s "
+          f"({summary['throughput_rps']} req/s), errors: {summary['errors'] or 'none'}")
+    print(f"Latency ms: p50 {latency['p50']}, p95 {latency['p95']}, p99 {latency['p99']}, max {latency['max']}")
+    print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import argparse
+import ast
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "server"))
+from cache import LRUCache
+from deprecations import function_key
+from patches import make_patch
+from rag_service import NumpyFunctionExtractor, RAGService
+
+# Timing and memory benchmarks for the pure-Python hot paths, over synthetic snippets of 10 to
+# 10,000 lines. Compares against the committed baseline and exits with status 1 on a regression:
+#
+#   python evaluation/scripts/micro_benchmarks.py --update-baseline   # on the reference machine
+#   python evaluation/scripts/micro_benchmarks.py                     # after a change
+#
+# --update-baseline checks the run against the existing baseline first and refuses to store
+# regressions unless --accept-regressions is given. The baseline records the revision it was measured on.
+#
+# Timings are the median of several repeats. Each is also divided by the median of a fixed calibration
+# workload timed just before it; a regression has to exceed the threshold both ways, so a machine running
+# slower as a whole does not fail the gate. Benchmarks over the threshold are measured again and only
+# count if they stay over it. Memory is
+# the tracemalloc peak of one call and the number of blocks still allocated when it returns (mostly
+# its result); allocations freed during the call are not counted
+
+BASELINE_PATH = Path(__file__).parent.parent / "micro_benchmark_baseline.json"
+SIZES = [10, 100, 1000, 10000]
+TEMPLATES = [
+    "x{i} = np.float(a{i})",
+    "y{i} = np.sum(x{i}, axis=0) + np.mean(b{i})",
+    "z{i} = np.random.rand({n}).reshape(-1, 1)",
+    "w{i} = arr{i}.astype(np.int).tostring()",
+    "v{i} = np.linalg.norm(z{i}) * np.asscalar(w{i})",
+    "u{i} = np.product(np.in1d(v{i}, [1, 2, 3]))",
+    "t{i} = compute(v{i}, dtype=np.float64)",
+    "s{i} = np.fft.rfft(np.cumproduct(t{i}))",
+]
+FUNCTIONS = ["np.float", "np.asscalar", "np.linalg.norm", "np.random.rand", "np.in1d"]
+# Function tags on every fake chunk, so the function filter keeps them all
+TAGS = {function_key(f): True for f in FUNCTIONS}
+# Thresholds below which differences are treated as timer and allocator noise
+MIN_TIME_DELTA = 5e-6
+MIN_MEMORY_DELTA = 16 * 1024
+CALIBRATION_CODE = "\n".join(f"x{i} = np.sum(a{i}, axis=0) + f(b{i})[i]" for i in range(20))
+
+
+def synthetic_code(lines):
+    body = [TEMPLATES[i % len(TEMPLATES)].format(i=i, n=i % 7 + 1) for i in range(lines - 1)]
+    return "\n".join(["import numpy as np"] + body) + "\n"
+
+
+def modernize(code):
+    return code.replace("np.float(", "float(").replace("np.asscalar(", "np.ndarray.item(").replace("np.product(", "np.prod(")
+
+
+def synthetic_doc(lines):
+    # A deprecation chunk padded with unrelated release-note text, with the function named at the end
+    filler = [f"Line {i}: behaviour of the array API changed for dtype promotion." for i in range(lines - 1)]
+    return "\n".join(filler + ["np.in1d is deprecated. Replacement: use np.isin instead."])
+
+
+class FakeCollection:
+    # Returns the same documents for every query, like a collection whose top hits are stable
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def query(self, query_embeddings, n_results, include, where=None):
+        rows = len(query_embeddings)
+        docs = self.documents[:n_results]
+        return {
+            "documents": [list(docs) for _ in range(rows)],
+            "metadatas": [[{"function": "np.in1d", "version": "2.0.0", **TAGS} for _ in docs] for _ in range(rows)],
+            "distances": [[0.1 + 0.05 * i for i in range(len(docs))] for _ in range(rows)],
+        }
+
+
+def make_service(documents):
+    # Only the parts of RAGService the benchmarked paths touch; no Chroma, embedder or model is loaded.
+    # Zero-sized caches make every query_db call take the full retrieval path
+    service = RAGService.__new__(RAGService)
+    service.collection = FakeCollection(documents)
+    service.embed_fn = lambda texts: [[float(len(text)), 1.0] for text in texts]
+    service.embedding_cache = LRUCache(0)
+    service.retrieval_cache = LRUCache(0)
+    return service
+
+
+def benchmarks(sizes):
+    # name -> zero-argument callable
+    cases = {}
+    for lines in sizes:
+        code = synthetic_code(lines)
+        tree = ast.parse(code)
+        modernized = modernize(code)
+        full = f"### Refactored Code\n```python\n{modernized}```\n### Deprecation Context\nnp.float was removed; use float.\n"
+        loose = f"Here is the code.\n### Refactored Code\n```python\n{modernized}```\n### Deprecation Context\n`np.float` was removed.\n\n### Notes\nSee [docs](https://numpy.org).\n"
+        diff = f"### Changes\n{make_patch(code, modernized)}\n### Deprecation Context\nnp.float was removed; use float.\n"
+        service = make_service([synthetic_doc(min(lines, 50))] * 3)
+
+        cases[f"extract/{lines}"] = lambda tree=tree: NumpyFunctionExtractor().visit(tree)
+        cases[f"extract_changes_full/{lines}"] = lambda s=service, out=full, code=code: s.extract_changes(out, code)
+        cases[f"extract_changes_loose/{lines}"] = lambda s=service, out=loose, code=code: s.extract_changes(out, code)
+        cases[f"extract_changes_diff/{lines}"] = lambda s=service, out=diff, code=code: s.extract_changes(out, code)
+    for docs in (1, 3):
+        service = make_service([synthetic_doc(20)] * docs)
+        cases[f"query_db/{docs}_docs"] = lambda s=service: [s.query_db(f, "2.0.0") for f in FUNCTIONS]
+    return cases
+
+
+def source_revision():
+    # The commit the benchmarks ran on, with "-dirty" for uncommitted changes
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def calibration():
+    # Parsing and walking a fixed snippet exercises the same interpreter paths as the benchmarks
+    return sum(1 for _ in ast.walk(ast.parse(CALIBRATION_CODE)))
+
+
+def median_seconds(fn, repeat):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return statistics.median(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def measure(fn, repeat):
+    calibration_seconds = median_seconds(calibration, repeat)
+    seconds = median_seconds(fn, repeat)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    start_bytes, _ = tracemalloc.get_traced_memory()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    del result
+    return {"seconds": seconds, "relative": seconds / calibration_seconds, "peak_bytes": peak - start_bytes,
+            "retained_blocks": retained}
+
+
+def check(current, base, time_threshold, memory_threshold):
+    # (time ratio, calibrated time ratio, memory ratio, regressed) against one baseline entry. A slowdown
+    # has to show both in absolute time, which drifts with the machine, and relative to the calibration
+    # workload, which jitters with it
+    ratio = current["seconds"] / base["seconds"] if base["seconds"] else 1.0
+    relative_ratio = current["relative"] / base["relative"] if base.get("relative") else ratio
+    memory_ratio = current["peak_bytes"] / base["peak_bytes"] if base["peak_bytes"] else 1.0
+    slower = (min(ratio, relative_ratio) > 1 + time_threshold
+              and current["seconds"] - base["seconds"] > MIN_TIME_DELTA)
+    larger = memory_ratio > 1 + memory_threshold and current["peak_bytes"] - base["peak_bytes"] > MIN_MEMORY_DELTA
+    return ratio, relative_ratio, memory_ratio, slower or larger
+
+
+def compare(results, baseline, cases, args):
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:34} {current['seconds'] * 1e6:12.1f} us  (not in baseline)")
+            continue
+        ratio, relative_ratio, memory_ratio, regressed = check(current, base, args.time_threshold, args.memory_threshold)
+        for _ in range(args.confirm if regressed else 0):
+            # Keep the best of the confirmation runs; a real regression is slower every time
+            retry = measure(cases[name], args.repeat)
+            if retry["seconds"] < current["seconds"]:
+                current = {**retry, "peak_bytes": min(retry["peak_bytes"], current["peak_bytes"])}
+            ratio, relative_ratio, memory_ratio, regressed = check(current, base, args.time_threshold, args.memory_threshold)
+            if not regressed:
+                break
+        if regressed:
+            regressions.append(name)
+        print(f"{name:34} {current['seconds'] * 1e6:12.1f} us  x{ratio:5.2f} (x{relative_ratio:5.2f} calibrated)  "
+              f"{current['peak_bytes'] / 1024:10.1f} KiB  x{memory_ratio:5.2f}  {current['retained_blocks']:8} blocks  "
+              f"{'REGRESSED' if regressed else 'ok'}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for extraction, retrieval and output parsing")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--accept-regressions", action="store_true",
+                        help="With --update-baseline, store the run even if it regressed against the current baseline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="Snippet sizes in lines")
+    parser.add_argument("--filter", default="", help="Only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--confirm", type=int, default=3, help="Measure a benchmark over the threshold this many more times")
+    parser.add_argument("--time-threshold", type=float, default=0.25, help="Allowed slowdown (0.25 = 25%%)")
+    parser.add_argument("--memory-threshold", type=float, default=0.25, help="Allowed growth of peak memory")
+    parser.add_argument("--output", type=Path, help="Also write this run's results as JSON")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    cases = {name: fn for name, fn in benchmarks(args.sizes).items() if args.filter in name}
+    if not args.update_baseline and not args.baseline.exists():
+        print(f"No baseline at {args.baseline}; record one with --update-baseline")
+        return 2
+
+    results = {name: measure(fn, args.repeat) for name, fn in cases.items()}
+    run = {
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()} {platform.processor()}".strip(),
+        "revision": source_revision(),
+        "results": results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(run, indent=2))
+
+    if args.update_baseline:
+        if args.baseline.exists():
+            previous = json.loads(args.baseline.read_text())
+            regressions = compare(results, previous["results"], cases, args)
+            if regressions and not args.accept_regressions:
+                print(f"Not updating the baseline: {len(regressions)} regression(s) against revision "
+                      f"{previous.get('revision', 'unknown')}: {', '.join(regressions)}. "
+                      f"Pass --accept-regressions once they have been reviewed")
+                return 1
+            # A filtered or resized run only replaces the benchmarks it ran
+            run["results"] = {**previous["results"], **results}
+        args.baseline.write_text(json.dumps(run, indent=2) + "\n")
+        for name, current in results.items():
+            print(f"{name:34} {current['seconds'] * 1e6:12.1f} us  {current['peak_bytes'] / 1024:10.1f} KiB  "
+                  f"{current['retained_blocks']:8} blocks")
+        print(f"Baseline for revision {run['revision']} written to {args.baseline}")
+        return 0
+
+    baseline = json.loads(args.baseline.read_text())
+    if (baseline.get("python"), baseline.get("machine")) != (run["python"], run["machine"]):
+        print(f"Warning: baseline was recorded on {baseline.get('machine')} (Python {baseline.get('python')}); "
+              f"timings may not be comparable")
+    regressions = compare(results, {k: v for k, v in baseline["results"].items() if args.filter in k}, cases, args)
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        return 1
+    print("No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,39 @@
+import argparse
 import json
+import multiprocessing
 import os
 import warnings
 import textwrap
 import ast
 import re
+import time
 import pandas as pd
 import numpy as np
 from numpy import ma
 import pickle
 import numpy_financial as npf
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
 from pathlib import Path
+try:
+    import resource
+except ImportError:
+    # Windows: no address-space limit, only the timeout applies
+    resource = None
 
 VALIDATION_DATA_PATH = str(Path(__file__).parent.parent.parent / "data" / "datasets" / "validation_data.json")
 RESULTS_PATH = str(Path(__file__).parent.parent)
 DETAILED_RESULTS_CSV = RESULTS_PATH + "/evaluation_detailed.csv"
 SUMMARY_METRICS_CSV = RESULTS_PATH + "/evaluation_summary.csv"
+BATCH_SIZE = 16
+# Batch requests in flight at once; the server queues them on its own analysis slots
+API_CONCURRENCY = 4
+# Each sample's checks run in a child process that is killed after SAMPLE_TIMEOUT seconds and may map
+# at most SAMPLE_MEMORY_MB more than the interpreter already does
+SAMPLE_WORKERS = os.cpu_count() or 4
+SAMPLE_TIMEOUT = 30
+SAMPLE_MEMORY_MB = 1024
 
 EVAL_GLOBALS = {
     'np': np,
@@ -109,22 +127,149 @@ def parse_model_output2(raw_output):
         return output
     return code
 
-def call_rag_api(code, version):
+def call_rag_api_batch(samples):
     try:
         response = requests.post(
-            "http://localhost:8000/analyze",
-            json={"code": code, "numpy_version": version},
-            timeout=60
+            "http://localhost:8000/analyze/batch",
+            json={"items": [{"code": s['input'], "numpy_version": s['version']} for s in samples]},
+            timeout=60 * len(samples)
         )
         if response.status_code == 200:
-            return response.json()
+            return [r['result'] if r.get('result') else {"error": r.get('error')} for r in response.json()['results']]
         else:
-            return {"error": f"API error: {response.status_code}"}
+            return [{"error": f"API error: {response.status_code}"} for _ in samples]
     except Exception as e:
-        return {"error": str(e)}
+        return [{"error": str(e)} for _ in samples]
+
+def failed_result(index, reason, retrieved_context=None):
+    retrieved_context = retrieved_context if isinstance(retrieved_context, dict) else {}
+    return {
+        'sample_index': index,
+        'compiles': f'Fail: {reason}',
+        'correct_indentation': 'Fail: Skipped',
+        'no_deprecations': 'Fail: Skipped',
+        'correct_functionality': 'Fail: Skipped',
+        'functions_retrieved': len(retrieved_context),
+        'functions_with_context': sum(1 for v in retrieved_context.values() if v)
+    }
+
+def evaluate_sample(index, sample, generated_code, retrieved_context):
+    dedented_code = textwrap.dedent(generated_code)
+    indented_code = textwrap.indent(dedented_code, "    ")
+    full_code = sample['code_before'] + indented_code + sample['code_after']
+    full_code_ni = sample['code_before'] + generated_code + sample['code_after']
+    function_name = sample['code_before'].split('def ')[1].split('(')[0].strip()
+
+    functions_retrieved = len(retrieved_context) if isinstance(retrieved_context, dict) else 0
+    functions_with_context = sum(1 for v in retrieved_context.values() if v) if isinstance(retrieved_context, dict) else 0
+
+    #COMPILATION CHECK
+    compiles, compiles_msg, compiled_function = check_compiles(function_name, full_code)
+    #INDENTATION CHECK  
+    indentation, indentation_msg = (check_indentation(function_name, full_code_ni) if compiles else (False, "Skipped"))
+    #DEPRECATION CHECK
+    test_input = eval(sample['test_cases'][0]['input'], EVAL_GLOBALS)
+    no_deprecations, no_deprecations_msg = (check_no_deprecations(compiled_function, test_input) if compiles else (False, "Skipped"))
+    #FUNCTIONALITY CHECK
+    functionality, functionality_msg = (check_functionality(compiled_function, sample['test_cases']) if compiles and no_deprecations else (False, "Skipped"))
+
+    return {
+        'sample_index': index,
+        'compiles': 'Pass' if compiles else f'Fail: {compiles_msg}',
+        'correct_indentation': 'Pass' if indentation else f'Fail: {indentation_msg}',
+        'no_deprecations': 'Pass' if no_deprecations else f'Fail: {no_deprecations_msg}',
+        'correct_functionality': 'Pass' if functionality else f'Fail: {functionality_msg}',
+        'functions_retrieved': functions_retrieved,
+        'functions_with_context': functions_with_context
+    }
+
+def _address_space():
+    # Bytes currently mapped by this process (Linux); RLIMIT_AS counts them against the limit. None if unknown
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+def _limit_memory(memory_mb):
+    # Without the current size a limit could be below what is already mapped; only the timeout applies then
+    mapped = _address_space()
+    if mapped is None:
+        return
+    limit = mapped + memory_mb * 2**20
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ValueError, OSError):
+        # Above the hard limit, or not supported on this platform
+        pass
+
+def _sandboxed(conn, job, memory_mb):
+    index = job[0]
+    try:
+        if resource is not None and memory_mb:
+            _limit_memory(memory_mb)
+        result = evaluate_sample(*job)
+    except MemoryError:
+        result = failed_result(index, f"Exceeded the {memory_mb} MB memory limit", job[3])
+    except BaseException as e:
+        result = failed_result(index, f"Evaluation crashed: {type(e).__name__}: {e}", job[3])
+    conn.send(result)
+    conn.close()
+
+def _status(result):
+    # First failed check, or Pass
+    checks = ('compiles', 'correct_indentation', 'no_deprecations', 'correct_functionality')
+    return next((f"{check} {result[check]}" for check in checks if result[check] != 'Pass'), 'Pass')
+
+def run_sandboxed(jobs, workers, timeout, memory_mb):
+    # jobs are (index, sample, generated_code, retrieved_context). A sample that hangs is killed at
+    # its deadline and one that crashes the interpreter is reported; neither affects the others
+    results = {}
+    pending = list(jobs)
+    running = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            job = pending.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_sandboxed, args=(sender, job, memory_mb), daemon=True)
+            process.start()
+            sender.close()
+            running[receiver] = (job, process, time.monotonic() + timeout)
+
+        next_deadline = min(deadline for _, _, deadline in running.values())
+        for receiver in wait(list(running), timeout=max(0, next_deadline - time.monotonic())):
+            job, process, _ = running.pop(receiver)
+            try:
+                results[job[0]] = receiver.recv()
+            except EOFError:
+                process.join()
+                results[job[0]] = failed_result(job[0], f"Evaluation process died (exit code {process.exitcode})", job[3])
+            process.join()
+            receiver.close()
+            print(f"Sample {job[0]+1}: {_status(results[job[0]])}")
+
+        now = time.monotonic()
+        for receiver, (job, process, deadline) in list(running.items()):
+            if deadline <= now:
+                process.kill()
+                process.join()
+                receiver.close()
+                del running[receiver]
+                results[job[0]] = failed_result(job[0], f"Timed out after {timeout:g}s", job[3])
+                print(f"Sample {job[0]+1}: timed out")
+    return results
 
 #evaluation
 def main():
+    parser = argparse.ArgumentParser(description="Evaluate the RAG API on the validation set")
+    parser.add_argument("--data", default=VALIDATION_DATA_PATH, help="Samples with code_before/code_after and test_cases")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=API_CONCURRENCY, help="Batch requests in flight")
+    parser.add_argument("--workers", type=int, default=SAMPLE_WORKERS, help="Samples evaluated in parallel")
+    parser.add_argument("--timeout", type=float, default=SAMPLE_TIMEOUT, help="Seconds per sample evaluation")
+    parser.add_argument("--memory-mb", type=int, default=SAMPLE_MEMORY_MB, help="Memory limit per sample evaluation (0: none)")
+    args = parser.parse_args()
+
     print("Starting RAG evaluation script")
     
     # Check if API is available
@@ -134,6 +279,11 @@ def main():
             print("RAG API is not available! Please start the server first.")
             return
         health_data = health_response.json()
+        # The server loads the embedder and model in the background after it starts listening
+        while health_data.get("status") == "starting":
+            print("Waiting for the RAG service to finish loading...")
+            time.sleep(5)
+            health_data = requests.get("http://localhost:8000/health", timeout=60).json()
         if not health_data.get("chroma_connected") or not health_data.get("model_available"):
             print("RAG service is not properly initialized!")
             return
@@ -142,95 +292,40 @@ def main():
         print(f"Failed to connect to RAG API: {e}")
         return
 
-    print(f"Loading validation data from: {VALIDATION_DATA_PATH}")
+    print(f"Loading validation data from: {args.data}")
 
-    if not os.path.exists(VALIDATION_DATA_PATH):
-        print(f"Validation file not found! Please ensure '{VALIDATION_DATA_PATH}' exists.")
+    if not os.path.exists(args.data):
+        print(f"Validation file not found! Please ensure '{args.data}' exists.")
         return
-    with open(VALIDATION_DATA_PATH, 'r') as f:
+    with open(args.data, 'r') as f:
         validation_data = json.load(f)
 
-    results_list = []
     total_samples = len(validation_data)
 
+    batches = [validation_data[start:start+args.batch_size] for start in range(0, total_samples, args.batch_size)]
+    print(f"Requesting {total_samples} samples in {len(batches)} batches, {args.concurrency} at a time")
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        api_results = [result for batch in pool.map(call_rag_api_batch, batches) for result in batch]
+
+    results_by_index = {}
+    jobs = []
     for i, sample in enumerate(validation_data):
-        print(f"\nProcessing sample {i+1}/{total_samples}:")
-        try:            
-            api_result = call_rag_api(sample['input'], sample['version'])            
-            if api_result.get('error'):
-                print(f"RAG API failed: {api_result['error']}")
-                results_list.append({
-                    'sample_index': i, 
-                    'compiles': 'Fail: RAG API error',
-                    'correct_indentation': 'Fail: Skipped',
-                    'no_deprecations': 'Fail: Skipped', 
-                    'correct_functionality': 'Fail: Skipped',
-                    'functions_retrieved': 0,
-                    'functions_with_context': 0
-                })
-                continue
-                
-            modernized_code = api_result.get('modernized_code', '')
-            retrieved_context = api_result.get('retrieved_context', {})
-            
-        except Exception as e:
-            print(f"RAG API error: {e}")
-            results_list.append({
-                'sample_index': i,
-                'compiles': f'Fail: {str(e)}',
-                'correct_indentation': 'Fail: Skipped',
-                'no_deprecations': 'Fail: Skipped',
-                'correct_functionality': 'Fail: Skipped',
-                'functions_retrieved': 0,
-                'functions_with_context': 0
-            })
+        api_result = api_results[i]
+        if api_result.get('error'):
+            print(f"Sample {i+1}: RAG API failed: {api_result['error']}")
+            results_by_index[i] = failed_result(i, 'RAG API error')
             continue
-
-        generated_code = modernized_code
-        print(generated_code)        
+        generated_code = api_result.get('modernized_code', '')
+        retrieved_context = api_result.get('retrieved_context', {})
         if not generated_code:
-            print("RAG did not generate code. Skipping.")
-            functions_retrieved = len(retrieved_context) if isinstance(retrieved_context, dict) else 0
-            functions_with_context = sum(1 for v in retrieved_context.values() if v) if isinstance(retrieved_context, dict) else 0
-            results_list.append({
-                'sample_index': i, 
-                'compiles': 'Fail: No code generated',
-                'correct_indentation': 'Fail: Skipped',
-                'no_deprecations': 'Fail: Skipped',
-                'correct_functionality': 'Fail: Skipped',
-                'functions_retrieved': functions_retrieved,
-                'functions_with_context': functions_with_context
-            })
+            print(f"Sample {i+1}: RAG did not generate code. Skipping.")
+            results_by_index[i] = failed_result(i, 'No code generated', retrieved_context)
             continue
+        jobs.append((i, sample, generated_code, retrieved_context))
 
-        dedented_code = textwrap.dedent(generated_code)
-        indented_code = textwrap.indent(dedented_code, "    ")
-        full_code = sample['code_before'] + indented_code + sample['code_after']
-        full_code_ni = sample['code_before'] + generated_code + sample['code_after']
-        function_name = sample['code_before'].split('def ')[1].split('(')[0].strip()
-        
-        functions_retrieved = len(retrieved_context) if isinstance(retrieved_context, dict) else 0
-        functions_with_context = sum(1 for v in retrieved_context.values() if v) if isinstance(retrieved_context, dict) else 0
-        
-        #COMPILATION CHECK
-        compiles, compiles_msg, compiled_function = check_compiles(function_name, full_code)
-        #INDENTATION CHECK  
-        indentation, indentation_msg = (check_indentation(function_name, full_code_ni) if compiles else (False, "Skipped"))
-        #DEPRECATION CHECK
-        test_input = eval(sample['test_cases'][0]['input'], EVAL_GLOBALS)
-        no_deprecations, no_deprecations_msg = (check_no_deprecations(compiled_function, test_input) if compiles else (False, "Skipped"))
-        #FUNCTIONALITY CHECK
-        functionality, functionality_msg = (check_functionality(compiled_function, sample['test_cases']) if compiles and no_deprecations else (False, "Skipped"))
-
-        results_list.append({
-            'sample_index': i,
-            'compiles': 'Pass' if compiles else f'Fail: {compiles_msg}',
-            'correct_indentation': 'Pass' if indentation else f'Fail: {indentation_msg}',
-            'no_deprecations': 'Pass' if no_deprecations else f'Fail: {no_deprecations_msg}',
-            'correct_functionality': 'Pass' if functionality else f'Fail: {functionality_msg}',
-            'functions_retrieved': functions_retrieved,
-            'functions_with_context': functions_with_context
-        })
+    print(f"Evaluating {len(jobs)} samples with {args.workers} workers ({args.timeout:g}s, {args.memory_mb} MB limit each)")
+    results_by_index.update(run_sandboxed(jobs, max(1, args.workers), args.timeout, args.memory_mb))
+    results_list = [results_by_index[i] for i in range(total_samples)]
 
     print("\nEvaluation DONE")
 
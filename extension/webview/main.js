@@ -29,15 +29,59 @@ window.addEventListener('message', function(event) {
     }
 });
 
+// reads server-sent events from a fetch response and calls onEvent(event, data) for each one
+function readEventStream(response, onEvent) {
+    var reader = response.body.getReader();
+    var decoder = new TextDecoder();
+    var buffer = '';
+    function pump() {
+        return reader.read().then(function(chunk) {
+            if (chunk.done) {
+                return;
+            }
+            buffer += decoder.decode(chunk.value, { stream: true });
+            var parts = buffer.split('\n\n');
+            buffer = parts.pop();
+            parts.forEach(function(part) {
+                var event = 'message';
+                var data = '';
+                part.split('\n').forEach(function(line) {
+                    if (line.indexOf('event: ') === 0) {
+                        event = line.slice(7);
+                    } else if (line.indexOf('data: ') === 0) {
+                        data += line.slice(6);
+                    }
+                });
+                if (data) {
+                    onEvent(event, JSON.parse(data));
+                }
+            });
+            return pump();
+        });
+    }
+    return pump();
+}
+
+// shows the refactored code while the model is still generating
+function showPartialCode(text) {
+    document.getElementById('loader').style.display = 'none';
+    document.getElementById('result').style.display = 'block';
+    document.getElementById('no-changes').style.display = 'none';
+    document.getElementById('changes-found').style.display = 'block';
+    document.getElementById('replace-btn').disabled = true;
+    document.getElementById('modernized-code').textContent += text;
+}
+
 function runAnalysis(code) {
     document.getElementById('loader').style.display = 'block';
     document.getElementById('result').style.display = 'none';
+    document.getElementById('modernized-code').textContent = '';
 
     var apiPromise;
     if (useMock) {
         apiPromise = getMockResponse(code);
     } else {
-        var fullUrl = 'http://127.0.0.1:8000/analyze'
+        var fullUrl = 'http://127.0.0.1:8000/analyze/stream'
         console.log('Send request to:', fullUrl);
         apiPromise = fetch(fullUrl, {
             method: 'POST',
@@ -47,7 +91,18 @@ function runAnalysis(code) {
             if(!response.ok){
                 throw new Error('Network response was not ok: ' + response.statusText);
             }
-            return response.json();
+            var finalResult = null;
+            return readEventStream(response, function(event, data) {
+                if (event === 'token') {
+                    showPartialCode(data.text);
+                } else if (event === 'result') {
+                    finalResult = data;
+                } else if (event === 'error') {
+                    finalResult = { error: data.detail };
+                }
+            }).then(function() {
+                return finalResult || { error: 'Stream ended without a result' };
+            });
         });
     }
 
@@ -73,6 +128,7 @@ function runAnalysis(code) {
             document.getElementById('explanation').innerHTML = result.explanation;
             hljs.highlightAll();
             // set up the button click
+            document.getElementById('replace-btn').disabled = false;
             document.getElementById('replace-btn').onclick = function() {
                 this.disabled = true;
                 vscode.postMessage({
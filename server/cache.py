@@ -0,0 +1,127 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Hashable, Optional
+
+
+class LRUCache:
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class ResponseCache:
+    # In-memory LRU in front of an optional SQLite table that survives restarts
+
+    def __init__(self, max_size: int, db_path: str | None = None, max_disk_entries: int = 10000):
+        self.memory = LRUCache(max_size)
+        self.db_path = db_path
+        self.max_disk_entries = max_disk_entries
+        self.disk_hits = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        # Rows written since the last count (replaced keys included); the table is pruned once this passes
+        # max_disk_entries by a tenth, so the oldest rows are deleted in batches rather than on every write
+        self._disk_rows = 0
+        if db_path:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+            self._db.commit()
+            self._disk_rows = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.memory.get(key)
+        if value is not None or self._db is None:
+            return value
+        with self._db_lock:
+            row = self._db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.disk_hits += 1
+        self.memory.put(key, row[0])
+        return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        self.memory.put(key, value)
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)",
+                (key, value, time.time())
+            )
+            self._disk_rows += 1
+            if self._disk_rows > self.max_disk_entries + max(1, self.max_disk_entries // 10):
+                self._prune()
+            self._db.commit()
+
+    def _prune(self) -> None:
+        # Keeps the newest max_disk_entries rows; called with the lock held
+        if self.max_disk_entries <= 0:
+            self._db.execute("DELETE FROM responses")
+        else:
+            self._db.execute(
+                "DELETE FROM responses WHERE created < (SELECT created FROM responses ORDER BY created DESC LIMIT 1 OFFSET ?)",
+                (self.max_disk_entries - 1,)
+            )
+        self._disk_rows = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+            self._disk_rows = 0
+
+    def stats(self) -> Dict[str, int]:
+        stats = self.memory.stats()
+        stats["disk_hits"] = self.disk_hits
+        if self._db is not None:
+            with self._db_lock:
+                stats["disk_size"] = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return stats
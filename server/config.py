@@ -5,6 +5,8 @@ from pathlib import Path
 BASE_DIR = Path(__file__).parent.parent
 DATA_DIR = BASE_DIR / "data"
 DOCS_DIR = DATA_DIR / "docs"
+DEPRECATIONS_MD = DOCS_DIR / "numpy_deprecations.md"
+MODELS_DIR = BASE_DIR / "fine-tuning" / "models"
 
 # ChromaDB
 CHROMA_DB_DIR = str(DOCS_DIR / "chroma_db")
@@ -14,6 +16,25 @@ COLLECTION_NAME = "numpy_docs"
 TOP_K_RESULTS = 3
 CHUNK_SIZE = 500
 SIMILARITY_THRESHOLD = 0.4
+EMBEDDING_CACHE_SIZE = int(os.getenv("LIBSMART_EMBEDDING_CACHE_SIZE", "2048"))
+RETRIEVAL_CACHE_SIZE = int(os.getenv("LIBSMART_RETRIEVAL_CACHE_SIZE", "1024"))
+# Restrict each function's search to chunks tagged with its name (Chroma where filter on function:<name> metadata)
+RETRIEVAL_FUNCTION_FILTER = os.getenv("LIBSMART_RETRIEVAL_FUNCTION_FILTER", "1") == "1"
+
+# Query embedder: "sentence-transformers" (torch), "onnx" (int8 ONNX export, see
+# data/scripts/export_onnx_embedder.py) or "llama-cpp" (GGUF conversion of the same model)
+EMBEDDING_BACKEND = os.getenv("LIBSMART_EMBEDDING_BACKEND", "sentence-transformers")
+EMBEDDING_MODEL = "BAAI/bge-base-en-v1.5"
+EMBEDDING_ONNX_DIR = Path(os.getenv("LIBSMART_EMBEDDING_ONNX_DIR", str(DATA_DIR / "models" / "bge-base-en-v1.5-onnx")))
+EMBEDDING_GGUF = Path(os.getenv("LIBSMART_EMBEDDING_GGUF", str(DATA_DIR / "models" / "bge-base-en-v1.5-q8_0.gguf")))
+EMBEDDING_THREADS = int(os.getenv("LIBSMART_EMBEDDING_THREADS", "2"))
+# Stored documents re-embedded at startup to compare the backend with the vectors in the collection
+EMBEDDING_PARITY_SAMPLES = int(os.getenv("LIBSMART_EMBEDDING_PARITY_SAMPLES", "16"))
+EMBEDDING_PARITY_MIN_COSINE = 0.98
+
+# Response cache: set LIBSMART_RESPONSE_CACHE_DB to a file path to keep responses across restarts
+RESPONSE_CACHE_SIZE = int(os.getenv("LIBSMART_RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_DB = os.getenv("LIBSMART_RESPONSE_CACHE_DB") or None
 
 # API
 API_HOST = "0.0.0.0"
@@ -21,5 +42,65 @@ API_PORT = 8000
 API_TITLE = "NumPy Code Modernization API"
 API_VERSION = "2.0.0"
 
+# Model
+# GGUF file name (without .gguf) in fine-tuning/models; --model on the command line overrides it
+MODEL_NAME = os.getenv("LIBSMART_MODEL") or None
+# Other models load on first request; least recently used idle models are evicted once the resident
+# GGUF weights plus every worker's KV cache would exceed this many MB (0 = no limit)
+MODEL_MEMORY_BUDGET_MB = int(os.getenv("LIBSMART_MODEL_MEMORY_BUDGET_MB", "4096"))
+# Each generation worker owns a llama.cpp context; the GGUF weights are memory-mapped and shared
+GENERATION_WORKERS = int(os.getenv("LIBSMART_GENERATION_WORKERS", "1"))
+# Seconds a generation waits for a free worker before the request fails with 503 (0 = wait indefinitely)
+GENERATION_WAIT_SECONDS = float(os.getenv("LIBSMART_GENERATION_WAIT_SECONDS", "300"))
+MODEL_THREADS = int(os.getenv("LIBSMART_MODEL_THREADS", str(min(8, os.cpu_count() or 8))))
+# Directory for the prefilled KV state of the static system prompt, so restarts skip that prefill
+PROMPT_CACHE_DIR = os.getenv("LIBSMART_PROMPT_CACHE_DIR") or None
+# Context window per llama.cpp context. Prompts are budgeted against it: the output gets
+# OUTPUT_CODE_RATIO x input tokens plus OUTPUT_EXPLANATION_TOKENS, retrieved context gets what is left
+MODEL_CONTEXT_TOKENS = int(os.getenv("LIBSMART_MODEL_CONTEXT_TOKENS", "1024"))
+OUTPUT_CODE_RATIO = 1.25
+OUTPUT_EXPLANATION_TOKENS = 160
+# Section headers and fences around the code when the explanation is requested separately
+OUTPUT_HEADER_TOKENS = 24
+CONTEXT_CHUNK_MAX_TOKENS = 64
+# "full" re-emits the refactored snippet; "diff" asks for a list of changed lines (server/patches.py),
+# which needs a model fine-tuned on that format (data/scripts/make_diff_training_data.py)
+OUTPUT_MODE = os.getenv("LIBSMART_OUTPUT_MODE", "full")
+# Constrain decoding with a GBNF grammar to exactly the response sections, ending after a one-line explanation
+CONSTRAINED_DECODING = os.getenv("LIBSMART_CONSTRAINED_DECODING", "0") == "1"
+EXPLANATION_MAX_CHARS = 400
+# Prompt-lookup speculative decoding: drafts tokens by matching n-grams of the prompt, which fits
+# refactors that mostly copy the input code. Draft tokens per step by model (2-4 suits CPU, ~10 GPU)
+SPECULATIVE_DECODING = os.getenv("LIBSMART_SPECULATIVE_DECODING", "0") == "1"
+SPECULATIVE_DRAFT_TOKENS = {
+    "gemma-2-2b-it": 4,
+    "tinyllama-1.1b-chat": 4,
+}
+# Offline stub model (LIBSMART_MODEL=stub or "model": "stub"): no weights, deterministic output and
+# simulated prefill/decode speed, for benchmarking the server itself. A rate of 0 means no delay.
+# Only selectable when LIBSMART_ENABLE_STUB=1, so production clients cannot pick the fake model
+STUB_MODEL = "stub"
+STUB_ENABLED = os.getenv("LIBSMART_ENABLE_STUB", "0") == "1"
+STUB_PREFILL_TOKENS_PER_SECOND = float(os.getenv("LIBSMART_STUB_PREFILL_TPS", "400"))
+STUB_DECODE_TOKENS_PER_SECOND = float(os.getenv("LIBSMART_STUB_DECODE_TPS", "25"))
+STUB_DELAY_MS = float(os.getenv("LIBSMART_STUB_DELAY_MS", "0"))
+
+# Analysis workers
+ANALYSIS_WORKERS = int(os.getenv("LIBSMART_ANALYSIS_WORKERS", str(GENERATION_WORKERS + 1)))
+ANALYSIS_MAX_IN_FLIGHT = int(os.getenv("LIBSMART_ANALYSIS_MAX_IN_FLIGHT", "4"))
+BATCH_MAX_ITEMS = int(os.getenv("LIBSMART_BATCH_MAX_ITEMS", "64"))
+# Analysis slots one batch may hold at once; capped below ANALYSIS_MAX_IN_FLIGHT so single requests keep a slot
+BATCH_MAX_IN_FLIGHT = int(os.getenv("LIBSMART_BATCH_MAX_IN_FLIGHT", str(GENERATION_WORKERS)))
+# Code-only analyses (explain=false) whose explanation can still be requested via /explain/{handle}
+EXPLANATION_STORE_SIZE = int(os.getenv("LIBSMART_EXPLANATION_STORE_SIZE", "256"))
+
+# Tracing: "1" traces every request, otherwise only requests sent with "X-Libsmart-Trace: 1".
+# Traced responses carry a Server-Timing header; LIBSMART_TRACE_DIR also writes each span tree as JSON
+TRACING = os.getenv("LIBSMART_TRACING", "0") == "1"
+TRACE_DIR = os.getenv("LIBSMART_TRACE_DIR") or None
+# Fraction of requests profiled with cProfile into PROFILE_DIR; adjustable at runtime via /admin/profiling
+PROFILE_SAMPLE_RATE = float(os.getenv("LIBSMART_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = Path(os.getenv("LIBSMART_PROFILE_DIR", str(DATA_DIR / "profiles")))
+
 # NumPy
 NUMPY_ALIASES = ["np", "numpy"]
\ No newline at end of file
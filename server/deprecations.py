@@ -0,0 +1,209 @@
+import inspect
+import logging
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from rules import RULES
+from versions import version_at_least, version_tuple
+
+logger = logging.getLogger(__name__)
+
+_DOTTED = re.compile(r'\b(?:np|numpy|ndarray)\.[A-Za-z_][\w.]*')
+_IDENTIFIER = re.compile(r'^[A-Za-z_]\w*$')
+_SUFFIXES = ('function', 'functions', 'class', 'method', 'module')
+# Headings about one keyword of a function: 'histogram "normed" keyword', 'normed argument of np.histogram',
+# 'fix_imports in numpy.save', 'np.unravel_index dims parameter'
+_KEYWORD_HEADINGS = (
+    re.compile(r'^(?P<func>[\w.]+) "(?P<kw>\w+)" (?:keyword|argument|parameter)$'),
+    re.compile(r'^(?P<kw>[a-z_]\w*)(?: keyword| argument| parameter)? (?:of|in|to) (?P<func>[\w.]+?)(?:\(\))?$'),
+    re.compile(r'^(?P<func>[\w.]+) (?P<kw>\w+) (?:keyword|argument|parameter)$'),
+)
+_IMPORTS = re.compile(r'^Imports? from ')
+_METHOD_HEADING = re.compile(r'^(?P<method>\w+) method of (?P<cls>[\w.]+)$')
+_ATTRIBUTE_HEADING = re.compile(r'\b(?P<attr>\w+) array attribute$')
+
+
+def _path(ref: str) -> str:
+    # "numpy.fft.refft" -> "fft.refft"; ndarray methods keep their qualifier
+    ref = ref.rstrip('.')
+    for prefix in ('np.', 'numpy.'):
+        if ref.startswith(prefix):
+            return ref[len(prefix):]
+    return ref
+
+
+def heading_keywords(heading: str) -> List[Tuple[str, str]]:
+    # (function path, keyword) for headings that deprecate a keyword rather than the whole function
+    for pattern in _KEYWORD_HEADINGS:
+        match = pattern.match(heading)
+        if match:
+            return [(_path(match.group('func')), match.group('kw'))]
+    return []
+
+
+def heading_symbols(heading: str) -> List[str]:
+    # API names mentioned in a deprecation heading of numpy_deprecations.md
+    if heading_keywords(heading):
+        return []
+    match = _METHOD_HEADING.match(heading)
+    if match:
+        return [f"{_path(match.group('cls'))}.{match.group('method')}"]
+    match = _ATTRIBUTE_HEADING.search(heading)
+    if match:
+        return [f"ndarray.{match.group('attr')}"]
+
+    symbols: List[str] = []
+    words = heading.split()
+    if len(words) == 1 and _IDENTIFIER.match(words[0]):
+        return [words[0]]
+    if len(words) == 2 and _IDENTIFIER.match(words[0]) and words[1] in _SUFFIXES:
+        return [words[0]]
+
+    # Asides in parentheses list names ("Aliases of builtin types (np.int, np.float, etc.)"); arguments
+    # attached to a name ("np.finfo(None)") stay in the text and mark a usage
+    text = _IMPORTS.sub('', heading)
+    asides = re.findall(r'\s\(([^)]*)\)', text)
+    text = re.sub(r'\s\([^)]*\)', '', text)
+
+    parent = ""
+    for part in re.split(r',|\band\b', text):
+        refs = _DOTTED.findall(part)
+        if refs:
+            rest = _DOTTED.sub('', part).replace('()', '').split()
+            if any(word not in _SUFFIXES for word in rest):
+                # The heading deprecates one way of using the names, not the names themselves:
+                # "np.linspace with non-integer num parameter", "Inexact matches for np.convolve and np.correlate"
+                symbols = []
+                break
+            for ref in refs:
+                symbols.append(_path(ref))
+            last = _path(refs[-1])
+            parent = last.rsplit('.', 1)[0] if '.' in last else ""
+            continue
+        item = part.strip().strip('()').strip()
+        if parent and _IDENTIFIER.match(item):
+            symbols.append(f"{parent}.{item}")
+
+    for group in asides:
+        for item in group.split(','):
+            item = item.strip()
+            if _DOTTED.fullmatch(item):
+                symbols.append(_path(item))
+            elif _IDENTIFIER.match(item) and item not in ('etc', 'None', 'True', 'False'):
+                symbols.append(item)
+    return list(dict.fromkeys(symbols))
+
+
+def heading_functions(heading: str) -> List[str]:
+    # Last components of every API name a heading mentions, deprecated or not; retrieval chunks are tagged
+    # with these so that the search can be restricted to the functions in the code
+    names = heading_symbols(heading) + [func for func, _ in heading_keywords(heading)]
+    names += [_path(ref) for ref in _DOTTED.findall(heading)]
+    return list(dict.fromkeys(name.split('.')[-1] for name in names if name))
+
+
+def function_key(name: str) -> str:
+    # Boolean chunk metadata key marking a chunk as being about `name` (Chroma metadata cannot hold lists)
+    return f"function:{name.split('.')[-1]}"
+
+
+def numpy_api() -> Set[str]:
+    # Public names of the installed NumPy and of its subpackages one level down ("zeros", "random.randint")
+    names: Set[str] = set()
+    for name in dir(np):
+        if name.startswith('_'):
+            continue
+        names.add(name)
+        try:
+            module = getattr(np, name)
+        except Exception:
+            continue
+        if inspect.ismodule(module) and module.__name__ == f"numpy.{name}":
+            names.update(f"{name}.{member}" for member in dir(module) if not member.startswith('_'))
+    return names
+
+
+class DeprecationIndex:
+
+    def __init__(self, entries: Dict[str, str], keywords: Dict[str, Dict[str, str]] | None = None,
+                 current: Set[str] | None = None):
+        # symbol path (without the np. prefix) -> earliest NumPy version it is deprecated in
+        self.entries = entries
+        # function path -> {keyword: version}, for deprecated keywords of functions that are still current
+        self.keywords = keywords or {}
+        # Paths named as replacements or exported by the installed NumPy; these are current API unless listed in entries
+        self.current = current or set()
+        self._by_last: Dict[str, List[str]] = {}
+        for symbol in entries:
+            self._by_last.setdefault(symbol.split('.')[-1], []).append(symbol)
+        self._known_by_last: Dict[str, List[str]] = {}
+        for symbol in set(entries) | set(self.keywords) | self.current:
+            self._known_by_last.setdefault(symbol.split('.')[-1], []).append(symbol)
+
+    @classmethod
+    def from_markdown(cls, path: Path) -> "DeprecationIndex":
+        entries: Dict[str, str] = {}
+        keywords: Dict[str, Dict[str, str]] = {}
+        current: Set[str] = set()
+
+        def add(symbol: str, version: str) -> None:
+            if symbol not in entries or version_tuple(version) < version_tuple(entries[symbol]):
+                entries[symbol] = version
+
+        def add_keyword(func: str, keyword: str, version: str) -> None:
+            known = keywords.setdefault(func, {})
+            if keyword not in known or version_tuple(version) < version_tuple(known[keyword]):
+                known[keyword] = version
+
+        version = None
+        for line in path.read_text(encoding='utf-8').splitlines():
+            line = line.strip()
+            if line.startswith('## Version'):
+                version = line.replace('## Version ', '').strip()
+            elif version and line.startswith('**') and line.endswith('**') and len(line) > 4:
+                for symbol in heading_symbols(line[2:-2]):
+                    add(symbol, version)
+                for func, keyword in heading_keywords(line[2:-2]):
+                    add_keyword(func, keyword, version)
+            elif line.startswith('- **Replacement**'):
+                current.update(_path(ref) for ref in _DOTTED.findall(line))
+
+        for name, rule in RULES.items():
+            if rule.kind == 'keyword':
+                for keyword, _ in rule.keywords:
+                    add_keyword(_path(name), keyword, rule.since)
+            elif rule.until:
+                # Valid again from rule.until; while deprecated, the rule itself rewrites it
+                current.add(_path(name))
+            else:
+                add(_path(name), rule.since)
+            current.update(_path(ref) for ref in _DOTTED.findall(rule.replacement))
+        current.update(numpy_api())
+        logger.info(f"Loaded {len(entries)} deprecated symbols and {sum(map(len, keywords.values()))} keywords from {path.name}")
+        return cls(entries, keywords, current)
+
+    def _matches(self, by_last: Dict[str, List[str]], name: str) -> List[str]:
+        # NumPy-qualified names must match a symbol path; bare names (methods) match on the last component
+        if name.startswith(('np.', 'numpy.')):
+            path = _path(name)
+            return [s for s in by_last.get(path.split('.')[-1], []) if path == s or path.endswith('.' + s)]
+        return by_last.get(name.split('.')[-1], [])
+
+    def lookup(self, name: str, version: str, keywords: Iterable[str] = ()) -> Optional[str]:
+        # Earliest version <= `version` in which the symbol, or one of the keywords passed to it, was deprecated
+        hits = [self.entries[s] for s in self._matches(self._by_last, name) if version_at_least(version, self.entries[s])]
+        if keywords:
+            for symbol in self._matches(self._known_by_last, name):
+                for keyword in keywords:
+                    since = self.keywords.get(symbol, {}).get(keyword)
+                    if since and version_at_least(version, since):
+                        hits.append(since)
+        return min(hits, key=version_tuple) if hits else None
+
+    def knows(self, name: str) -> bool:
+        # Whether the index can vouch for the name at all: deprecated, with deprecated keywords, current API
+        # or a named replacement
+        return bool(self._matches(self._known_by_last, name))
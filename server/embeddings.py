@@ -0,0 +1,104 @@
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EmbeddingFunction = Callable[[List[str]], List[Any]]
+
+
+class OnnxEmbedder:
+    # bge-base-en-v1.5 exported to ONNX (ideally int8-quantized), run with onnxruntime and the
+    # Rust tokenizer; no torch or transformers at query time
+
+    def __init__(self, model_dir: Path, threads: int, max_length: int = 512):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_path = model_dir / "model_int8.onnx"
+        if not model_path.exists():
+            model_path = model_dir / "model.onnx"
+        self.tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        logger.info(f"ONNX embedder: {model_path}")
+
+    def __call__(self, input: List[str]) -> List[np.ndarray]:
+        encodings = self.tokenizer.encode_batch(input)
+        feeds = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+        }
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.zeros_like(feeds["input_ids"])
+        hidden = self.session.run(None, feeds)[0]
+        # BGE pools the [CLS] token
+        return list(_normalize(hidden[:, 0]))
+
+
+class LlamaCppEmbedder:
+    # GGUF conversion of bge-base-en-v1.5 (e.g. q8_0) through llama.cpp's embedding mode
+
+    def __init__(self, model_path: Path, threads: int, max_length: int = 512):
+        import llama_cpp
+
+        self.model = llama_cpp.Llama(
+            model_path=str(model_path),
+            embedding=True,
+            n_ctx=max_length,
+            n_batch=max_length,
+            n_threads=threads,
+            pooling_type=llama_cpp.LLAMA_POOLING_TYPE_CLS,
+            verbose=False
+        )
+        # A llama.cpp context is not thread-safe, and queries embed from several analysis threads
+        self._lock = threading.Lock()
+        logger.info(f"llama.cpp embedder: {model_path}")
+
+    def __call__(self, input: List[str]) -> List[np.ndarray]:
+        with self._lock:
+            vectors = self.model.embed(input)
+        return list(_normalize(np.array(vectors, dtype=np.float32)))
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def create_embedder(backend: str, model_name: str, onnx_dir: Path, gguf_path: Path, threads: int) -> EmbeddingFunction:
+    if backend == "onnx":
+        return OnnxEmbedder(onnx_dir, threads)
+    if backend == "llama-cpp":
+        return LlamaCppEmbedder(gguf_path, threads)
+    if backend == "sentence-transformers":
+        import torch
+        from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+        return SentenceTransformerEmbeddingFunction(
+            model_name=model_name,
+            device="mps" if torch.backends.mps.is_available() else "cpu"
+        )
+    raise ValueError(f"Unknown embedding backend: {backend}")
+
+
+def check_parity(embed_fn: EmbeddingFunction, collection: Any, samples: int) -> Dict[str, Any]:
+    # Re-embeds stored documents and compares them with the vectors in the collection, which were
+    # produced by the full-precision model when the database was built
+    data = collection.get(limit=samples, include=["documents", "embeddings"])
+    documents = data.get("documents") or []
+    stored = data.get("embeddings")
+    if not documents or stored is None or len(stored) == 0:
+        return {"samples": 0}
+    fresh = _normalize(np.array(embed_fn(documents), dtype=np.float32))
+    similarity = np.sum(fresh * _normalize(np.array(stored, dtype=np.float32)), axis=1)
+    return {
+        "samples": len(documents),
+        "min_cosine": round(float(similarity.min()), 4),
+        "mean_cosine": round(float(similarity.mean()), 4),
+    }
@@ -0,0 +1,104 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterable, Iterator, List, Sequence
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisExecutor:
+
+    def __init__(self, workers: int, max_in_flight: int):
+        self.workers = max(1, workers)
+        self.max_in_flight = max(1, max_in_flight)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="analysis")
+        # asyncio.Semaphore wakes waiters in FIFO order, so queued requests are served fairly
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self.in_flight = 0
+        self.waiting = 0
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        await self._wait_for_slot()
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            # run_in_executor does not carry context variables; the request's trace span has to follow the call
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(self._pool, context.run, tracing.call, fn, *args)
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    async def run_many(self, fn: Callable[..., Any], calls: Iterable[Sequence[Any]], limit: int) -> List[Any]:
+        # Runs fn once per argument tuple, holding at most `limit` slots at a time and always leaving one slot
+        # for other requests, so a large batch cannot hold back single analyses queued behind it
+        limit = max(1, min(limit, self.max_in_flight - 1))
+        share = asyncio.Semaphore(limit)
+
+        async def call(args: Sequence[Any]) -> Any:
+            async with share:
+                return await self.run(fn, *args)
+
+        return await asyncio.gather(*(call(args) for args in calls))
+
+    async def stream(self, gen_fn: Callable[..., Iterator[Any]], *args: Any) -> AsyncIterator[Any]:
+        # Drives a blocking generator on a worker thread and relays its items to the event loop.
+        # The slot is held until the generator finishes or the consumer goes away.
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+        done = object()
+
+        def produce() -> None:
+            gen = gen_fn(*args)
+            try:
+                for item in gen:
+                    if cancelled.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, (None, e))
+            finally:
+                if hasattr(gen, "close"):
+                    gen.close()
+                loop.call_soon_threadsafe(queue.put_nowait, (done, None))
+
+        await self._wait_for_slot()
+        self.in_flight += 1
+        try:
+            future = loop.run_in_executor(self._pool, contextvars.copy_context().run, tracing.call, produce)
+            try:
+                while True:
+                    item, error = await queue.get()
+                    if error is not None:
+                        raise error
+                    if item is done:
+                        break
+                    yield item
+            finally:
+                cancelled.set()
+                await future
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    async def _wait_for_slot(self) -> None:
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+            tracing.record("queue", time.perf_counter() - started)
+
+    def queue_depth(self) -> int:
+        return self.waiting
+
+    def shutdown(self) -> None:
+        logger.info("Shutting down analysis executor")
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -1,15 +1,26 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 import uvicorn
+import argparse
+import asyncio
+import json
 import logging
+import os
 import sys
-from pathlib import Path
 
-MODELS_DIR = Path(__file__).parent.parent / "fine-tuning" / "models"
-
-from config import API_TITLE, API_VERSION, API_HOST, API_PORT
-from schemas import CodeAnalysisRequest, CodeAnalysisResponse, HealthResponse
+from config import API_TITLE, API_VERSION, API_HOST, API_PORT, ANALYSIS_WORKERS, ANALYSIS_MAX_IN_FLIGHT, BATCH_MAX_ITEMS, BATCH_MAX_IN_FLIGHT
+from config import GENERATION_WORKERS, MODEL_NAME, MODELS_DIR, MODEL_MEMORY_BUDGET_MB, TRACING, STUB_MODEL, STUB_ENABLED
+from schemas import CodeAnalysisRequest, CodeAnalysisResponse, HealthResponse, StatsResponse
+from schemas import ModelListResponse, ModelStatus, ProfilingRequest, ProfilingStatus
+from schemas import BatchAnalysisRequest, BatchAnalysisResponse, BatchItemResult
+from schemas import FileAnalysisRequest, FileAnalysisResponse, ExplanationResponse
 from rag_service import RAGService
+from model_registry import ModelInUseError, UnknownModelError
+from prompt_budget import PromptTooLongError, WorkersBusyError
+from executor import AnalysisExecutor
+from metrics import REGISTRY, Gauge
+import tracing
 
 logging.basicConfig(
     level = logging.INFO,
@@ -28,6 +39,25 @@ app.add_middleware(
 )
 
 rag = None
+executor = None
+TRACED_PATHS = ("/analyze", "/explain")
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # Tracing and profiling are opt-in; other requests pass straight through
+    if not request.url.path.startswith(TRACED_PATHS):
+        return await call_next(request)
+    trace = TRACING or request.headers.get("x-libsmart-trace") == "1"
+    profile = tracing.PROFILING.sample()
+    if not trace and not profile:
+        return await call_next(request)
+    # The root span ends when the body has been sent, not when the response is returned, so it covers streams
+    with tracing.request(f"{request.method} {request.url.path}", trace, profile, end=False) as root:
+        response = await call_next(request)
+    if root is not None:
+        response.headers["Server-Timing"] = tracing.server_timing(root)
+        response.body_iterator = tracing.finish_after(root, response.body_iterator)
+    return response
 
 def get_available_models():
     models = []
@@ -56,44 +86,272 @@ def select_model():
         except:
             print("Invalid selection. Try again.")
 
+def resolve_model(name: str | None) -> str:
+    # Explicit choice (--model, LIBSMART_MODEL) first; only prompt when someone is at the terminal
+    models = get_available_models()
+    if name:
+        if name == STUB_MODEL and not STUB_ENABLED:
+            raise Exception("The stub model is only available with LIBSMART_ENABLE_STUB=1")
+        if name not in models and name != STUB_MODEL:
+            raise Exception(f"Model '{name}' not found in {MODELS_DIR} (available: {', '.join(models) or 'none'})")
+        return name
+    if len(models) == 1:
+        return models[0]
+    if sys.stdin.isatty():
+        return select_model()
+    raise Exception(f"No model selected: pass --model or set LIBSMART_MODEL to one of: {', '.join(models) or 'none'}")
+
+def require_ready() -> None:
+    if rag is None or not rag.is_ready():
+        detail = "Service is still loading" if rag is None or rag.is_loading() else "Service failed to load, see /health"
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "5"})
+    if not rag.is_connected():
+        raise HTTPException(status_code=503, detail="Vector database unavailable")
+
+def require_model(name: str | None) -> None:
+    try:
+        rag.models.resolve(name)
+    except UnknownModelError as e:
+        raise HTTPException(status_code=400, detail=f"{e} (available: {', '.join(rag.models.available())})")
+
 @app.get("/health", response_model=HealthResponse)
 async def health() -> HealthResponse:
+    if rag is None:
+        return HealthResponse(status="starting", chroma_connected=False, model_available=False)
+    ready = rag.is_ready()
     return HealthResponse(
-        status = "healthy",
-        chroma_connected = rag.is_connected() if rag else False,
-        model_available = rag.is_model_available() if rag else False
+        status = "ready" if ready else ("starting" if rag.is_loading() else "degraded"),
+        ready = ready,
+        model = rag.model_name,
+        chroma_connected = rag.is_connected(),
+        model_available = rag.is_model_available(),
+        components = rag.components
+    )
+
+@app.get("/health/live")
+async def health_live() -> dict:
+    return {"live": True}
+
+@app.get("/health/ready", response_model=HealthResponse)
+async def health_ready() -> HealthResponse:
+    require_ready()
+    return await health()
+
+def _cache_metric(field: str) -> dict:
+    return {(name,): stats[field] for name, stats in rag.cache_stats().items()} if rag else {}
+
+def _cache_hit_ratio() -> dict:
+    if rag is None:
+        return {}
+    return {(name,): stats["hits"] / (stats["hits"] + stats["misses"])
+            for name, stats in rag.cache_stats().items() if stats["hits"] + stats["misses"]}
+
+def _worker_metric(field: str) -> dict:
+    if rag is None:
+        return {}
+    return {(w["model"], str(w["worker"])): float(w[field]) for w in rag.models.worker_stats()}
+
+# Scrape-time views of state kept by the executor, caches and generation workers
+REGISTRY.register(Gauge("libsmart_queue_depth", "Requests waiting for an analysis slot", [],
+                        lambda: {(): executor.queue_depth()} if executor else {}))
+REGISTRY.register(Gauge("libsmart_in_flight", "Requests holding an analysis slot", [],
+                        lambda: {(): executor.in_flight} if executor else {}))
+REGISTRY.register(Gauge("libsmart_cache_hits_total", "Cache hits", ["cache"], lambda: _cache_metric("hits"), "counter"))
+REGISTRY.register(Gauge("libsmart_cache_misses_total", "Cache misses", ["cache"], lambda: _cache_metric("misses"), "counter"))
+REGISTRY.register(Gauge("libsmart_cache_hit_ratio", "Cache hits over lookups since startup", ["cache"], _cache_hit_ratio))
+REGISTRY.register(Gauge("libsmart_pipeline_events_total", "Pipeline counters from /stats", ["event"],
+                        lambda: {(name,): value for name, value in rag.counters.items()} if rag else {}, "counter"))
+REGISTRY.register(Gauge("libsmart_worker_busy", "Generation workers currently generating", ["model", "worker"],
+                        lambda: _worker_metric("busy")))
+REGISTRY.register(Gauge("libsmart_worker_utilization", "Share of uptime each generation worker was busy", ["model", "worker"],
+                        lambda: _worker_metric("utilization")))
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats", response_model=StatsResponse)
+async def stats() -> StatsResponse:
+    return StatsResponse(
+        caches = rag.cache_stats() if rag else {},
+        counters = dict(rag.counters) if rag else {},
+        generation_workers = rag.models.worker_stats() if rag else [],
+        embedding = rag.embedding_info if rag else {}
     )
 
 @app.post("/analyze", response_model=CodeAnalysisResponse)
 async def analyze(req: CodeAnalysisRequest) -> CodeAnalysisResponse:
     logger.info(f"Analyzing code: {len(req.code)} chars, NumPy {req.numpy_version}")
     
-    if not rag.is_connected():
-        raise HTTPException(status_code=503, detail="Vector database unavailable")
+    require_ready()
+    require_model(req.model)
     try:
-        result = rag.analyze_code(req.code, req.numpy_version)
+        result = await executor.run(rag.analyze_code, req.code, req.numpy_version, req.model, req.explain)
         if result.error:
             logger.error(f"Analysis error: {result.error}")
         else:
             logger.info(f"Analysis successful: {len(result.retrieved_context)} functions analyzed")
         return result
+    except PromptTooLongError as e:
+        raise HTTPException(status_code=413, detail=f"{e}; send smaller snippets or use /analyze/file")
+    except WorkersBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
     except Exception as e:
         logger.exception("Analysis failed")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/analyze/batch", response_model=BatchAnalysisResponse)
+async def analyze_batch(req: BatchAnalysisRequest) -> BatchAnalysisResponse:
+    logger.info(f"Batch analysis: {len(req.items)} items")
+
+    if len(req.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {BATCH_MAX_ITEMS} items")
+    require_ready()
+    for item in req.items:
+        require_model(item.model)
+    try:
+        batch = await executor.run(rag.prepare_batch, [(item.code, item.numpy_version, item.model) for item in req.items])
+        # One executor task per generation, so they run concurrently on the model's generation workers,
+        # but only BATCH_MAX_IN_FLIGHT at a time so the batch shares the executor with other requests
+        await executor.run_many(rag.generate_batch_item, [(batch, key) for key in batch.plans], BATCH_MAX_IN_FLIGHT)
+        outcomes = rag.batch_results(batch)
+    except Exception as e:
+        logger.exception("Batch analysis failed")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    results = []
+    for i, outcome in enumerate(outcomes):
+        if isinstance(outcome, Exception):
+            results.append(BatchItemResult(index=i, error=str(outcome)))
+        else:
+            results.append(BatchItemResult(index=i, result=outcome, error=outcome.error))
+    return BatchAnalysisResponse(results=results)
+
+@app.post("/analyze/file", response_model=FileAnalysisResponse)
+async def analyze_file(req: FileAnalysisRequest) -> FileAnalysisResponse:
+    logger.info(f"Analyzing file: {len(req.code)} chars, NumPy {req.numpy_version}")
+
+    require_ready()
+    require_model(req.model)
+    try:
+        result = await executor.run(rag.analyze_file, req.code, req.numpy_version, req.model)
+        changed = sum(1 for chunk in result.chunks if chunk.changed)
+        logger.info(f"File analysis finished: {changed}/{len(result.chunks)} chunks changed")
+        return result
+    except Exception as e:
+        logger.exception("File analysis failed")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/analyze/stream")
+async def analyze_stream(req: CodeAnalysisRequest) -> StreamingResponse:
+    logger.info(f"Streaming analysis: {len(req.code)} chars, NumPy {req.numpy_version}")
+
+    require_ready()
+    require_model(req.model)
+
+    async def events():
+        try:
+            async for event in executor.stream(rag.analyze_code_stream, req.code, req.numpy_version, req.model, req.explain):
+                yield f"event: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+        except Exception as e:
+            logger.exception("Streaming analysis failed")
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.post("/explain/{handle}", response_model=ExplanationResponse)
+async def explain(handle: str) -> ExplanationResponse:
+    require_ready()
+    try:
+        return await executor.run(rag.explain, handle)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Unknown or expired explanation handle; analyze the code again")
+    except WorkersBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except Exception as e:
+        logger.exception("Explanation failed")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/admin/models", response_model=ModelListResponse)
+async def list_models() -> ModelListResponse:
+    if rag is None:
+        raise HTTPException(status_code=503, detail="Service is still loading")
+    return ModelListResponse(
+        models = [ModelStatus(**status) for status in rag.models.status()],
+        memory_budget_mb = MODEL_MEMORY_BUDGET_MB,
+        resident_mb = round(rag.models.resident_bytes() / 2**20, 1),
+        evictions = rag.models.evictions
+    )
+
+@app.post("/admin/models/{name}/load", response_model=ModelListResponse)
+async def load_model(name: str) -> ModelListResponse:
+    if rag is None:
+        raise HTTPException(status_code=503, detail="Service is still loading")
+    require_model(name)
+    try:
+        # Loading takes seconds and does not count against the analysis slots
+        await asyncio.to_thread(rag.models.load, name)
+    except Exception as e:
+        logger.exception(f"Loading model {name} failed")
+        raise HTTPException(status_code=500, detail=str(e))
+    return await list_models()
+
+@app.delete("/admin/models/{name}", response_model=ModelListResponse)
+async def unload_model(name: str) -> ModelListResponse:
+    if rag is None:
+        raise HTTPException(status_code=503, detail="Service is still loading")
+    try:
+        unloaded = await asyncio.to_thread(rag.models.unload, name)
+    except ModelInUseError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if not unloaded:
+        raise HTTPException(status_code=404, detail=f"Model {name} is not loaded")
+    return await list_models()
+
+@app.get("/admin/profiling", response_model=ProfilingStatus)
+async def profiling_status() -> ProfilingStatus:
+    return ProfilingStatus(**tracing.PROFILING.status())
+
+@app.post("/admin/profiling", response_model=ProfilingStatus)
+async def set_profiling(req: ProfilingRequest) -> ProfilingStatus:
+    tracing.PROFILING.sample_rate = req.sample_rate
+    logger.info(f"Profiling {req.sample_rate:.0%} of analysis requests into {tracing.PROFILING.directory}")
+    return await profiling_status()
+
 @app.on_event("startup")
 async def startup() -> None:
-    global rag
+    global rag, executor
     try:
-        selected_model = select_model()
-        rag = RAGService(selected_model)
+        selected_model = resolve_model(os.getenv("LIBSMART_MODEL") or MODEL_NAME)
+        # The vector store and model load in background threads; /health reports their progress
+        rag = RAGService(selected_model, background=True)
     except Exception as e:
         logger.error(f"Failed to initialize RAG service: {e}")
         raise
+    executor = AnalysisExecutor(ANALYSIS_WORKERS, ANALYSIS_MAX_IN_FLIGHT)
     logger.info(f"Starting {API_TITLE} v{API_VERSION}")
-    logger.info(f"Model: {selected_model}")
-    logger.info(f"ChromaDB: {'connected' if rag.is_connected() else 'disconnected'}")
-    logger.info(f"Model: {'available' if rag.is_model_available() else 'unavailable'}")
+    logger.info(f"Model: {selected_model} (loading in background)")
+    logger.info(f"Analysis workers: {ANALYSIS_WORKERS}, max in flight: {ANALYSIS_MAX_IN_FLIGHT}")
+    logger.info(f"Generation workers: {GENERATION_WORKERS}")
+    if min(ANALYSIS_WORKERS, ANALYSIS_MAX_IN_FLIGHT) < GENERATION_WORKERS:
+        logger.warning("Fewer analysis workers or in-flight slots than generation workers; some generation workers will sit idle")
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    if executor:
+        executor.shutdown()
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host=API_HOST, port=API_PORT, reload=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description=API_TITLE)
+    parser.add_argument("--model", help="GGUF model name in fine-tuning/models (default: LIBSMART_MODEL)")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--reload", action="store_true", help="Restart the server when source files change")
+    args = parser.parse_args()
+
+    # Resolved before uvicorn starts so the reloader's worker process sees the same choice
+    os.environ["LIBSMART_MODEL"] = resolve_model(args.model or os.getenv("LIBSMART_MODEL") or MODEL_NAME)
+    if args.reload:
+        uvicorn.run("main:app", host=args.host, port=args.port, reload=True)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
\ No newline at end of file
@@ -0,0 +1,148 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# Prometheus text exposition (format 0.0.4) without a client library dependency
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 35, 50, 75, 100, 200)
+
+LabelValues = Tuple[str, ...]
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Counter:
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(labels[n] for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # Label values -> [per-bucket counts, sum, count]
+        self._series: Dict[LabelValues, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels[n] for n in self.label_names)
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.label_names + ("le",)
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append(f"{self.name}_bucket{_labels(names, key + (_number(bound),))} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class Gauge:
+    # Read at scrape time from a callback returning {label values: value}; kind "counter" exposes
+    # totals that are kept elsewhere (e.g. cache hit counts)
+
+    def __init__(self, name: str, help: str, labels: Sequence[str], read: Callable[[], Dict[LabelValues, float]],
+                 kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.read = read
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        values = self.read()
+        if not values:
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, key)} {_number(value)}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: Dict[str, Counter | Histogram | Gauge] = {}
+
+    def register(self, metric: Counter | Histogram | Gauge) -> Counter | Histogram | Gauge:
+        # Re-registering a name replaces it, so gauges can be rebound when the service restarts
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Stages: queue (waiting for an analysis slot), rules, extract, embed, search, prompt, worker_wait
+# (waiting for a generation worker), prefill, decode, generate (the whole model call)
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "libsmart_stage_seconds", "Time spent in each stage of the analysis pipeline", ["stage"]))
+ANALYSIS_SECONDS = REGISTRY.register(Histogram(
+    "libsmart_analysis_seconds", "End-to-end analyze_code latency", ["source"]))
+PROMPT_TOKENS = REGISTRY.register(Histogram(
+    "libsmart_prompt_tokens", "Prompt tokens per generation", ["model"], TOKEN_BUCKETS))
+COMPLETION_TOKENS = REGISTRY.register(Histogram(
+    "libsmart_completion_tokens", "Completion tokens per generation", ["model"], TOKEN_BUCKETS))
+DECODE_TOKENS_PER_SECOND = REGISTRY.register(Histogram(
+    "libsmart_decode_tokens_per_second", "Completion tokens per second of decoding", ["model"], RATE_BUCKETS))
+TOKENS = REGISTRY.register(Counter(
+    "libsmart_tokens_total", "Tokens processed by the model", ["model", "kind"]))
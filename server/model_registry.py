@@ -0,0 +1,270 @@
+import logging
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List
+
+from config import GENERATION_WORKERS, MODEL_CONTEXT_TOKENS, SPECULATIVE_DECODING, SPECULATIVE_DRAFT_TOKENS
+from config import STUB_ENABLED, STUB_MODEL
+
+logger = logging.getLogger(__name__)
+
+
+# GGUF metadata value types: struct format of the scalar types, 8 = string, 9 = array
+_GGUF_SCALARS = {0: '<B', 1: '<b', 2: '<H', 3: '<h', 4: '<I', 5: '<i', 6: '<f', 7: '<?', 10: '<Q', 11: '<q', 12: '<d'}
+_GGUF_STRING, _GGUF_ARRAY = 8, 9
+
+
+def _gguf_read(f: BinaryIO, fmt: str) -> Any:
+    return struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
+
+
+def _gguf_value(f: BinaryIO, kind: int) -> Any:
+    if kind == _GGUF_STRING:
+        return f.read(_gguf_read(f, '<Q')).decode('utf-8', errors='replace')
+    if kind == _GGUF_ARRAY:
+        item_kind, count = _gguf_read(f, '<I'), _gguf_read(f, '<Q')
+        if item_kind in _GGUF_SCALARS:
+            # Only the length of numeric arrays is needed; skip their contents
+            f.seek(count * struct.calcsize(_GGUF_SCALARS[item_kind]), 1)
+        else:
+            for _ in range(count):
+                _gguf_value(f, item_kind)
+        return count
+    return _gguf_read(f, _GGUF_SCALARS[kind])
+
+
+def gguf_metadata(path: Path) -> Dict[str, Any]:
+    # Key/value header of a GGUF file; arrays are returned as their length
+    with open(path, 'rb') as f:
+        if f.read(4) != b'GGUF':
+            raise ValueError(f"{path} is not a GGUF file")
+        _gguf_read(f, '<I')  # version
+        _gguf_read(f, '<Q')  # tensor count
+        metadata = {}
+        for _ in range(_gguf_read(f, '<Q')):
+            key = _gguf_value(f, _GGUF_STRING)
+            metadata[key] = _gguf_value(f, _gguf_read(f, '<I'))
+        return metadata
+
+
+def context_bytes(metadata: Dict[str, Any], n_ctx: int, logits: bool = False) -> int:
+    # KV cache of one llama.cpp context (f16 keys and values for every layer and position),
+    # plus the n_ctx x vocabulary logits kept when every position's logits are requested
+    arch = metadata['general.architecture']
+    layers = metadata[f'{arch}.block_count']
+    heads = metadata[f'{arch}.attention.head_count']
+    kv_heads = metadata.get(f'{arch}.attention.head_count_kv', heads)
+    key_length = metadata.get(f'{arch}.attention.key_length', metadata[f'{arch}.embedding_length'] // heads)
+    value_length = metadata.get(f'{arch}.attention.value_length', key_length)
+    kv = n_ctx * layers * kv_heads * (key_length + value_length) * 2
+    if logits:
+        kv += n_ctx * metadata.get('tokenizer.ggml.tokens', 0) * 4
+    return kv
+
+
+class UnknownModelError(ValueError):
+    pass
+
+
+class ModelInUseError(RuntimeError):
+    pass
+
+
+class ModelRegistry:
+
+    def __init__(self, models_dir: Path, default: str, memory_budget: int = 0, allow_stub: bool = STUB_ENABLED):
+        self.models_dir = models_dir
+        self.default = default
+        # The stub model is for tests and benchmarks only
+        self.allow_stub = allow_stub
+        # Bytes of GGUF weights and context memory allowed to stay resident; 0 means no limit
+        self.memory_budget = memory_budget
+        # name -> ModelService, least recently used first
+        self._resident: "OrderedDict[str, Any]" = OrderedDict()
+        # Estimated bytes per model (weights plus every worker's KV cache), and bytes set aside for models
+        # that are loading
+        self._sizes: Dict[str, int] = {}
+        self._estimates: Dict[str, int] = {}
+        self._reserved: Dict[str, int] = {}
+        self._refs: Dict[str, int] = {}
+        self._loading: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def path(self, name: str) -> Path:
+        return self.models_dir / f"{name}.gguf"
+
+    def identity(self, name: str) -> str:
+        # Changes when the GGUF file is replaced under the same name
+        if name == STUB_MODEL:
+            return name
+        try:
+            stat = self.path(name).stat()
+        except OSError:
+            return name
+        return f"{name}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def available(self) -> List[str]:
+        if not self.models_dir.exists():
+            return []
+        return sorted(path.stem for path in self.models_dir.glob("*.gguf"))
+
+    def resolve(self, name: str | None) -> str:
+        name = name or self.default
+        if name == STUB_MODEL:
+            if not self.allow_stub:
+                raise UnknownModelError(f"Unknown model: {name} (the stub model needs LIBSMART_ENABLE_STUB=1)")
+        elif name not in self._resident and not self.path(name).exists():
+            raise UnknownModelError(f"Unknown model: {name}")
+        return name
+
+    def is_resident(self, name: str | None = None) -> bool:
+        return (name or self.default) in self._resident
+
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(self._sizes[name] for name in self._resident)
+
+    def load(self, name: str | None = None) -> None:
+        with self.use(name):
+            pass
+
+    def unload(self, name: str) -> bool:
+        with self._lock:
+            if name not in self._resident:
+                return False
+            if self._refs.get(name):
+                raise ModelInUseError(f"Model {name} is serving {self._refs[name]} request(s)")
+            service = self._resident.pop(name)
+            # Requests for it wait until it is closed, then load it again
+            self._loading[name] = threading.Event()
+        try:
+            service.close()
+        finally:
+            with self._lock:
+                event = self._loading.pop(name)
+            event.set()
+        logger.info(f"Unloaded model {name}")
+        return True
+
+    @contextmanager
+    def use(self, name: str | None = None) -> Iterator[Any]:
+        # Holds a reference for the duration of a generation so the model cannot be evicted under it
+        name = self.resolve(name)
+        service = self._acquire(name)
+        try:
+            yield service
+        finally:
+            with self._lock:
+                self._refs[name] -= 1
+
+    def _acquire(self, name: str) -> Any:
+        while True:
+            with self._lock:
+                if name in self._resident:
+                    self._resident.move_to_end(name)
+                    self._refs[name] = self._refs.get(name, 0) + 1
+                    return self._resident[name]
+                event = self._loading.get(name)
+                loading = event is None
+                if loading:
+                    event = self._loading[name] = threading.Event()
+            if not loading:
+                # Another request is loading it; a failed load is retried by the next waiter
+                event.wait()
+                continue
+            try:
+                self._load(name)
+            finally:
+                with self._lock:
+                    del self._loading[name]
+                event.set()
+
+    def estimate(self, name: str) -> int:
+        # Weights are memory-mapped and shared; each generation worker adds its own context
+        if name == STUB_MODEL:
+            return 0
+        if name not in self._estimates:
+            path = self.path(name)
+            size = path.stat().st_size
+            try:
+                logits = SPECULATIVE_DECODING and any(model in name for model in SPECULATIVE_DRAFT_TOKENS)
+                size += GENERATION_WORKERS * context_bytes(gguf_metadata(path), MODEL_CONTEXT_TOKENS, logits)
+            except Exception as e:
+                logger.warning(f"Could not estimate the context memory of {name}, counting its weights only: {e}")
+            self._estimates[name] = size
+        return self._estimates[name]
+
+    def _load(self, name: str) -> None:
+        # Imported here so the API can start serving before llama.cpp is loaded
+        if name == STUB_MODEL:
+            from stub_model import StubModelService as ModelService
+        else:
+            from model_service import ModelService
+        size = self.estimate(name)
+        self._make_room(name, size)
+        start = time.perf_counter()
+        try:
+            service = ModelService(name)
+            with self._lock:
+                self._resident[name] = service
+                self._sizes[name] = size
+                self._refs.setdefault(name, 0)
+        finally:
+            with self._lock:
+                self._reserved.pop(name, None)
+        logger.info(f"Loaded model {name} ({size / 2**20:.0f} MB with context) in {time.perf_counter() - start:.2f}s")
+
+    def _make_room(self, name: str, needed: int) -> None:
+        # Victims are chosen, removed and the new model's memory reserved in one critical section, so a
+        # concurrent use() either holds a reference that protects the model or finds it gone and waits for
+        # the eviction to finish before loading it again; concurrent loads see each other's reservations
+        if not self.memory_budget:
+            return
+        victims = []
+        with self._lock:
+            total = sum(self._sizes[n] for n in self._resident) + sum(self._reserved.values())
+            for victim in list(self._resident):
+                if total + needed <= self.memory_budget:
+                    break
+                if self._refs.get(victim):
+                    continue
+                victims.append((victim, self._resident.pop(victim)))
+                self._loading[victim] = threading.Event()
+                total -= self._sizes.pop(victim)
+                self.evictions += 1
+            self._reserved[name] = needed
+            over = total + needed > self.memory_budget
+        for victim, service in victims:
+            try:
+                service.close()
+                logger.info(f"Evicted model {victim} to stay within the memory budget")
+            finally:
+                with self._lock:
+                    event = self._loading.pop(victim)
+                event.set()
+        if over:
+            logger.warning("Loading a model beyond the memory budget; the other resident models are in use")
+
+    def status(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            names = sorted(set(self.available()) | set(self._resident))
+            return [
+                {
+                    "name": name,
+                    "resident": name in self._resident,
+                    "in_use": self._refs.get(name, 0),
+                    "size_mb": round(self._sizes.get(name, self._estimates.get(name, 0)) / 2**20, 1),
+                    "default": name == self.default,
+                }
+                for name in names
+            ]
+
+    def worker_stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            resident = list(self._resident.items())
+        return [{"model": name, **stats} for name, service in resident for stats in service.worker_stats()]
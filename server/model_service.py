@@ -1,15 +1,164 @@
+import ctypes
+import hashlib
+import json
 import logging
+import queue
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Any
-from llama_cpp import Llama
+from typing import Dict, List, Any, Iterator, Optional, Tuple
+import llama_cpp
+from llama_cpp import Llama, LlamaGrammar
+from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+
+from config import (
+    GENERATION_WORKERS, MODEL_THREADS, PROMPT_CACHE_DIR, SPECULATIVE_DECODING, SPECULATIVE_DRAFT_TOKENS,
+    MODEL_CONTEXT_TOKENS, CONTEXT_CHUNK_MAX_TOKENS, OUTPUT_MODE, CONSTRAINED_DECODING, EXPLANATION_MAX_CHARS,
+    OUTPUT_EXPLANATION_TOKENS
+)
+from prompt_budget import EXPLANATION_HEADER, Prompt, PromptTooLongError, WorkersBusyError, output_budget, worker_wait_timeout
+from metrics import STAGE_SECONDS, PROMPT_TOKENS, COMPLETION_TOKENS, DECODE_TOKENS_PER_SECOND, TOKENS
+import tracing
 
 logger = logging.getLogger(__name__)
 
+# Response formats for constrained decoding. Code lines may not start with a backtick, so the closing
+# fence ends the block; the explanation is one line without markdown headers, which completes the grammar
+_EXPLANATION_RULE = f'explanation ::= [^\\n#]{{1,{EXPLANATION_MAX_CHARS}}} "\\n"'
+GRAMMARS = {
+    "full": "\n".join([
+        'root ::= "### Refactored Code\\n```python\\n" code "```\\n### Deprecation Context\\n" explanation',
+        'code ::= codeline*',
+        'codeline ::= [^`\\n] [^\\n]* "\\n" | "\\n"',
+        _EXPLANATION_RULE,
+    ]),
+    "diff": "\n".join([
+        'root ::= "### Changes\\n" changes "### Deprecation Context\\n" explanation',
+        'changes ::= "None\\n" | hunk+',
+        'hunk ::= "@@ " [0-9]+ "\\n" ("- " line)* ("+ " line)*',
+        'line ::= [^\\n]* "\\n"',
+        _EXPLANATION_RULE,
+    ]),
+    "explanation": "\n".join([
+        'root ::= explanation',
+        _EXPLANATION_RULE,
+    ]),
+}
+
+
+class TrackingPromptLookup(LlamaPromptLookupDecoding):
+    # Prompt-lookup drafting that also counts how many drafted tokens the model went on to accept
+
+    def __init__(self, num_pred_tokens: int):
+        super().__init__(num_pred_tokens=num_pred_tokens)
+        self.drafted = 0
+        self.accepted = 0
+        self._pending: Optional[Tuple[int, List[int]]] = None
+
+    def begin(self) -> None:
+        self._pending = None
+
+    def __call__(self, input_ids, /, **kwargs):
+        n = len(input_ids)
+        if self._pending is not None:
+            # The previous draft was proposed for the positions from `start` (the length of its input) on
+            start, draft = self._pending
+            for expected, actual in zip(draft, input_ids[start:n].tolist()):
+                if expected != actual:
+                    break
+                self.accepted += 1
+        draft = super().__call__(input_ids, **kwargs)
+        self.drafted += len(draft)
+        self._pending = (n, draft.tolist()) if len(draft) else None
+        return draft
+
+
+class GenerationWorker:
+
+    def __init__(self, index: int, model: Llama, draft: TrackingPromptLookup | None = None):
+        self.index = index
+        self.model = model
+        self.draft = draft
+        self.jobs = 0
+        self.tokens = 0
+        self.busy_seconds = 0.0
+        self.busy_since: float | None = None
+        self.prefix_restores = 0
+        self.started_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        busy = self.busy_seconds + (time.monotonic() - self.busy_since if self.busy_since else 0.0)
+        uptime = max(time.monotonic() - self.started_at, 1e-9)
+        stats = {
+            "worker": self.index,
+            "jobs": self.jobs,
+            "busy": self.busy_since is not None,
+            "busy_seconds": round(busy, 3),
+            "utilization": round(busy / uptime, 4),
+            "tokens": self.tokens,
+            "tokens_per_second": round(self.tokens / busy, 2) if busy else 0.0,
+            "prefix_restores": self.prefix_restores,
+        }
+        if self.draft:
+            stats["drafted_tokens"] = self.draft.drafted
+            stats["accepted_tokens"] = self.draft.accepted
+            stats["acceptance_rate"] = round(self.draft.accepted / self.draft.drafted, 4) if self.draft.drafted else 0.0
+        return stats
+
+
+@dataclass
+class PrefixState:
+    # KV cache of a llama.cpp context after evaluating `tokens`
+    tokens: List[int]
+    data: bytes
+
+
+def _save_kv(model: Llama) -> bytes:
+    # llama_state_* copies only the context state; Llama.save_state would also copy the logits matrix
+    ctx = model._ctx.ctx
+    size = llama_cpp.llama_state_get_size(ctx)
+    buf = (ctypes.c_uint8 * size)()
+    written = llama_cpp.llama_state_get_data(ctx, buf, size)
+    return ctypes.string_at(buf, written)
+
+
+def _reset_perf(model: Llama) -> None:
+    if hasattr(llama_cpp, "llama_perf_context_reset"):
+        llama_cpp.llama_perf_context_reset(model._ctx.ctx)
+
+
+def _eval_seconds(model: Llama) -> Tuple[float, float] | None:
+    # Prompt processing and decoding time since the last _reset_perf, from llama.cpp's perf counters
+    if not hasattr(llama_cpp, "llama_perf_context"):
+        return None
+    data = llama_cpp.llama_perf_context(model._ctx.ctx)
+    return data.t_p_eval_ms / 1000, data.t_eval_ms / 1000
+
+
+def _load_kv(model: Llama, state: PrefixState) -> None:
+    buf = (ctypes.c_uint8 * len(state.data)).from_buffer_copy(state.data)
+    if llama_cpp.llama_state_set_data(model._ctx.ctx, buf, len(state.data)) != len(state.data):
+        raise RuntimeError("Failed to restore prompt prefix state")
+    n = len(state.tokens)
+    model.input_ids[:n] = state.tokens
+    model.n_tokens = n
+
+
 class ModelService:
 
-    def __init__(self, model_name: str = None):
+    def __init__(self, model_name: str = None, workers: int = GENERATION_WORKERS):
         self.model_name = model_name
         self.model = None
+        self.workers: List[GenerationWorker] = []
+        # Idle workers wait here; generations take the next free one, so jobs queue on a common pool
+        self._idle: queue.Queue = queue.Queue()
+        self.n_workers = max(1, workers)
+        self.output_mode = OUTPUT_MODE
+        self.grammars: Dict[str, LlamaGrammar] = {}
+        if CONSTRAINED_DECODING:
+            self.grammars = {mode: LlamaGrammar.from_string(gbnf, verbose=False) for mode, gbnf in GRAMMARS.items()}
+        self._prefix: Optional[PrefixState] = None
         
         if model_name:
             self._load_gguf_model()
@@ -24,46 +173,219 @@ class ModelService:
             if not direct_gguf_path.exists():
                 raise ValueError(f"GGUF file not found: {direct_gguf_path}")
             
-            logger.info(f"Loading GGUF model: {direct_gguf_path}")
+            threads = max(1, MODEL_THREADS // self.n_workers)
+            draft_tokens = self._draft_tokens()
+            logger.info(f"Loading GGUF model: {direct_gguf_path} ({self.n_workers} workers x {threads} threads)")
+            if draft_tokens:
+                logger.info(f"Prompt-lookup speculative decoding: {draft_tokens} draft tokens per step")
             
-            self.model = Llama(
-                model_path=str(direct_gguf_path),
-                n_ctx=1024,
-                n_gpu_layers=-1,
-                verbose=False,
-                n_threads=8
-            )
+            for i in range(self.n_workers):
+                # Each worker drafts from its own prompt, so draft models are not shared
+                draft = TrackingPromptLookup(draft_tokens) if draft_tokens else None
+                # use_mmap maps the weights read-only, so extra workers only add their own KV cache
+                worker = GenerationWorker(i, Llama(
+                    model_path=str(direct_gguf_path),
+                    n_ctx=MODEL_CONTEXT_TOKENS,
+                    n_gpu_layers=-1,
+                    verbose=False,
+                    n_threads=threads,
+                    use_mmap=True,
+                    draft_model=draft
+                ), draft)
+                self.workers.append(worker)
+                self._idle.put(worker)
+            self.model = self.workers[0].model
             
         except Exception as e:
             logger.error(f"Failed to load GGUF model: {e}")
             raise
+
+        try:
+            self._prefix = self._prefix_state(direct_gguf_path)
+            for worker in self.workers[1:]:
+                _load_kv(worker.model, self._prefix)
+        except Exception as e:
+            logger.warning(f"Prompt prefix cache disabled: {e}")
+            self._prefix = None
+
+    def _draft_tokens(self) -> int:
+        if not SPECULATIVE_DECODING:
+            return 0
+        for name, tokens in SPECULATIVE_DRAFT_TOKENS.items():
+            if name in self.model_name:
+                return tokens
+        return 0
+
+    def _prefix_tokens(self) -> List[int]:
+        # Tokenized exactly as create_completion does; the last token is dropped because it can
+        # merge with whatever text follows the prefix in a full prompt
+        tokens = self.model.tokenize(self._prompt_prefix().encode("utf-8"), special=True)
+        return tokens[:-1]
+
+    def _prefix_path(self, model_path: Path) -> Optional[Path]:
+        if not PROMPT_CACHE_DIR:
+            return None
+        stat = model_path.stat()
+        key = json.dumps([self._prompt_prefix(), stat.st_size, stat.st_mtime_ns,
+                          self.model.n_ctx(), llama_cpp.__version__])
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+        return Path(PROMPT_CACHE_DIR) / f"{self.model_name}-{digest}.kvstate"
+
+    def _prefix_state(self, model_path: Path) -> PrefixState:
+        # Prefills the static prompt prefix on the first worker, or loads the snapshot a previous run saved
+        tokens = self._prefix_tokens()
+        path = self._prefix_path(model_path)
+        if path and path.exists():
+            try:
+                header, data = path.read_bytes().split(b"\n", 1)
+                state = PrefixState(json.loads(header)["tokens"], data)
+                if state.tokens == tokens:
+                    _load_kv(self.model, state)
+                    logger.info(f"Loaded prompt prefix state ({len(tokens)} tokens) from {path}")
+                    return state
+            except Exception as e:
+                logger.warning(f"Ignoring prompt prefix snapshot {path}: {e}")
+
+        start = time.perf_counter()
+        self.model.reset()
+        self.model.eval(tokens)
+        state = PrefixState(tokens, _save_kv(self.model))
+        logger.info(f"Prefilled prompt prefix ({len(tokens)} tokens) in {time.perf_counter() - start:.2f}s")
+
+        if path:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_bytes(json.dumps({"tokens": tokens}).encode("utf-8") + b"\n" + state.data)
+            tmp.replace(path)
+            logger.info(f"Saved prompt prefix state to {path}")
+        return state
+
+    def _restore_prefix(self, worker: GenerationWorker) -> None:
+        # llama.cpp reuses the longest matching token prefix left in the context, so a worker only
+        # needs the snapshot when its context no longer starts with the static prefix
+        state = self._prefix
+        if state is None:
+            return
+        n = len(state.tokens)
+        model = worker.model
+        if model.n_tokens >= n and model.input_ids[:n].tolist() == state.tokens:
+            return
+        try:
+            _load_kv(model, state)
+            worker.prefix_restores += 1
+        except Exception as e:
+            logger.warning(f"Worker {worker.index} could not restore the prompt prefix: {e}")
+            model.reset()
     
 
-    def _create_system_prompt(self, context: Dict[str, List[Dict[str, Any]]] | None = None) -> str:
-        base_prompt = (
-            "You are a Python code refactoring tool for NumPy. Your task is to replace only the deprecated functions in the given code snippet with their modern equivalents.\n"
-            "Your response must be structured with two markdown sections:\n"
-            "1. A '### Refactored Code' section containing ONLY the updated Python code block. Do not change the code's logic. Do not add imports. Do not add comments.\n"
-            "2. A '### Deprecation Context' section containing a brief explanation of the deprecation.\n"
-            " If no functions are deprecated, return the original code and state that no changes were needed in the context section."
-        )
+    @contextmanager
+    def _acquire(self) -> Iterator[GenerationWorker]:
+        timeout = worker_wait_timeout()
+        with tracing.stage("worker_wait"):
+            try:
+                worker = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise WorkersBusyError(timeout)
+        worker.busy_since = time.monotonic()
+        try:
+            self._restore_prefix(worker)
+            if worker.draft:
+                worker.draft.begin()
+            _reset_perf(worker.model)
+            yield worker
+        finally:
+            worker.busy_seconds += time.monotonic() - worker.busy_since
+            worker.busy_since = None
+            worker.jobs += 1
+            self._idle.put(worker)
+
+    def _observe(self, worker: GenerationWorker, prompt_tokens: int, completion_tokens: int, seconds: float) -> None:
+        timings = _eval_seconds(worker.model)
+        if timings and not worker.draft:
+            prefill, decode = timings
+            tracing.record("prefill", prefill)
+        else:
+            # Speculative verification batches are counted as prompt processing, so prefill and
+            # decoding cannot be told apart; the whole call is attributed to decoding
+            decode = seconds
+        tracing.record("decode", decode, tokens=completion_tokens)
+        STAGE_SECONDS.observe(seconds, stage="generate")
+        PROMPT_TOKENS.observe(prompt_tokens, model=self.model_name)
+        COMPLETION_TOKENS.observe(completion_tokens, model=self.model_name)
+        TOKENS.inc(prompt_tokens, model=self.model_name, kind="prompt")
+        TOKENS.inc(completion_tokens, model=self.model_name, kind="completion")
+        if completion_tokens and decode > 0:
+            DECODE_TOKENS_PER_SECOND.observe(completion_tokens / decode, model=self.model_name)
+
+    def worker_stats(self) -> List[Dict[str, Any]]:
+        return [worker.stats() for worker in self.workers]
+
+    def _create_system_prompt(self, context_lines: List[str] | None = None, output_mode: str | None = None) -> str:
+        if (output_mode or self.output_mode) == "diff":
+            base_prompt = (
+                "You are a Python code refactoring tool for NumPy. Your task is to replace only the deprecated functions in the given code snippet with their modern equivalents.\n"
+                "Your response must be structured with two markdown sections:\n"
+                "1. A '### Changes' section listing ONLY the edited lines. Start each edit with '@@ N', where N is the line number of the first original line, then the original lines prefixed with '- ' and their replacements prefixed with '+ '. Do not change the code's logic. Do not add imports. Do not add comments.\n"
+                "2. A '### Deprecation Context' section containing a brief explanation of the deprecation.\n"
+                " If no functions are deprecated, write 'None' in the changes section and state that no changes were needed in the context section."
+            )
+        else:
+            base_prompt = (
+                "You are a Python code refactoring tool for NumPy. Your task is to replace only the deprecated functions in the given code snippet with their modern equivalents.\n"
+                "Your response must be structured with two markdown sections:\n"
+                "1. A '### Refactored Code' section containing ONLY the updated Python code block. Do not change the code's logic. Do not add imports. Do not add comments.\n"
+                "2. A '### Deprecation Context' section containing a brief explanation of the deprecation.\n"
+                " If no functions are deprecated, return the original code and state that no changes were needed in the context section."
+            )
         
-        if context:
-            context_parts = []
-            for fn, chunks in context.items():
-                if chunks and chunks[0]['similarity_score'] > 0.5:
-                    content = chunks[0]['content']
-                    if 'deprecated' in content.lower() or 'replacement' in content.lower():
-                        context_parts.append(f"- {fn}: {content[:150]}...")
-            
-            if context_parts:
-                base_prompt += f"\n\nRelevant context (use only if applicable):\n{chr(10).join(context_parts)}"
+        if context_lines:
+            base_prompt += f"\n\nRelevant context (use only if applicable):\n{chr(10).join(context_lines)}"
         
         return base_prompt
 
-    def _generate_gguf(self, code: str, context: Dict[str, List[Dict[str, Any]]] | None = None) -> str:
-        system_prompt = self._create_system_prompt(context)
-        
+    def _context_snippets(self, context: Dict[str, List[Dict[str, Any]]] | None) -> List[tuple[str, str]]:
+        snippets = []
+        for fn, chunks in (context or {}).items():
+            if chunks and chunks[0]['similarity_score'] > 0.5:
+                content = chunks[0]['content']
+                if 'deprecated' in content.lower() or 'replacement' in content.lower():
+                    snippets.append((fn, content))
+        return snippets
+
+    def _tokens(self, text: str) -> List[int]:
+        return self.model.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+
+    def _prompt_tokens(self, text: str) -> int:
+        # Counted the way create_completion tokenizes the prompt
+        return len(self.model.tokenize(text.encode("utf-8"), special=True))
+
+    def _context_lines(self, snippets: List[tuple[str, str]], budget: int) -> List[str]:
+        # Each snippet gets up to CONTEXT_CHUNK_MAX_TOKENS while the budget lasts, cut on a token boundary
+        lines = []
+        used = len(self._tokens("\n\nRelevant context (use only if applicable):\n"))
+        for fn, content in snippets:
+            label = f"- {fn}: "
+            overhead = len(self._tokens(label)) + 2
+            room = min(CONTEXT_CHUNK_MAX_TOKENS, budget - used - overhead)
+            if room <= 0:
+                break
+            tokens = self._tokens(content)
+            if len(tokens) > room:
+                content = self.model.detokenize(tokens[:room]).decode("utf-8", errors="ignore").strip() + "..."
+            lines.append(label + content)
+            used += overhead + min(len(tokens), room)
+        return lines
+
+    def _prompt_prefix(self) -> str:
+        # Start of every prompt for this template, up to where the per-request context is appended
+        system_prompt = self._create_system_prompt()
+        if "gemma-2-2b-it" in self.model_name:
+            return f"<bos><start_of_turn>user\n{system_prompt}"
+        if "tinyllama-1.1b-chat" in self.model_name:
+            return f"<|system|>\n{system_prompt}"
+        raise ValueError(f"Unsupported model: {self.model_name}")
+
+    def _render(self, code: str, system_prompt: str) -> tuple[str, List[str]]:
         if "gemma-2-2b-it" in self.model_name:
             user_content = f"{system_prompt}\n\n### INPUT CODE:\n```python\n{code}\n```"
             full_prompt = f"<bos><start_of_turn>user\n{user_content}<end_of_turn>\n<start_of_turn>model\n"
@@ -74,35 +396,147 @@ class ModelService:
             stop_tokens = ["</s>", "<|user|>"]
         else:
             raise ValueError(f"Unsupported model: {self.model_name}")
+        return full_prompt, stop_tokens
+
+    def _build_prompt(self, code: str, context: Dict[str, List[Dict[str, Any]]] | None = None,
+                      output_mode: str | None = None, explain: bool = True) -> Prompt:
+        # The output budget is reserved first; retrieved context only gets the tokens left over.
+        # Code-only prompts are budgeted as if explained so a later explanation continues the same prompt
+        n_ctx = self.model.n_ctx()
+        bare_prompt, _ = self._render(code, self._create_system_prompt(None, output_mode))
+        bare_tokens = self._prompt_tokens(bare_prompt)
+        code_tokens = len(self._tokens(code))
+        max_tokens = output_budget(code_tokens)
+        if bare_tokens + max_tokens > n_ctx:
+            raise PromptTooLongError(bare_tokens + max_tokens, n_ctx)
+
+        snippets = self._context_snippets(context)
+        lines = self._context_lines(snippets, n_ctx - bare_tokens - max_tokens) if snippets else []
+        full_prompt, stop_tokens = self._render(code, self._create_system_prompt(lines, output_mode))
+        prompt_tokens = self._prompt_tokens(full_prompt) if lines else bare_tokens
+        return Prompt(
+            text = full_prompt,
+            stop = stop_tokens,
+            prompt_tokens = prompt_tokens,
+            code_tokens = code_tokens,
+            context_tokens = prompt_tokens - bare_tokens,
+            max_tokens = min(max_tokens if explain else output_budget(code_tokens, explain=False), n_ctx - prompt_tokens),
+            n_ctx = n_ctx
+        )
+
+    def _generate_gguf(self, code: str, context: Dict[str, List[Dict[str, Any]]] | None = None,
+                       usage: Dict[str, int] | None = None, output_mode: str | None = None, explain: bool = True) -> str:
+        with tracing.stage("prompt"):
+            prompt = self._build_prompt(code, context, output_mode, explain)
         
         try:
-            output = self.model(
-                full_prompt,
-                max_tokens=256,
-                temperature=0.0,
-                stop=stop_tokens,
-                echo=False
-            )
+            with self._acquire() as worker, tracing.span("generate", model=self.model_name):
+                started = time.perf_counter()
+                output = worker.model(
+                    prompt.text,
+                    max_tokens=prompt.max_tokens,
+                    temperature=0.0,
+                    stop=prompt.stop if explain else prompt.stop + [EXPLANATION_HEADER],
+                    echo=False,
+                    grammar=self.grammars.get(output_mode or self.output_mode)
+                )
+                completion_tokens = output.get('usage', {}).get('completion_tokens', 0) if output else 0
+                worker.tokens += completion_tokens
+                self._observe(worker, prompt.prompt_tokens, completion_tokens, time.perf_counter() - started)
+            if usage is not None:
+                usage.update(prompt.usage(completion_tokens))
             
-            if output and 'choices' in output and output['choices']:
-                result = output['choices'][0]['text'].strip()
-            else:
-                result = "Model returned empty response"
-            logger.info(f"Model generated {len(result)} characters")
+            if not output or not output.get('choices'):
+                raise RuntimeError("Model returned empty response")
+            result = output['choices'][0]['text'].strip()
+            logger.info(f"Model generated {len(result)} characters ({prompt.prompt_tokens} prompt + {completion_tokens}/{prompt.max_tokens} completion tokens)")
             return result
             
         except Exception as e:
+            # Raised rather than returned as text, so the failure is reported as an error and never cached
             logger.error(f"Model generation failed: {e}")
-            return f"Model generation error: {str(e)}"
+            raise
+
+    def _stream_gguf(self, code: str, context: Dict[str, List[Dict[str, Any]]] | None = None,
+                     usage: Dict[str, int] | None = None, explain: bool = True) -> Iterator[str]:
+        with tracing.stage("prompt"):
+            prompt = self._build_prompt(code, context, explain=explain)
+        generated = 0
+        completion_tokens = 0
+        with self._acquire() as worker, tracing.span("generate", model=self.model_name, stream=True):
+            started = time.perf_counter()
+            for chunk in worker.model(
+                prompt.text,
+                max_tokens=prompt.max_tokens,
+                temperature=0.0,
+                stop=prompt.stop if explain else prompt.stop + [EXPLANATION_HEADER],
+                echo=False,
+                stream=True,
+                grammar=self.grammars.get(self.output_mode)
+            ):
+                text = chunk['choices'][0]['text'] if chunk.get('choices') else ""
+                generated += len(text)
+                completion_tokens += 1
+                worker.tokens += 1
+                yield text
+            self._observe(worker, prompt.prompt_tokens, completion_tokens, time.perf_counter() - started)
+        if usage is not None:
+            usage.update(prompt.usage(completion_tokens))
+        logger.info(f"Model streamed {generated} characters ({prompt.prompt_tokens} prompt + {completion_tokens}/{prompt.max_tokens} completion tokens)")
 
 
-    def call_model(self, code: str, version: str, funcs: List[str], ctx: Dict[str, List[Dict[str, Any]]] | None = None) -> str:
+    def call_model(self, code: str, version: str, funcs: List[str], ctx: Dict[str, List[Dict[str, Any]]] | None = None,
+                   usage: Dict[str, int] | None = None, output_mode: str | None = None, explain: bool = True) -> str:
+        # usage, if given, is filled with the request's token counts; output_mode overrides self.output_mode.
+        # explain=False stops before the explanation section, which explain() can produce later
         logger.info(f"Calling model for {len(funcs)} functions")
         try:
-            return self._generate_gguf(code, ctx)
+            return self._generate_gguf(code, ctx, usage, output_mode, explain)
         except Exception as e:
             logger.exception("Model call exception")
             raise
 
+    def call_model_stream(self, code: str, version: str, funcs: List[str], ctx: Dict[str, List[Dict[str, Any]]] | None = None,
+                          usage: Dict[str, int] | None = None, explain: bool = True) -> Iterator[str]:
+        logger.info(f"Streaming model output for {len(funcs)} functions")
+        return self._stream_gguf(code, ctx, usage, explain)
+
+    def explain(self, code: str, ctx: Dict[str, List[Dict[str, Any]]] | None, partial: str,
+                output_mode: str | None = None, usage: Dict[str, int] | None = None) -> str:
+        # Continues a code-only answer with its explanation. The prompt and partial answer form a token
+        # prefix of this call, so llama.cpp reuses their KV state if the worker still holds it
+        prompt = self._build_prompt(code, ctx, output_mode)
+        text = f"{prompt.text}{partial}\n{EXPLANATION_HEADER}\n"
+        with self._acquire() as worker, tracing.span("generate", model=self.model_name, explanation=True):
+            started = time.perf_counter()
+            output = worker.model(
+                text,
+                max_tokens=OUTPUT_EXPLANATION_TOKENS,
+                temperature=0.0,
+                stop=prompt.stop,
+                echo=False,
+                grammar=self.grammars.get("explanation")
+            )
+            completion_tokens = output.get('usage', {}).get('completion_tokens', 0) if output else 0
+            worker.tokens += completion_tokens
+            self._observe(worker, output.get('usage', {}).get('prompt_tokens', prompt.prompt_tokens) if output else 0,
+                          completion_tokens, time.perf_counter() - started)
+        if usage is not None:
+            usage.update(prompt.usage(completion_tokens))
+            usage["prompt_tokens"] = output.get('usage', {}).get('prompt_tokens', prompt.prompt_tokens)
+            usage["max_tokens"] = OUTPUT_EXPLANATION_TOKENS
+        result = output['choices'][0]['text'].strip() if output and output.get('choices') else ""
+        logger.info(f"Model explained in {completion_tokens} tokens")
+        return result
+
     def is_available(self) -> bool:
-        return self.model is not None
\ No newline at end of file
+        return self.model is not None
+
+    def close(self) -> None:
+        # Frees the llama.cpp contexts; the weights are unmapped once the last context is gone
+        for worker in self.workers:
+            worker.model.close()
+        self.workers = []
+        self._idle = queue.Queue()
+        self.model = None
+        self._prefix = None
\ No newline at end of file
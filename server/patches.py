@@ -0,0 +1,93 @@
+import difflib
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+# Diff output mode: instead of re-emitting the whole snippet, the model lists only the edited lines
+#
+#   ### Changes
+#   @@ 3
+#   - x = np.float(y)
+#   + x = float(y)
+#
+# "@@ N" is the 1-based line of the first original line in the hunk, "- " lines are the original
+# lines and "+ " lines replace them. "None" means nothing changes.
+CHANGES_HEADER = "### Changes"
+
+
+class PatchError(ValueError):
+    pass
+
+
+@dataclass
+class Hunk:
+    line: int
+    remove: List[str] = field(default_factory=list)
+    add: List[str] = field(default_factory=list)
+
+
+def make_patch(original: str, modernized: str) -> str:
+    before, after = original.splitlines(), modernized.splitlines()
+    hunks = []
+    matcher = difflib.SequenceMatcher(a=before, b=after, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        lines = [f"@@ {i1 + 1}"]
+        lines += [f"- {line}" for line in before[i1:i2]]
+        lines += [f"+ {line}" for line in after[j1:j2]]
+        hunks.append("\n".join(lines))
+    return "\n".join(hunks) if hunks else "None"
+
+
+def parse_patch(output: str) -> Optional[List[Hunk]]:
+    # None if the output has no changes section at all
+    if CHANGES_HEADER not in output:
+        return None
+    section = output.split(CHANGES_HEADER, 1)[1].split("### Deprecation Context")[0]
+    lines = [line for line in section.strip("\n").splitlines() if not line.startswith("```")]
+    if not "".join(lines).strip() or "".join(lines).strip() == "None":
+        return []
+
+    hunks: List[Hunk] = []
+    for line in lines:
+        if line.startswith("@@"):
+            try:
+                hunks.append(Hunk(int(line[2:].strip().split()[0])))
+            except (ValueError, IndexError):
+                raise PatchError(f"Bad hunk header: {line!r}")
+        elif line.startswith(("-", "+")) and hunks:
+            text = line[2:] if line[1:2] == " " else line[1:]
+            (hunks[-1].remove if line[0] == "-" else hunks[-1].add).append(text)
+        elif line.strip():
+            raise PatchError(f"Unexpected line in changes section: {line!r}")
+    return hunks
+
+
+def _find(lines: List[str], block: List[str], start: int) -> int:
+    def matches(at: int) -> bool:
+        return [l.rstrip() for l in lines[at:at + len(block)]] == [l.rstrip() for l in block]
+
+    if 0 <= start and matches(start):
+        return start
+    # Models often get the line number slightly wrong; accept the block if it occurs exactly once
+    found = [at for at in range(len(lines) - len(block) + 1) if matches(at)]
+    if len(found) != 1:
+        raise PatchError(f"Lines to replace not found: {block[0]!r}" if block else "Empty hunk")
+    return found[0]
+
+
+def apply_patch(code: str, hunks: List[Hunk]) -> str:
+    lines = code.splitlines()
+    offset = 0
+    for hunk in sorted(hunks, key=lambda h: h.line):
+        if not hunk.remove and not hunk.add:
+            raise PatchError(f"Empty hunk at line {hunk.line}")
+        start = hunk.line - 1 + offset
+        if hunk.remove:
+            start = _find(lines, hunk.remove, start)
+        elif not 0 <= start <= len(lines):
+            raise PatchError(f"Insertion outside the code at line {hunk.line}")
+        lines[start:start + len(hunk.remove)] = hunk.add
+        offset += len(hunk.add) - len(hunk.remove)
+    patched = "\n".join(lines)
+    return patched + "\n" if code.endswith("\n") else patched
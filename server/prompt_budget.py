@@ -0,0 +1,55 @@
+from dataclasses import dataclass
+from typing import Dict, List
+
+from config import OUTPUT_CODE_RATIO, OUTPUT_EXPLANATION_TOKENS, OUTPUT_HEADER_TOKENS, GENERATION_WAIT_SECONDS
+
+EXPLANATION_HEADER = "### Deprecation Context"
+# Part of the response cache key; bump it when the system prompts or the answer format change
+PROMPT_VERSION = 1
+
+
+class PromptTooLongError(ValueError):
+
+    def __init__(self, needed: int, n_ctx: int):
+        super().__init__(f"Input needs about {needed} tokens including its output, more than the model's {n_ctx}-token context")
+        self.needed = needed
+        self.n_ctx = n_ctx
+
+
+class WorkersBusyError(RuntimeError):
+
+    def __init__(self, seconds: float):
+        super().__init__(f"No generation worker became free within {seconds:g} s")
+        self.seconds = seconds
+
+
+def worker_wait_timeout() -> float | None:
+    # Timeout for queue.get / Semaphore.acquire when waiting for a generation worker
+    return GENERATION_WAIT_SECONDS if GENERATION_WAIT_SECONDS > 0 else None
+
+
+@dataclass
+class Prompt:
+    text: str
+    stop: List[str]
+    prompt_tokens: int
+    code_tokens: int
+    context_tokens: int
+    max_tokens: int
+    n_ctx: int
+
+    def usage(self, completion_tokens: int) -> Dict[str, int]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "code_tokens": self.code_tokens,
+            "context_tokens": self.context_tokens,
+            "max_tokens": self.max_tokens,
+            "n_ctx": self.n_ctx,
+        }
+
+
+def output_budget(code_tokens: int, explain: bool = True) -> int:
+    # The answer repeats the code (renames can make it a little longer) and adds a short explanation
+    code = int(code_tokens * OUTPUT_CODE_RATIO)
+    return code + (OUTPUT_EXPLANATION_TOKENS if explain else OUTPUT_HEADER_TOKENS)
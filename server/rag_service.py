@@ -1,18 +1,36 @@
 import ast
+import hashlib
 import logging
-from typing import List, Dict, Set, Any
-import chromadb
-import torch
-from chromadb.config import Settings
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List, Dict, Set, Any, Iterable, Iterator, Callable
 import textwrap
 
-from config import CHROMA_DB_DIR, COLLECTION_NAME, NUMPY_ALIASES
-from schemas import FunctionInfo, CodeAnalysisResponse
-from model_service import ModelService
+from config import CHROMA_DB_DIR, COLLECTION_NAME, NUMPY_ALIASES, EMBEDDING_CACHE_SIZE, RETRIEVAL_CACHE_SIZE, RETRIEVAL_FUNCTION_FILTER
+from config import RESPONSE_CACHE_SIZE, RESPONSE_CACHE_DB, DEPRECATIONS_MD, MODELS_DIR, MODEL_MEMORY_BUDGET_MB
+from config import EMBEDDING_BACKEND, EMBEDDING_MODEL, EMBEDDING_ONNX_DIR, EMBEDDING_GGUF, EMBEDDING_THREADS
+from config import EMBEDDING_PARITY_SAMPLES, EMBEDDING_PARITY_MIN_COSINE, EXPLANATION_STORE_SIZE, OUTPUT_MODE, CONSTRAINED_DECODING
+from cache import LRUCache, ResponseCache
+from schemas import FunctionInfo, CodeAnalysisResponse, FileAnalysisResponse, FileChunkResult, TokenUsage, ExplanationResponse
+from rules import RULES_VERSION, RewriteResult, applicable_rule, apply_rules
+from versions import version_number
+from deprecations import DeprecationIndex, function_key, heading_functions
+from model_registry import ModelRegistry
+from embeddings import create_embedder, check_parity
+from prompt_budget import PROMPT_VERSION, PromptTooLongError, WorkersBusyError
+from patches import CHANGES_HEADER, PatchError, apply_patch, parse_patch
+from metrics import ANALYSIS_SECONDS
+import tracing
 
 logger = logging.getLogger(__name__)
 
 NUMPY_ALIASES = ['np', 'numpy', 'npf', 'numpy_financial']
+# Response shapes guaranteed by constrained decoding (model_service.GRAMMARS): one code block or
+# changes section, then a single-line explanation
+STRUCTURED_FULL = re.compile(r'### Refactored Code\n```python\n(.*?)```\n### Deprecation Context\n([^\n#]*)', re.DOTALL)
+STRUCTURED_DIFF = re.compile(r'### Changes\n(.*?)### Deprecation Context\n([^\n#]*)', re.DOTALL)
 METHODS = ['mean', 'std', 'sum', 'min', 'max', 'var', 'cumprod', 'cumsum', 
                                   'argsort', 'sort', 'tostring', 'tofile', 'astype', 'reshape',
                                   'flatten', 'ravel', 'transpose', 'swapaxes', 'squeeze']
@@ -20,15 +38,29 @@ METHODS = ['mean', 'std', 'sum', 'min', 'max', 'var', 'cumprod', 'cumsum',
 
 class NumpyFunctionExtractor(ast.NodeVisitor):
 
-    def __init__(self):
+    def __init__(self, scope: 'NumpyFunctionExtractor | None' = None):
         self.funcs: List[FunctionInfo] = []
-        self.imports: Dict[str, str] = {}
-        self.star_imports: Set[str] = set()
+        # NumPy attributes referenced without being called, e.g. dtype=np.float
+        self.attrs: List[FunctionInfo] = []
+        # Attribute and method names on other objects (fp.sync(), arr._format), which may be deprecated
+        # members of an array, memmap or iterator
+        self.members: List[FunctionInfo] = []
+        # A scope carries over imports seen elsewhere in the module, for analyzing one chunk of a file
+        self.imports: Dict[str, str] = dict(scope.imports) if scope else {}
+        self.star_imports: Set[str] = set(scope.star_imports) if scope else set()
+        # Names bound by imports of other modules (ET in import xml.etree.ElementTree as ET)
+        self.foreign: Set[str] = set(scope.foreign) if scope else set()
+        # Names assigned from NumPy expressions, and names assigned from anything else
+        self.arrays: Set[str] = set(scope.arrays) if scope else set()
+        self.other_names: Set[str] = set(scope.other_names) if scope else set()
+        self._seen_chains: Set[int] = set()
         
     def visit_Import(self, node):
         for alias in node.names:
             if 'numpy' in alias.name or alias.name == 'numpy_financial':
                 self.imports[alias.asname or alias.name] = alias.name
+            else:
+                self.foreign.add(alias.asname or alias.name.split('.')[0])
         self.generic_visit(node)
         
     def visit_ImportFrom(self, node):
@@ -39,7 +71,37 @@ class NumpyFunctionExtractor(ast.NodeVisitor):
                 for alias in node.names:
                     name = alias.asname or alias.name
                     self.imports[name] = f"{node.module}.{alias.name}"
+        else:
+            self.foreign.update(alias.asname or alias.name for alias in node.names if alias.name != '*')
         self.generic_visit(node)
+
+    def visit_Assign(self, node):
+        self._bind(node.targets, node.value)
+        self.generic_visit(node)
+
+    def visit_AnnAssign(self, node):
+        if node.value is not None:
+            self._bind([node.target], node.value)
+        self.generic_visit(node)
+
+    def _bind(self, targets, value):
+        root = value
+        while isinstance(root, (ast.Attribute, ast.Subscript, ast.Call)):
+            root = root.func if isinstance(root, ast.Call) else root.value
+        is_numpy = isinstance(root, ast.Name) and self._is_numpy_name(root.id)
+        for target in targets:
+            if isinstance(target, ast.Name):
+                (self.arrays if is_numpy else self.other_names).add(target.id)
+
+    def numpy_roots(self) -> Set[str]:
+        # Names whose attributes and methods belong to NumPy: module aliases and variables only ever
+        # assigned from NumPy expressions
+        modules = {name for name in self.imports if self._is_numpy_root(name)} | {'np', 'numpy'}
+        return modules | (self.arrays - self.other_names)
+
+    def _is_numpy_name(self, name: str) -> bool:
+        # Same as name in numpy_roots(), without building the set for every assignment
+        return self._is_numpy_root(name) or name in ('np', 'numpy') or (name in self.arrays and name not in self.other_names)
     
     def visit_Call(self, node):
         func_str = self._extract_call(node)
@@ -47,11 +109,32 @@ class NumpyFunctionExtractor(ast.NodeVisitor):
             self.funcs.append(FunctionInfo(
                 name=func_str,
                 line=node.lineno,
-                call=ast.unparse(node) if hasattr(ast, 'unparse') else str(node)
+                call=ast.unparse(node) if hasattr(ast, 'unparse') else str(node),
+                col=node.col_offset,
+                end_line=node.end_lineno,
+                end_col=node.end_col_offset
             ))
+        elif isinstance(node.func, ast.Attribute) and id(node.func) not in self._seen_chains:
+            self._add_members(node.func, self._get_chain(node.func))
+        self._mark_chain(node.func)
         self.generic_visit(node)
     
     def visit_Attribute(self, node):
+        if id(node) not in self._seen_chains:
+            self._mark_chain(node)
+            chain = self._get_chain(node)
+            if len(chain) > 1 and self._is_numpy_root(chain[0]):
+                self.attrs.append(FunctionInfo(
+                    name = self._qualify_chain(chain),
+                    line = node.lineno,
+                    call = '.'.join(chain),
+                    col = node.col_offset,
+                    end_line = node.end_lineno,
+                    end_col = node.end_col_offset
+                ))
+            else:
+                self._add_members(node, chain)
+
         if isinstance(node.value, ast.Name) and node.value.id in NUMPY_ALIASES:
             return
         chain = self._get_chain(node)
@@ -60,7 +143,10 @@ class NumpyFunctionExtractor(ast.NodeVisitor):
             self.funcs.append(FunctionInfo(
                 name = chain[-1],
                 line = node.lineno,
-                call = '.'.join(chain)
+                call = '.'.join(chain),
+                col = node.col_offset,
+                end_line = node.end_lineno,
+                end_col = node.end_col_offset
             ))
         self.generic_visit(node)
     
@@ -76,18 +162,48 @@ class NumpyFunctionExtractor(ast.NodeVisitor):
         elif isinstance(node.func, ast.Attribute):
             chain = self._get_chain(node.func)
             if chain:
-                root = chain[0]
-                if root in self.imports:
-                    base = self.imports[root]
-                    full_name = f"{base}.{'.'.join(chain[1:])}"
-                    return full_name.replace('numpy.', 'np.')
-                elif root in ['np', 'numpy', 'npf', 'numpy_financial'] + list(NUMPY_ALIASES):
-                    full_name = '.'.join(chain)
-                    return full_name.replace('numpy.', 'np.')
-                elif self.star_imports and len(chain) > 1:
-                    return '.'.join(chain)
+                return self._qualify_chain(chain)
                 
         return None
+
+    def _qualify_chain(self, chain):
+        root = chain[0]
+        if root in self.imports:
+            base = self.imports[root]
+            full_name = f"{base}.{'.'.join(chain[1:])}"
+            return full_name.replace('numpy.', 'np.')
+        elif root in ['np', 'numpy', 'npf', 'numpy_financial'] + list(NUMPY_ALIASES):
+            full_name = '.'.join(chain)
+            return full_name.replace('numpy.', 'np.')
+        elif self.star_imports and len(chain) > 1:
+            return '.'.join(chain)
+        return None
+
+    def _is_numpy_root(self, root):
+        if root in self.imports:
+            return self.imports[root].split('.')[0] == 'numpy'
+        return root in ('np', 'numpy')
+
+    def _add_members(self, node, chain):
+        # The chain starts with a variable name, or hangs off a call or subscript
+        root = node
+        while isinstance(root, ast.Attribute):
+            root = root.value
+        for member in (chain[1:] if isinstance(root, ast.Name) else chain):
+            self.members.append(FunctionInfo(
+                name = member,
+                line = node.lineno,
+                call = '.'.join(chain),
+                col = node.col_offset,
+                end_line = node.end_lineno,
+                end_col = node.end_col_offset
+            ))
+
+    def _mark_chain(self, node):
+        # Inner links of an attribute chain (np.fft in np.fft.refft) are not separate references
+        while isinstance(node, ast.Attribute):
+            self._seen_chains.add(id(node))
+            node = node.value
     
     def _get_chain(self, node):
 
@@ -100,107 +216,482 @@ class NumpyFunctionExtractor(ast.NodeVisitor):
             parts.append(node.id)
         return list(reversed(parts))
 
+def _call_keywords(call: str) -> List[str]:
+    try:
+        node = ast.parse(call, mode='eval').body
+    except SyntaxError:
+        return []
+    return [kw.arg for kw in node.keywords if kw.arg] if isinstance(node, ast.Call) else []
+
+
+@dataclass
+class RewriteStage:
+    rewrite: RewriteResult
+    unique_funcs: List[str]
+    candidates: Dict[str, str | None] | None
+
+    @property
+    def needs_model(self) -> bool:
+        return bool(self.rewrite.unresolved) or self.candidates is None or bool(self.candidates)
+
+
+@dataclass
+class AnalysisPlan:
+    code: str
+    version: str
+    rewrite: RewriteResult
+    rule_code: str
+    unique_funcs: List[str]
+    ctx: Dict[str, List[Dict[str, Any]]]
+    retrieved_context: Dict[str, List[str]]
+    needs_model: bool
+    skip_reason: str | None = None
+    model: str | None = None
+    # False generates only the code; the explanation is produced later through RAGService.explain
+    explain: bool = True
+
+    @property
+    def model_input(self) -> str:
+        return self.rule_code or self.code
+
+
+@dataclass
+class BatchPlan:
+    items: List[tuple[str, str, str]]
+    keys: List[str]
+    # Response key -> index of the first item with that key
+    first: Dict[str, int] = field(default_factory=dict)
+    plans: Dict[str, AnalysisPlan] = field(default_factory=dict)
+    outcomes: Dict[str, CodeAnalysisResponse | Exception] = field(default_factory=dict)
+
+
+@dataclass
+class CodeChunk:
+    name: str
+    start: int
+    end: int
+    nodes: List[ast.stmt]
+
+
+def split_module(tree: ast.Module) -> List[CodeChunk]:
+    # Top-level functions and classes become their own chunks; runs of other statements are grouped
+    chunks: List[CodeChunk] = []
+    for node in tree.body:
+        start = min([node.lineno] + [d.lineno for d in getattr(node, 'decorator_list', [])])
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            chunks.append(CodeChunk(node.name, start, node.end_lineno, [node]))
+        elif chunks and chunks[-1].name == "<module>":
+            chunks[-1].end = node.end_lineno
+            chunks[-1].nodes.append(node)
+        else:
+            chunks.append(CodeChunk("<module>", start, node.end_lineno, [node]))
+    return chunks
+
+
+class CodeSectionStream:
+    # Picks the body of the ```python block under "### Refactored Code" out of streamed model text
+
+    def __init__(self):
+        self.buffer = ""
+        self.state = "header"
+
+    def feed(self, text: str) -> str:
+        self.buffer += text
+        if self.state == "header":
+            header = self.buffer.find("### Refactored Code")
+            fence = self.buffer.find("```python", header) if header >= 0 else -1
+            newline = self.buffer.find("\n", fence) if fence >= 0 else -1
+            if newline < 0:
+                return ""
+            self.buffer = self.buffer[newline + 1:]
+            self.state = "code"
+        if self.state == "code":
+            end = self.buffer.find("```")
+            if end >= 0:
+                out = self.buffer[:end]
+                self.buffer = ""
+                self.state = "done"
+                return out
+            # Hold back trailing backticks that may be the start of the closing fence
+            keep = len(self.buffer) - len(self.buffer.rstrip("`"))
+            out = self.buffer[:len(self.buffer) - keep]
+            self.buffer = self.buffer[len(self.buffer) - keep:]
+            return out
+        return ""
+
+    def flush(self) -> str:
+        return ""
+
+
+class ChangesSectionStream:
+    # Diff output mode: picks the hunk lines under "### Changes" out of streamed model text, a whole line at a time
+
+    def __init__(self):
+        self.buffer = ""
+        self.state = "header"
+
+    def feed(self, text: str) -> str:
+        self.buffer += text
+        if self.state == "header":
+            header = self.buffer.find(CHANGES_HEADER)
+            newline = self.buffer.find("\n", header) if header >= 0 else -1
+            if newline < 0:
+                return ""
+            self.buffer = self.buffer[newline + 1:]
+            self.state = "changes"
+        if self.state != "changes":
+            return ""
+        end = self.buffer.rfind("\n")
+        if end < 0:
+            return ""
+        lines, self.buffer = self.buffer[:end + 1], self.buffer[end + 1:]
+        return self._section(lines)
+
+    def flush(self) -> str:
+        # The last line has no newline when generation stops at the end of the section
+        lines, self.buffer = self.buffer, ""
+        return self._section(lines) if self.state == "changes" else ""
+
+    def _section(self, lines: str) -> str:
+        out = []
+        for line in lines.splitlines(keepends=True):
+            if line.startswith("###"):
+                self.state = "done"
+                break
+            if not line.startswith("```"):
+                out.append(line)
+        return "".join(out)
+
+
 class RAGService:
 
-    def __init__(self, model_name: str | None = None):
+    def __init__(self, model_name: str | None = None, background: bool = False):
+        if not model_name:
+            raise ValueError("Model name is required")
+        self.model_name = model_name
+        # Resident ModelServices; model_name is preloaded and serves requests that do not pick a model
+        self.models = ModelRegistry(MODELS_DIR, model_name, MODEL_MEMORY_BUDGET_MB * 2**20)
         self.collection: Any = None
-        self._init_chroma()
-        if model_name:
-            self.model = ModelService(model_name)
+        self.embed_fn: Any = None
+        self.embedding_info: Dict[str, Any] = {"backend": EMBEDDING_BACKEND}
+        # Component name -> {"state": pending|loading|ready|failed, "load_seconds", "error"}
+        self.components: Dict[str, Dict[str, Any]] = {
+            name: {"state": "pending", "load_seconds": None, "error": None}
+            for name in ("deprecations", "vector_store", "model")
+        }
+        self.embedding_cache = LRUCache(EMBEDDING_CACHE_SIZE)
+        self.retrieval_cache = LRUCache(RETRIEVAL_CACHE_SIZE)
+        self.response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_DB)
+        # Handle -> what is needed to continue a code-only answer with its explanation
+        self.explanations = LRUCache(EXPLANATION_STORE_SIZE)
+        self._collection_state: Any = None
+        self.counters: Dict[str, int] = {"skipped_generations": 0, "patch_applied": 0, "patch_failed": 0}
+        self._counter_lock = threading.Lock()
+        self.deprecations: DeprecationIndex | None = None
+        self._load("deprecations", self._init_deprecations)
+
+        loaders = [("vector_store", self._init_chroma), ("model", self._init_model)]
+        if background:
+            # Components load in parallel; requests are refused until is_ready()
+            for name, loader in loaders:
+                threading.Thread(target=self._load, args=(name, loader), name=f"load-{name}", daemon=True).start()
         else:
-            raise ValueError("Model name is required")
-        
+            for name, loader in loaders:
+                self._load(name, loader)
+            if self.components["model"]["state"] == "failed":
+                raise RuntimeError(self.components["model"]["error"])
+
+    def _load(self, name: str, loader: Callable[[], None]) -> None:
+        status = self.components[name]
+        status["state"] = "loading"
+        start = time.perf_counter()
+        try:
+            loader()
+            status["state"] = "ready"
+        except Exception as e:
+            logger.error(f"Loading {name} failed: {e}")
+            status["state"] = "failed"
+            status["error"] = str(e)
+        status["load_seconds"] = round(time.perf_counter() - start, 3)
+        logger.info(f"{name}: {status['state']} after {status['load_seconds']}s")
+
+    def _init_deprecations(self) -> None:
+        try:
+            self.deprecations = DeprecationIndex.from_markdown(DEPRECATIONS_MD)
+        except Exception as e:
+            logger.error(f"Deprecation index unavailable, every request will call the model: {e}")
+            raise
+
+    def _check_embedding_parity(self) -> None:
+        if EMBEDDING_PARITY_SAMPLES <= 0:
+            return
+        try:
+            parity = check_parity(self.embed_fn, self.collection, EMBEDDING_PARITY_SAMPLES)
+        except Exception as e:
+            logger.warning(f"Embedding parity check failed: {e}")
+            return
+        self.embedding_info.update(parity)
+        if parity["samples"]:
+            logger.info(f"Embedding parity ({EMBEDDING_BACKEND}) vs stored vectors: {parity}")
+            if parity["min_cosine"] < EMBEDDING_PARITY_MIN_COSINE:
+                logger.warning(f"{EMBEDDING_BACKEND} embeddings diverge from the stored vectors; retrieval quality may drop")
+
+    def _init_model(self) -> None:
+        self.models.load(self.model_name)
+
     def _init_chroma(self) -> None:
         try:
-            from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
-            embed_fn = SentenceTransformerEmbeddingFunction(
-                model_name="BAAI/bge-base-en-v1.5",
-                device="mps" if torch.backends.mps.is_available() else "cpu"
-            )
+            import chromadb
+            from chromadb.config import Settings
+            embed_fn = create_embedder(EMBEDDING_BACKEND, EMBEDDING_MODEL, EMBEDDING_ONNX_DIR, EMBEDDING_GGUF, EMBEDDING_THREADS)
+            # Queries pass precomputed embeddings, so only the sentence-transformers function is
+            # registered with Chroma; the other backends would not match the collection's persisted config
+            ef_kwargs = {"embedding_function": embed_fn} if EMBEDDING_BACKEND == "sentence-transformers" else {}
             
             client = chromadb.PersistentClient(
                 path=CHROMA_DB_DIR,
                 settings=Settings(anonymized_telemetry=False)
             )
             try:
-                self.collection = client.get_collection(COLLECTION_NAME, embedding_function=embed_fn)
+                self.collection = client.get_collection(COLLECTION_NAME, **ef_kwargs)
                 logger.info(f"Connected to collection: {COLLECTION_NAME}")
             except:
                 self.collection = client.create_collection(
                     name=COLLECTION_NAME,
-                    embedding_function=embed_fn,
-                    metadata={"hnsw:space": "cosine"}
+                    metadata={"hnsw:space": "cosine"},
+                    **ef_kwargs
                 )
                 logger.info(f"Created collection: {COLLECTION_NAME}")
+            self.embed_fn = embed_fn
+            self._backfill_metadata()
+            self._collection_state = self._collection_fingerprint()
+            # Warm up the embedder so the first request does not pay for it
+            embed_fn(["numpy"])
+            self._check_embedding_parity()
 
         except Exception as e:
             logger.error(f"ChromaDB init failed: {e}")
+            self.collection = None
+            raise
     
-    def extract_funcs(self, code: str) -> List[FunctionInfo]:
-
+    def _extract(self, code: str, scope: NumpyFunctionExtractor | None = None) -> NumpyFunctionExtractor | None:
         try:
             tree = ast.parse(code)
-            extractor = NumpyFunctionExtractor()
+            extractor = NumpyFunctionExtractor(scope)
             extractor.visit(tree)
-            return extractor.funcs
+            return extractor
         except Exception as e:
             logger.error(f"Function extraction failed: {e}")
-            return []
-    
-    def _func_matches_content(self, func: str, content: str) -> bool:
-        func_parts = func.replace('np.', '').replace('numpy.', '').split('.')
-        content_lower = content.lower()
-        return any(part.lower() in content_lower for part in func_parts if len(part) > 2)
+            return None
+
+    def extract_funcs(self, code: str, scope: NumpyFunctionExtractor | None = None) -> List[FunctionInfo]:
+        extractor = self._extract(code, scope)
+        return extractor.funcs if extractor else []
+
+    def apply_rules(self, code: str, version: str, max_passes: int = 3, scope: NumpyFunctionExtractor | None = None) -> RewriteResult:
+        # Repeated passes pick up rewrites nested inside an earlier one, e.g. np.asscalar(np.product(x))
+        result = RewriteResult(code)
+        for _ in range(max_passes):
+            extractor = self._extract(result.code, scope)
+            if not extractor:
+                break
+            step = apply_rules(result.code, extractor.funcs + extractor.attrs, version,
+                               extractor.numpy_roots(), extractor.foreign)
+            result.unresolved = step.unresolved
+            if not step.applied:
+                break
+            result.code = step.code
+            result.applied.extend(step.applied)
+        return result
+
+    def _reindent(self, dedented: str, original: str) -> str:
+        for orig_line, ded_line in zip(original.splitlines(), textwrap.dedent(original).splitlines()):
+            if ded_line.strip():
+                margin = orig_line[:len(orig_line) - len(ded_line)]
+                return textwrap.indent(dedented, margin) if margin else dedented
+        return dedented
     
+    def _backfill_metadata(self) -> None:
+        # Collections built before version_num and the function:<name> tags were stored cannot be
+        # range-filtered by version or filtered by function
+        data = self.collection.get(include=["metadatas"])
+        ids, metadatas = [], []
+        for doc_id, metadata in zip(data['ids'], data['metadatas'] or []):
+            if not metadata:
+                continue
+            added: Dict[str, Any] = {}
+            number = version_number(str(metadata.get('version', '')))
+            if 'version_num' not in metadata and number is not None:
+                added['version_num'] = number
+            for name in heading_functions(str(metadata.get('function', ''))):
+                if function_key(name) not in metadata:
+                    added[function_key(name)] = True
+            if added:
+                ids.append(doc_id)
+                metadatas.append({**metadata, **added})
+        if ids:
+            self.collection.update(ids=ids, metadatas=metadatas)
+            logger.info(f"Added version and function metadata to {len(ids)} chunks")
+
+    def _collection_fingerprint(self) -> Any:
+        return (self.collection.id, self.collection.count()) if self.collection else None
+
+    def check_collection(self) -> None:
+        # Retrieved chunks are only valid for the collection contents they were ranked against
+        state = self._collection_fingerprint()
+        if state != self._collection_state:
+            logger.info("Collection changed, clearing retrieval and response caches")
+            self.retrieval_cache.clear()
+            self.response_cache.clear()
+            self._collection_state = state
+
+    def _embed(self, texts: List[str]) -> List[Any]:
+        embeddings: Dict[str, Any] = {}
+        missing = []
+        for text in texts:
+            cached = self.embedding_cache.get(text)
+            if cached is None:
+                missing.append(text)
+            else:
+                embeddings[text] = cached
+        if missing:
+            with tracing.stage("embed", texts=len(missing)):
+                vectors = self.embed_fn(missing)
+            for text, embedding in zip(missing, vectors):
+                self.embedding_cache.put(text, embedding)
+                embeddings[text] = embedding
+        return [embeddings[text] for text in texts]
+
+    def _count(self, name: str) -> None:
+        with self._counter_lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            "embedding": self.embedding_cache.stats(),
+            "retrieval": self.retrieval_cache.stats(),
+            "response": self.response_cache.stats(),
+            "explanation": self.explanations.stats(),
+        }
+
     def query_db(self, func: str, version: str) -> List[Dict[str, Any]]:
-        if not self.collection:
-            return []
-        try:
-            base_func = func.split('.')[-1]
-            variations = [base_func, func, f"numpy.{base_func}", f"np.{base_func}"]
-            seen_content = set()
-            unique_chunks = []
-            
-            for variant in variations:
-                query = f"{variant} numpy {version} deprecated"
-                res = self.collection.query(
-                    query_texts = [query],
-                    n_results = 3,
-                    include = ["documents", "metadatas", "distances"]
-                )
-                if res['documents'] and res['documents'][0]:
+        return self.query_many([func], version)[func]
 
-                    for i, doc in enumerate(res['documents'][0]):
+    def query_many(self, funcs: List[str], version: str) -> Dict[str, List[Dict[str, Any]]]:
+        # Embeds every query variant of every function in one batch and searches them all with one query call.
+        # With the function filter, the call is restricted to chunks tagged with any of the pending functions,
+        # and each function only keeps the chunks tagged with its own name
+        ctx: Dict[str, List[Dict[str, Any]]] = {}
+        pending = []
+        for func in funcs:
+            cached = self.retrieval_cache.get((func, version))
+            if cached is not None:
+                ctx[func] = list(cached)
+            elif func not in pending:
+                pending.append(func)
+        if pending and not self.collection:
+            for func in pending:
+                ctx[func] = []
+            pending = []
+        if pending:
+            try:
+                queries = {func: [f"{variant} numpy deprecated" for variant in self._variations(func)] for func in pending}
+                texts = list(dict.fromkeys(q for func_queries in queries.values() for q in func_queries))
+                embeddings = dict(zip(texts, self._embed(texts)))
+                keys = {func: function_key(func) for func in pending} if RETRIEVAL_FUNCTION_FILTER else {}
+                where = self._combine_filters(self._version_filter(version), self._function_filter(keys.values()))
+                # A row can return chunks of the other pending functions, so each row fetches 3 per function
+                n_results = 3 * len(set(keys.values())) if keys else 3
+                with tracing.stage("search", functions=len(pending), queries=len(texts)):
+                    res = self.collection.query(
+                        query_embeddings = [embeddings[q] for q in texts],
+                        n_results = n_results,
+                        where = where,
+                        include = ["documents", "metadatas", "distances"]
+                    )
+                rows = {text: i for i, text in enumerate(texts)}
+                for func in pending:
+                    ctx[func] = self._rank_chunks(res, [rows[q] for q in queries[func]], keys.get(func))
+                    self.retrieval_cache.put((func, version), ctx[func])
+            except Exception as e:
+                logger.error(f"DB query failed for {pending}: {e}")
+                for func in pending:
+                    ctx[func] = []
+        return {func: ctx[func] for func in funcs}
 
-                        score = 1 - res['distances'][0][i]
+    def _version_filter(self, version: str) -> Dict[str, Any] | None:
+        number = version_number(version)
+        return {"version_num": {"$lte": number}} if number is not None else None
 
-                        if score >= 0.4 and self._func_matches_content(func, doc):
+    def _function_filter(self, keys: Iterable[str]) -> Dict[str, Any] | None:
+        # Chunks are tagged function:<name> for every API name their heading mentions
+        clauses = [{key: True} for key in dict.fromkeys(keys)]
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$or": clauses}
 
-                            content_hash = hash(doc[:200])
+    def _combine_filters(self, *filters: Dict[str, Any] | None) -> Dict[str, Any] | None:
+        clauses = [f for f in filters if f]
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
 
-                            if content_hash not in seen_content:
-                                seen_content.add(content_hash)
-                                chunk_data = {
-                                    'content': doc,
-                                    'metadata': res['metadatas'][0][i] if res['metadatas'] else {},
-                                    'similarity_score': score
-                                }
+    def _variations(self, func: str) -> List[str]:
+        base_func = func.split('.')[-1]
+        return [base_func, func, f"numpy.{base_func}", f"np.{base_func}"]
 
-                                unique_chunks.append(chunk_data)
-            
-            unique_chunks.sort(key = lambda x: x['similarity_score'], reverse = True)
-            return unique_chunks[:3]
-            
-        except Exception as e:
-            logger.error(f"DB query failed for {func}: {e}")
-            return []
+    def _rank_chunks(self, res: Dict[str, Any], rows: Iterable[int], key: str | None = None) -> List[Dict[str, Any]]:
+        # key, if given, is the function tag a chunk's metadata needs to be kept
+        seen_content = set()
+        unique_chunks = []
+
+        for row in rows:
+            if res['documents'] and res['documents'][row]:
+
+                for i, doc in enumerate(res['documents'][row]):
+
+                    score = 1 - res['distances'][row][i]
+                    metadata = res['metadatas'][row][i] if res['metadatas'] else {}
+
+                    if score >= 0.4 and (key is None or (metadata or {}).get(key)):
+
+                        content_hash = hash(doc[:200])
+
+                        if content_hash not in seen_content:
+                            seen_content.add(content_hash)
+                            chunk_data = {
+                                'content': doc,
+                                'metadata': metadata,
+                                'similarity_score': score
+                            }
+
+                            unique_chunks.append(chunk_data)
+
+        unique_chunks.sort(key = lambda x: x['similarity_score'], reverse = True)
+        return unique_chunks[:3]
     
     def extract_changes(self, output: str, original_code: str = "", context: Dict[str, List[Dict[str, Any]]] | None = None) -> tuple[str, str]:
         # Parse output based on the expected format from fine-tuned models
         modernized_code = ""
         explanation = ""
+        structured = STRUCTURED_FULL.fullmatch(output)
         
-        if "### Refactored Code" in output:
+        if structured:
+            modernized_code, explanation = structured.group(1), structured.group(2).strip()
+        elif CHANGES_HEADER in output:
+            # Diff output mode: apply the listed line edits to the code the model was given
+            try:
+                hunks = parse_patch(output)
+                modernized_code = apply_patch(original_code, hunks) if hunks else original_code
+            except PatchError as e:
+                logger.warning(f"Could not apply the model's changes: {e}")
+                modernized_code = original_code
+            structured = STRUCTURED_DIFF.fullmatch(output)
+            if structured:
+                explanation = structured.group(2).strip()
+            elif "### Deprecation Context" in output:
+                explanation = self._context_section(output)
+        elif "### Refactored Code" in output:
             # Extract code section
             parts = output.split("### Refactored Code")
             if len(parts) > 1:
@@ -214,14 +705,7 @@ class RAGService:
                 
                 # Extract explanation from Deprecation Context section only
                 if "### Deprecation Context" in output:
-                    explanation = output.split("### Deprecation Context")[1].strip()
-                    # Filter out markdown code blocks and links
-                    import re
-                    explanation = re.sub(r'```python.*?```', '', explanation, flags=re.DOTALL).strip()
-                    explanation = re.sub(r'\[.*?\]\(.*?\)', '', explanation).strip()
-                    explanation = re.sub(r'###.*', '', explanation).strip()
-                    if "### INPUT CODE:" in explanation:
-                        explanation = explanation.split("### INPUT CODE:")[0].strip()
+                    explanation = self._context_section(output)
         else:
             # Fallback: use the entire output as code
             modernized_code = output
@@ -232,66 +716,465 @@ class RAGService:
             explanation = "No deprecated functionality found"
         
         return modernized_code, explanation
+
+    def _context_section(self, output: str) -> str:
+        explanation = output.split("### Deprecation Context")[1].strip()
+        # Filter out markdown code blocks and links
+        explanation = re.sub(r'```python.*?```', '', explanation, flags=re.DOTALL).strip()
+        explanation = re.sub(r'\[.*?\]\(.*?\)', '', explanation).strip()
+        explanation = re.sub(r'###.*', '', explanation).strip()
+        if "### INPUT CODE:" in explanation:
+            explanation = explanation.split("### INPUT CODE:")[0].strip()
+        return explanation
+
+    def _check_patch(self, service: Any, plan: AnalysisPlan, output: str, usage: Dict[str, int]) -> str:
+        # Diff-mode answers that do not apply to the input are regenerated in full-code mode
+        if service.output_mode != "diff":
+            return output
+        try:
+            hunks = parse_patch(output)
+            if hunks is None:
+                raise PatchError("No changes section in the output")
+            apply_patch(plan.model_input, hunks)
+            self._count("patch_applied")
+            return output
+        except PatchError as e:
+            logger.warning(f"Patch failed ({e}), regenerating the full code")
+            self._count("patch_failed")
+            return service.call_model(plan.model_input, plan.version, plan.unique_funcs, plan.ctx, usage,
+                                      output_mode="full", explain=plan.explain)
     
-    def analyze_code(self, code: str, version: str) -> CodeAnalysisResponse:
+    def _response_key(self, code: str, version: str, model: str, scope: NumpyFunctionExtractor | None = None,
+                      explain: bool = True) -> str:
+        # Indentation is not part of the key; cached code is stored dedented and re-indented on a hit.
+        # The model file, output format, rule table and prompts are part of it, as they all change the answer
+        parts = [textwrap.dedent(code).strip("\n"), version, self.models.identity(model), repr(self._collection_state),
+                 OUTPUT_MODE, "grammar" if CONSTRAINED_DECODING else "free", RULES_VERSION, str(PROMPT_VERSION)]
+        if scope:
+            parts.append(repr(sorted(scope.imports.items())) + repr(sorted(scope.star_imports)))
+        if not explain:
+            parts.append("code-only")
+        key = "\0".join(parts)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _cached_response(self, key: str, code: str) -> CodeAnalysisResponse | None:
+        cached = self.response_cache.get(key)
+        if cached is None:
+            return None
+        logger.info("Serving analysis from response cache")
+        result = CodeAnalysisResponse.model_validate_json(cached)
+        if result.modernized_code:
+            result.modernized_code = self._reindent(result.modernized_code, code)
+        return result
+
+    def _store_response(self, key: str, result: CodeAnalysisResponse) -> None:
+        if result.error is None:
+            stored = result.model_copy(update={"modernized_code": textwrap.dedent(result.modernized_code)})
+            self.response_cache.put(key, stored.model_dump_json())
+
+    def analyze_code(self, code: str, version: str, model: str | None = None, explain: bool = True) -> CodeAnalysisResponse:
+        started = time.perf_counter()
+        self.check_collection()
+        model = self.models.resolve(model)
+        key = self._response_key(code, version, model, explain=explain)
+        result = self._cached_response(key, code)
+        if result is not None and result.explanation_handle and self.explanations.get(result.explanation_handle) is None:
+            # The handle outlived its explanation store entry; generate again so it can be explained
+            result = None
+        source = "cache" if result is not None else "pipeline"
+        if result is None:
+            try:
+                result = self._analyze(code, version, model, explain, key)
+            except PromptTooLongError as e:
+                result = self._split_oversized(code, version, model, e)
+            self._store_response(key, result)
+        ANALYSIS_SECONDS.observe(time.perf_counter() - started, source=source)
+        return result
+
+    def _split_oversized(self, code: str, version: str, model: str, error: PromptTooLongError) -> CodeAnalysisResponse:
+        # A snippet too long for one prompt is analyzed like a file, one top-level chunk per prompt
+        try:
+            chunks = split_module(ast.parse(textwrap.dedent(code)))
+        except SyntaxError:
+            chunks = []
+        if len(chunks) < 2:
+            raise error
+        logger.info(f"{error}; splitting into {len(chunks)} chunks")
+        result = self.analyze_file(textwrap.dedent(code), version, model)
+        return CodeAnalysisResponse(
+            modernized_code = self._reindent(result.modernized_code, code),
+            retrieved_context = result.retrieved_context,
+            explanation = result.explanation,
+            error = result.error
+        )
+
+    def analyze_code_stream(self, code: str, version: str, model: str | None = None,
+                            explain: bool = True) -> Iterator[Dict[str, Any]]:
+        # Yields {"event": "token", "data": {"text": ...}} for the refactored code as it is decoded (in diff
+        # output mode {"event": "patch", ...} with each hunk line instead), then a single
+        # {"event": "result", "data": <CodeAnalysisResponse>}. The result is authoritative: a patch that does
+        # not apply is regenerated in full without further events
+        self.check_collection()
+        model = self.models.resolve(model)
+        key = self._response_key(code, version, model, explain=explain)
+        result = self._cached_response(key, code)
+        if result is not None and result.explanation_handle and self.explanations.get(result.explanation_handle) is None:
+            result = None
+        if result is None:
+            plan = self._prepare(code, version, model, explain)
+            if not plan.needs_model:
+                result = self._without_model(plan)
+            else:
+                pieces = []
+                usage: Dict[str, int] = {}
+                try:
+                    with self.models.use(plan.model) as service:
+                        diff = service.output_mode == "diff"
+                        section = ChangesSectionStream() if diff else CodeSectionStream()
+                        event = "patch" if diff else "token"
+                        for piece in service.call_model_stream(plan.model_input, version, plan.unique_funcs, plan.ctx,
+                                                               usage, explain=explain):
+                            pieces.append(piece)
+                            text = section.feed(piece)
+                            if text:
+                                yield {"event": event, "data": {"text": text}}
+                        text = section.flush()
+                        if text:
+                            yield {"event": event, "data": {"text": text}}
+                        output = self._check_patch(service, plan, "".join(pieces).strip(), usage)
+                    result = self._finish(plan, output, usage, key)
+                except PromptTooLongError as e:
+                    result = self._split_oversized(code, version, model, e)
+                except WorkersBusyError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Model call failed: {e}")
+                    result = self._model_error(plan, e)
+            self._store_response(key, result)
+        yield {"event": "result", "data": result.model_dump()}
+
+    def _candidates(self, extractor: NumpyFunctionExtractor, version: str) -> Dict[str, str | None] | None:
+        # Symbols in the code that need the model for this version, mapped to the version they were deprecated
+        # in, or to None for NumPy calls that are neither indexed nor part of the installed NumPy API (they may be
+        # deprecated all the same). None means the index is unavailable and every snippet has to be treated as a candidate.
+        if self.deprecations is None:
+            return None
+        found: Dict[str, str | None] = {}
+        for info in extractor.funcs + extractor.attrs + extractor.members:
+            # Symbols with a rule were either rewritten or reported as unresolved by the rule engine
+            if applicable_rule(info.name, version):
+                continue
+            since = self.deprecations.lookup(info.name, version, _call_keywords(info.call))
+            if since:
+                found[info.name] = since
+        for info in extractor.funcs:
+            if info.name.startswith(('np.', 'numpy.')) and info.name not in found and not self.deprecations.knows(info.name):
+                found[info.name] = None
+        return found
+
+    def _rewrite(self, code: str, version: str, scope: NumpyFunctionExtractor | None = None) -> RewriteStage:
         logger.info(f"Analyzing code with NumPy {version}")
         dedented_code = textwrap.dedent(code)
-        funcs = self.extract_funcs(dedented_code)
+        with tracing.stage("rules"):
+            rewrite = self.apply_rules(dedented_code, version, scope=scope)
+        if rewrite.applied:
+            logger.info(f"Rules rewrote {len(rewrite.applied)} deprecated usages, {len(rewrite.unresolved)} left for the model")
+        with tracing.stage("extract"):
+            extractor = self._extract(rewrite.code, scope)
+        funcs = extractor.funcs if extractor else []
         unique_funcs = list({f.name for f in funcs})
         logger.info(f"Found {len(unique_funcs)} unique NumPy functions: {unique_funcs}")
-        ctx: Dict[str, List[Dict[str, Any]]] = {}
-        for fn in unique_funcs:
-            ctx[fn] = self.query_db(fn, version)
-        
+        candidates = self._candidates(extractor, version) if extractor else None
+        if candidates:
+            logger.info(f"Symbols for the model (deprecated since, or None if not known): {candidates}")
+        return RewriteStage(rewrite, unique_funcs, candidates)
+
+    def _prepare(self, code: str, version: str, model: str, explain: bool = True) -> AnalysisPlan:
+        stage = self._rewrite(code, version)
+        with tracing.span("retrieve", functions=len(stage.unique_funcs)):
+            ctx = self.query_many(stage.unique_funcs, version) if stage.needs_model else {}
+        return self._plan(code, version, stage, ctx, model, explain)
+
+    def _plan(self, code: str, version: str, stage: RewriteStage, ctx: Dict[str, List[Dict[str, Any]]], model: str,
+              explain: bool = True) -> AnalysisPlan:
         retrieved_context = {}
         for fn, chunks in ctx.items():
             if chunks:
                 retrieved_context[fn] = [chunks[0]['content']]
-        
-        #When DB is coomplete, this is a suitable early exit
-        '''if retrieved_context == {}:
+
+        rewrite = stage.rewrite
+        rule_code = self._reindent(rewrite.code, code) if rewrite.applied else ""
+        skip_reason = None
+        if not stage.needs_model:
+            if rewrite.applied:
+                skip_reason = "All deprecated usages were rewritten by rules"
+            else:
+                skip_reason = f"No known deprecated NumPy usage for version {version}"
+            logger.info(f"Skipping model: {skip_reason}")
+            self._count("skipped_generations")
+
+        return AnalysisPlan(
+            code = code,
+            version = version,
+            rewrite = rewrite,
+            rule_code = rule_code,
+            unique_funcs = stage.unique_funcs,
+            ctx = ctx,
+            retrieved_context = retrieved_context,
+            needs_model = stage.needs_model,
+            skip_reason = skip_reason,
+            model = model,
+            explain = explain
+        )
+
+    def _without_model(self, plan: AnalysisPlan) -> CodeAnalysisResponse:
+        return CodeAnalysisResponse(
+            modernized_code = plan.rule_code,
+            retrieved_context = plan.retrieved_context,
+            explanation = plan.rewrite.explanation(),
+            skip_reason = plan.skip_reason,
+            error = None if not plan.needs_model else "Model service unavailable"
+        )
+
+    def _model_error(self, plan: AnalysisPlan, error: Exception) -> CodeAnalysisResponse:
+        return CodeAnalysisResponse(
+            modernized_code = plan.rule_code,
+            retrieved_context = plan.retrieved_context,
+            explanation = plan.rewrite.explanation(),
+            error = str(error)
+        )
+
+    def _finish(self, plan: AnalysisPlan, output: str, usage: Dict[str, int] | None = None,
+                handle: str | None = None) -> CodeAnalysisResponse:
+        with tracing.span("extract_changes"):
+            modernized_code, explanation= self.extract_changes(output, plan.model_input, plan.ctx)
+        token_usage = TokenUsage(**usage) if usage else None
+        if not plan.explain and handle and modernized_code != plan.model_input:
+            # Code-only answer: the model's explanation is generated on demand by explain(handle)
+            self.explanations.put(handle, {
+                "model": plan.model,
+                "code": plan.model_input,
+                "ctx": plan.ctx,
+                "partial": output,
+                "output_mode": None if CHANGES_HEADER in output else "full",
+                "rules": plan.rewrite.explanation() if plan.rewrite.applied else "",
+                "result": None,
+            })
             return CodeAnalysisResponse(
-                    modernized_code = "",
-                    explanation = "",
-                )
-        '''
-        if self.model.is_available():
-            try:
-                output = self.model.call_model(code, version, unique_funcs, ctx)
-                modernized_code, explanation= self.extract_changes(output, code, ctx)
-                if explanation != "" and explanation!="This code chunk does not contain deprecated functions." and explanation!="No deprecated functionality found":
-                    return CodeAnalysisResponse(
-                        modernized_code = modernized_code,
-                        retrieved_context = retrieved_context,
-                        explanation = explanation,
-                        raw_output = output
-                    )
-                else:
-                    return CodeAnalysisResponse(
-                        modernized_code = "",
-                        retrieved_context = retrieved_context,
-                        explanation = "",
-                    )
-            
-            except Exception as e:
-                logger.error(f"Model call failed: {e}")
-                return CodeAnalysisResponse(
-                    modernized_code = "",
-                    retrieved_context = retrieved_context,
-                    explanation = "",
-                    error = str(e)
-                )
-            
+                modernized_code = modernized_code,
+                retrieved_context = plan.retrieved_context,
+                explanation = plan.rewrite.explanation() if plan.rewrite.applied else "",
+                raw_output = output,
+                usage = token_usage,
+                explanation_handle = handle
+            )
+        if explanation != "" and explanation!="This code chunk does not contain deprecated functions." and explanation!="No deprecated functionality found":
+            if plan.rewrite.applied:
+                explanation = f"{plan.rewrite.explanation()}\n{explanation}"
+            return CodeAnalysisResponse(
+                modernized_code = modernized_code,
+                retrieved_context = plan.retrieved_context,
+                explanation = explanation,
+                raw_output = output,
+                usage = token_usage
+            )
         else:
             return CodeAnalysisResponse(
-                modernized_code = "",
-                retrieved_context = retrieved_context,
-                explanation = "",
-                error = "Model service unavailable"
+                modernized_code = plan.rule_code,
+                retrieved_context = plan.retrieved_context,
+                explanation = plan.rewrite.explanation(),
+                usage = token_usage
             )
+
+    def _analyze(self, code: str, version: str, model: str, explain: bool = True, key: str | None = None) -> CodeAnalysisResponse:
+        return self._generate(self._prepare(code, version, model, explain), key)
+
+    def _generate(self, plan: AnalysisPlan, handle: str | None = None) -> CodeAnalysisResponse:
+        if not plan.needs_model:
+            return self._without_model(plan)
+        try:
+            # Loads the model on first use; a failed load is reported like a failed generation
+            usage: Dict[str, int] = {}
+            with self.models.use(plan.model) as service:
+                output = service.call_model(plan.model_input, plan.version, plan.unique_funcs, plan.ctx, usage,
+                                            explain=plan.explain)
+                output = self._check_patch(service, plan, output, usage)
+            return self._finish(plan, output, usage, handle)
+        except (PromptTooLongError, WorkersBusyError):
+            raise
+        except Exception as e:
+            logger.error(f"Model call failed: {e}")
+            return self._model_error(plan, e)
     
+    def prepare_batch(self, items: List[tuple[str, str, str | None]]) -> BatchPlan:
+        # Items are (code, version, model). Identical snippets (after dedenting) are analyzed once;
+        # retrieval for all remaining snippets is batched per NumPy version. Each plan is then generated
+        # by its own generate_batch_item call, so the API can run them concurrently on the generation workers
+        self.check_collection()
+        items = [(code, version, self.models.resolve(model)) for code, version, model in items]
+        batch = BatchPlan(items, [self._response_key(code, version, model) for code, version, model in items])
+        for i, key in enumerate(batch.keys):
+            batch.first.setdefault(key, i)
+        logger.info(f"Batch analysis: {len(items)} items, {len(batch.first)} unique")
+
+        rewrites: Dict[str, RewriteStage] = {}
+        for key, i in batch.first.items():
+            code, version, _ = items[i]
+            try:
+                cached = self._cached_response(key, code)
+                if cached is not None:
+                    batch.outcomes[key] = cached
+                else:
+                    rewrites[key] = self._rewrite(code, version)
+            except Exception as e:
+                logger.error(f"Batch item {i} failed: {e}")
+                batch.outcomes[key] = e
+
+        by_version: Dict[str, List[str]] = {}
+        for key, stage in rewrites.items():
+            funcs = by_version.setdefault(items[batch.first[key]][1], [])
+            if stage.needs_model:
+                funcs.extend(fn for fn in stage.unique_funcs if fn not in funcs)
+        contexts = {version: self.query_many(funcs, version) for version, funcs in by_version.items() if funcs}
+
+        for key, stage in rewrites.items():
+            code, version, model = items[batch.first[key]]
+            try:
+                ctx = {fn: contexts[version][fn] for fn in stage.unique_funcs} if stage.needs_model else {}
+                batch.plans[key] = self._plan(code, version, stage, ctx, model)
+            except Exception as e:
+                logger.error(f"Batch item {batch.first[key]} failed: {e}")
+                batch.outcomes[key] = e
+        return batch
+
+    def generate_batch_item(self, batch: BatchPlan, key: str) -> None:
+        try:
+            result = self._generate(batch.plans[key])
+            self._store_response(key, result)
+            batch.outcomes[key] = result
+        except Exception as e:
+            logger.error(f"Batch item {batch.first[key]} failed: {e}")
+            batch.outcomes[key] = e
+
+    def batch_results(self, batch: BatchPlan) -> List[CodeAnalysisResponse | Exception]:
+        results: List[CodeAnalysisResponse | Exception] = []
+        for i, key in enumerate(batch.keys):
+            outcome = batch.outcomes[key]
+            if isinstance(outcome, CodeAnalysisResponse) and i != batch.first[key]:
+                outcome = outcome.model_copy()
+                if outcome.modernized_code:
+                    outcome.modernized_code = self._reindent(textwrap.dedent(outcome.modernized_code), batch.items[i][0])
+            results.append(outcome)
+        return results
+
+    def analyze_file(self, code: str, version: str, model: str | None = None) -> FileAnalysisResponse:
+        # Parses the module once and only analyzes top-level chunks that reference NumPy;
+        # rewritten chunks are stitched back at their original line ranges
+        self.check_collection()
+        model = self.models.resolve(model)
+        try:
+            tree = ast.parse(code)
+        except SyntaxError as e:
+            return FileAnalysisResponse(modernized_code = "", explanation = "", error = f"SyntaxError: {e}")
+
+        lines = code.splitlines(keepends=True)
+        scope = NumpyFunctionExtractor()
+        for node in tree.body:
+            if isinstance(node, (ast.Import, ast.ImportFrom)):
+                scope.visit(node)
+
+        chunks = split_module(tree)
+        results: List[FileChunkResult] = []
+        pending: Dict[int, tuple[str, str, RewriteStage]] = {}
+        outcomes: Dict[int, CodeAnalysisResponse] = {}
+        for i, chunk in enumerate(chunks):
+            chunk_code = "".join(lines[chunk.start - 1:chunk.end])
+            extractor = NumpyFunctionExtractor(scope)
+            for node in chunk.nodes:
+                extractor.visit(node)
+            infos = extractor.funcs + extractor.attrs
+            candidates = self._candidates(extractor, version)
+            if candidates is None:
+                candidate = bool(infos) and not all(isinstance(n, (ast.Import, ast.ImportFrom)) for n in chunk.nodes)
+            else:
+                candidate = bool(candidates) or any(applicable_rule(info.name, version) for info in infos)
+            results.append(FileChunkResult(name = chunk.name, start_line = chunk.start, end_line = chunk.end, candidate = candidate))
+            if not candidate:
+                continue
+            key = self._response_key(chunk_code, version, model, scope)
+            cached = self._cached_response(key, chunk_code)
+            if cached is not None:
+                outcomes[i] = cached
+            else:
+                pending[i] = (chunk_code, key, self._rewrite(chunk_code, version, scope))
+        logger.info(f"File analysis: {len(chunks)} chunks, {len(pending) + len(outcomes)} candidates")
+
+        all_funcs: List[str] = []
+        for _, _, stage in pending.values():
+            if stage.needs_model:
+                all_funcs.extend(fn for fn in stage.unique_funcs if fn not in all_funcs)
+        ctx_all = self.query_many(all_funcs, version) if all_funcs else {}
+        for i, (chunk_code, key, stage) in pending.items():
+            ctx = {fn: ctx_all[fn] for fn in stage.unique_funcs} if stage.needs_model else {}
+            plan = self._plan(chunk_code, version, stage, ctx, model)
+            try:
+                outcomes[i] = self._generate(plan)
+                self._store_response(key, outcomes[i])
+            except (PromptTooLongError, WorkersBusyError) as e:
+                outcomes[i] = self._model_error(plan, e)
+
+        retrieved_context: Dict[str, List[str]] = {}
+        explanations = []
+        errors = []
+        new_lines = list(lines)
+        for i in sorted(outcomes, reverse=True):
+            chunk, outcome, result = chunks[i], outcomes[i], results[i]
+            retrieved_context.update(outcome.retrieved_context)
+            result.error = outcome.error
+            if outcome.error:
+                errors.append(f"{chunk.name} (lines {chunk.start}-{chunk.end}): {outcome.error}")
+            original = "".join(lines[chunk.start - 1:chunk.end])
+            modernized = outcome.modernized_code
+            if modernized and modernized.strip() != original.strip():
+                if original.endswith("\n") and not modernized.endswith("\n"):
+                    modernized += "\n"
+                new_lines[chunk.start - 1:chunk.end] = [modernized]
+                result.changed = True
+                result.explanation = outcome.explanation
+                explanations.append(f"{chunk.name} (lines {chunk.start}-{chunk.end}): {outcome.explanation}")
+
+        return FileAnalysisResponse(
+            modernized_code = "".join(new_lines),
+            retrieved_context = retrieved_context,
+            explanation = "\n".join(reversed(explanations)),
+            chunks = results,
+            error = "; ".join(reversed(errors)) or None
+        )
+
+    def explain(self, handle: str) -> ExplanationResponse:
+        # Raises KeyError for handles that were never issued or have been evicted
+        entry = self.explanations.get(handle)
+        if entry is None:
+            raise KeyError(handle)
+        if entry["result"] is None:
+            usage: Dict[str, int] = {}
+            with self.models.use(entry["model"]) as service:
+                output = service.explain(entry["code"], entry["ctx"], entry["partial"], entry["output_mode"], usage)
+            explanation = self._context_section(f"### Deprecation Context\n{output}")
+            if entry["rules"]:
+                explanation = f"{entry['rules']}\n{explanation}"
+            entry["result"] = ExplanationResponse(explanation = explanation, usage = TokenUsage(**usage) if usage else None)
+        return entry["result"]
+
     def is_connected(self) -> bool:
         return self.collection is not None
     
     def is_model_available(self) -> bool:
-        return self.model.is_available()
\ No newline at end of file
+        return self.models.is_resident(self.model_name)
+
+    def is_ready(self) -> bool:
+        # The deprecation index is optional: without it every request goes to the model
+        return all(self.components[name]["state"] == "ready" for name in ("vector_store", "model"))
+
+    def is_loading(self) -> bool:
+        return any(status["state"] in ("pending", "loading") for status in self.components.values())
\ No newline at end of file
@@ -0,0 +1,264 @@
+import ast
+import hashlib
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AbstractSet, Dict, List, Optional, Tuple
+
+from schemas import FunctionInfo
+from versions import version_at_least
+
+
+@dataclass(frozen=True)
+class Rule:
+    kind: str  # "rename", "method", "call" or "keyword"
+    since: str
+    replacement: str = ""
+    keywords: Tuple[Tuple[str, str], ...] = ()
+    # First version in which the old spelling is valid again, if any
+    until: str = ""
+
+
+# Mechanical deprecations that can be rewritten without the model.
+# Keys are normalized names as produced by NumpyFunctionExtractor ("np." prefix, or bare method names).
+RULES: Dict[str, Rule] = {
+    'np.unique1d': Rule('rename', '1.4.0', 'np.unique'),
+    'np.intersect1d_nu': Rule('rename', '1.4.0', 'np.intersect1d'),
+    'np.fft.refft': Rule('rename', '1.6.0', 'np.fft.rfft'),
+    'np.fft.refft2': Rule('rename', '1.6.0', 'np.fft.rfft2'),
+    'np.fft.refftn': Rule('rename', '1.6.0', 'np.fft.rfftn'),
+    'np.fft.irefft': Rule('rename', '1.6.0', 'np.fft.irfft'),
+    'np.fft.irefft2': Rule('rename', '1.6.0', 'np.fft.irfft2'),
+    'np.fft.irefftn': Rule('rename', '1.6.0', 'np.fft.irfftn'),
+    'np.asscalar': Rule('call', '1.16.0', '{0}.item()'),
+    'np.unravel_index': Rule('keyword', '1.16.0', keywords=(('dims', 'shape'),)),
+    'np.alen': Rule('call', '1.18.0', 'len({0})'),
+    'tostring': Rule('method', '1.19.0', 'tobytes'),
+    'np.int': Rule('rename', '1.20.0', 'int'),
+    'np.float': Rule('rename', '1.20.0', 'float'),
+    'np.complex': Rule('rename', '1.20.0', 'complex'),
+    # NumPy 2.0 brought np.bool back as the NumPy bool scalar type
+    'np.bool': Rule('rename', '1.20.0', 'bool', until='2.0.0'),
+    'np.long': Rule('rename', '1.20.0', 'int', until='2.0.0'),
+    'np.object': Rule('rename', '1.20.0', 'object'),
+    'np.str': Rule('rename', '1.20.0', 'str'),
+    'np.unicode': Rule('rename', '1.20.0', 'str'),
+    'np.typeDict': Rule('rename', '1.21.0', 'np.sctypeDict'),
+    'np.msort': Rule('call', '1.24.0', 'np.sort({0}, axis=0)'),
+    'np.round_': Rule('rename', '1.25.0', 'np.round'),
+    'np.product': Rule('rename', '1.25.0', 'np.prod'),
+    'np.cumproduct': Rule('rename', '1.25.0', 'np.cumprod'),
+    'np.sometrue': Rule('rename', '1.25.0', 'np.any'),
+    'np.alltrue': Rule('rename', '1.25.0', 'np.all'),
+    'np.float_': Rule('rename', '2.0.0', 'np.float64'),
+    'np.complex_': Rule('rename', '2.0.0', 'np.complex128'),
+    'np.cfloat': Rule('rename', '2.0.0', 'np.complex128'),
+    'np.singlecomplex': Rule('rename', '2.0.0', 'np.complex64'),
+    'np.longfloat': Rule('rename', '2.0.0', 'np.longdouble'),
+    'np.string_': Rule('rename', '2.0.0', 'np.bytes_'),
+    'np.unicode_': Rule('rename', '2.0.0', 'np.str_'),
+    'np.Inf': Rule('rename', '2.0.0', 'np.inf'),
+    'np.Infinity': Rule('rename', '2.0.0', 'np.inf'),
+    'np.infty': Rule('rename', '2.0.0', 'np.inf'),
+    'np.PINF': Rule('rename', '2.0.0', 'np.inf'),
+    'np.NaN': Rule('rename', '2.0.0', 'np.nan'),
+    'np.NAN': Rule('rename', '2.0.0', 'np.nan'),
+    'np.trapz': Rule('rename', '2.0.0', 'np.trapezoid'),
+    'np.row_stack': Rule('rename', '2.0.0', 'np.vstack'),
+}
+
+# Part of the response cache key: a digest of this module, so cached answers are not served once the
+# rule table or the rewriting code changes
+RULES_VERSION = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:16]
+
+# Argument node types that can take a method call or be embedded without parentheses
+_ATOMS = (ast.Name, ast.Attribute, ast.Subscript, ast.Call)
+# Expressions whose span leaves out the parentheses they need even as a call argument
+_BARE_ONLY = (ast.Yield, ast.YieldFrom)
+
+
+@dataclass
+class AppliedRule:
+    name: str
+    since: str
+    before: str
+    after: str
+    line: int
+
+
+@dataclass
+class RewriteResult:
+    code: str
+    applied: List[AppliedRule] = field(default_factory=list)
+    unresolved: List[FunctionInfo] = field(default_factory=list)
+
+    def explanation(self) -> str:
+        seen = {}
+        for change in self.applied:
+            seen.setdefault(change.name, change)
+        return "\n".join(
+            f"`{change.name}` is deprecated since NumPy {change.since}: `{change.before}` was replaced with `{change.after}`."
+            for change in seen.values()
+        )
+
+
+def normalize_name(name: str) -> str:
+    if name.startswith('numpy.'):
+        return 'np.' + name[len('numpy.'):]
+    return name
+
+
+def applicable_rule(name: str, version: str) -> Optional[Rule]:
+    rule = RULES.get(normalize_name(name))
+    if rule and version_at_least(version, rule.since) and not (rule.until and version_at_least(version, rule.until)):
+        return rule
+    return None
+
+
+def _to_offset(lines: List[str], line: int, col: int) -> int:
+    # ast reports columns as UTF-8 byte offsets
+    return sum(len(l) for l in lines[:line - 1]) + len(lines[line - 1].encode('utf-8')[:col].decode('utf-8', errors='ignore'))
+
+
+def _chain(node: ast.AST) -> List[str]:
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if isinstance(node, ast.Name):
+        parts.append(node.id)
+    return list(reversed(parts))
+
+
+def _receiver_root(node: ast.AST) -> Optional[str]:
+    # Name the receiver expression hangs off: arr in arr[0].T, np in np.array(x)
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Call)):
+        node = node.func if isinstance(node, ast.Call) else node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def _qualify(source_chain: List[str], name: str, replacement: str) -> Optional[str]:
+    # Maps a normalized replacement ("np.prod") onto the alias actually used in the source
+    if not replacement.startswith('np.'):
+        return replacement
+    name_parts = name.split('.')
+    prefix = name_parts[:len(name_parts) - len(source_chain) + 1]
+    repl_parts = replacement.split('.')
+    if len(source_chain) < 2 or repl_parts[:len(prefix)] != prefix:
+        return None
+    return '.'.join([source_chain[0]] + repl_parts[len(prefix):])
+
+
+def _segment_edits(rule: Rule, name: str, segment: str, numpy_roots: AbstractSet[str] = frozenset(),
+                   foreign: AbstractSet[str] = frozenset()) -> Optional[List[Tuple[int, int, str]]]:
+    # Returns (start, end, text) edits relative to the segment, or None if the rule does not fit.
+    # An empty list means there is nothing to rewrite (e.g. no deprecated keyword passed, or a method
+    # called on a non-NumPy object).
+    node = ast.parse(segment, mode='eval').body
+    seg_lines = segment.splitlines(keepends=True)
+
+    def span(n: ast.AST) -> Tuple[int, int]:
+        return _to_offset(seg_lines, n.lineno, n.col_offset), _to_offset(seg_lines, n.end_lineno, n.end_col_offset)
+
+    if rule.kind == 'method':
+        if not isinstance(node, ast.Attribute):
+            return None
+        # Method names are not NumPy-specific (ElementTree.tostring): only receivers traced to NumPy are
+        # rewritten, and receivers of unknown type are left to the model
+        root = _receiver_root(node.value)
+        if root in foreign and root not in numpy_roots:
+            return []
+        if root not in numpy_roots:
+            return None
+        start, end = span(node)
+        return [(end - len(node.attr), end, rule.replacement)]
+
+    target = node.func if isinstance(node, ast.Call) else node
+    if not isinstance(target, (ast.Attribute, ast.Name)):
+        return None
+
+    if rule.kind == 'rename':
+        text = _qualify(_chain(target), name, rule.replacement)
+        start, end = span(target)
+        if text is None or text == segment[start:end]:
+            return None
+        return [(start, end, text)]
+
+    if not isinstance(node, ast.Call):
+        return None
+
+    if rule.kind == 'keyword':
+        renames = dict(rule.keywords)
+        edits = []
+        for kw in node.keywords:
+            if kw.arg in renames:
+                start, _ = span(kw)
+                edits.append((start, start + len(kw.arg), renames[kw.arg]))
+        return edits
+
+    if rule.kind == 'call':
+        if len(node.args) != 1 or node.keywords or isinstance(node.args[0], ast.Starred):
+            return None
+        arg = node.args[0]
+        start, end = span(arg)
+        arg_text = segment[start:end]
+        template = rule.replacement
+        # Only a receiver ({0}.item()) binds tighter than the expression; as a call argument it only needs
+        # parentheses if it cannot stand there bare
+        if template.startswith('{0}.') and not isinstance(arg, _ATOMS) or isinstance(arg, _BARE_ONLY):
+            arg_text = f"({arg_text})"
+        if template.startswith('np.'):
+            func_name, rest = template.split('(', 1)
+            qualified = _qualify(_chain(node.func), name, func_name)
+            if qualified is None:
+                return None
+            template = f"{qualified}({rest}"
+        text = template.format(arg_text)
+        return [(0, len(segment), text)]
+
+    return None
+
+
+def apply_rules(code: str, infos: List[FunctionInfo], version: str, numpy_roots: AbstractSet[str] = frozenset(),
+                foreign: AbstractSet[str] = frozenset()) -> RewriteResult:
+    # numpy_roots are names bound to NumPy modules or arrays, foreign names bound to other imports;
+    # method rules only rewrite receivers rooted at the former
+    lines = code.splitlines(keepends=True)
+    edits: List[Tuple[int, int, str, AppliedRule]] = []
+    unresolved: List[FunctionInfo] = []
+
+    for info in infos:
+        rule = applicable_rule(info.name, version)
+        if not rule:
+            continue
+        if info.col is None or info.end_line is None or info.end_col is None:
+            unresolved.append(info)
+            continue
+        start = _to_offset(lines, info.line, info.col)
+        end = _to_offset(lines, info.end_line, info.end_col)
+        segment = code[start:end]
+        try:
+            seg_edits = _segment_edits(rule, normalize_name(info.name), segment, numpy_roots, foreign)
+        except SyntaxError:
+            seg_edits = None
+        if seg_edits is None:
+            unresolved.append(info)
+            continue
+        for rel_start, rel_end, text in seg_edits:
+            edits.append((start + rel_start, start + rel_end, text,
+                          AppliedRule(normalize_name(info.name), rule.since, segment[rel_start:rel_end], text, info.line)))
+
+    # Outer spans come first; anything nested inside an accepted edit waits for the next pass
+    edits.sort(key=lambda e: (e[0], -e[1]))
+    accepted = []
+    last_end = -1
+    for edit in edits:
+        if edit[0] < last_end:
+            continue
+        accepted.append(edit)
+        last_end = edit[1]
+
+    new_code = code
+    for start, end, text, _ in reversed(accepted):
+        new_code = new_code[:start] + text + new_code[end:]
+
+    return RewriteResult(new_code, [e[3] for e in accepted], unresolved)
@@ -1,16 +1,32 @@
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel, Field
 
+from versions import VERSION_PATTERN
+
 
 class CodeAnalysisRequest(BaseModel):
     code: str = Field(..., description="Python code to analyze")
-    numpy_version: str = Field(..., description="NumPy version (e.g., '1.24.0')")
+    numpy_version: str = Field(..., pattern=VERSION_PATTERN, description="NumPy version (e.g., '1.24.0')")
+    model: Optional[str] = Field(None, description="GGUF model to generate with (default: the server's model)")
+    explain: bool = Field(True, description="Generate the explanation now; false returns the code with an explanation_handle for POST /explain/{handle} (/analyze only)")
 
 
 class FunctionInfo(BaseModel):
     name: str
     line: int
     call: str
+    col: Optional[int] = None
+    end_line: Optional[int] = None
+    end_col: Optional[int] = None
+
+
+class TokenUsage(BaseModel):
+    prompt_tokens: int
+    completion_tokens: int
+    code_tokens: int
+    context_tokens: int
+    max_tokens: int
+    n_ctx: int
 
 
 class CodeAnalysisResponse(BaseModel):
@@ -18,10 +34,99 @@ class CodeAnalysisResponse(BaseModel):
     retrieved_context: Dict[str, List[str]] = Field(default_factory=dict)
     explanation: str
     raw_output: Optional[str] = None
+    skip_reason: Optional[str] = None
+    error: Optional[str] = None
+    usage: Optional[TokenUsage] = None
+    explanation_handle: Optional[str] = None
+
+
+class ExplanationResponse(BaseModel):
+    explanation: str
+    usage: Optional[TokenUsage] = None
+
+
+class BatchAnalysisRequest(BaseModel):
+    items: List[CodeAnalysisRequest] = Field(..., description="Snippets to analyze")
+
+
+class BatchItemResult(BaseModel):
+    index: int
+    result: Optional[CodeAnalysisResponse] = None
+    error: Optional[str] = None
+
+
+class BatchAnalysisResponse(BaseModel):
+    results: List[BatchItemResult]
+
+
+class FileAnalysisRequest(BaseModel):
+    code: str = Field(..., description="Complete Python module to analyze")
+    numpy_version: str = Field(..., pattern=VERSION_PATTERN, description="NumPy version (e.g., '1.24.0')")
+    model: Optional[str] = Field(None, description="GGUF model to generate with (default: the server's model)")
+
+
+class FileChunkResult(BaseModel):
+    name: str
+    start_line: int
+    end_line: int
+    candidate: bool
+    changed: bool = False
+    explanation: str = ""
+    error: Optional[str] = None
+
+
+class FileAnalysisResponse(BaseModel):
+    modernized_code: str
+    retrieved_context: Dict[str, List[str]] = Field(default_factory=dict)
+    explanation: str
+    chunks: List[FileChunkResult] = Field(default_factory=list)
+    error: Optional[str] = None
+
+
+class ComponentStatus(BaseModel):
+    state: str = Field(..., description="pending, loading, ready or failed")
+    load_seconds: Optional[float] = None
     error: Optional[str] = None
 
 
 class HealthResponse(BaseModel):
     status: str
+    live: bool = True
+    ready: bool = False
+    model: Optional[str] = None
     chroma_connected: bool
-    model_available: bool
\ No newline at end of file
+    model_available: bool
+    components: Dict[str, ComponentStatus] = Field(default_factory=dict)
+
+
+class ModelStatus(BaseModel):
+    name: str
+    resident: bool
+    in_use: int = 0
+    size_mb: float
+    default: bool = False
+
+
+class ModelListResponse(BaseModel):
+    models: List[ModelStatus] = Field(default_factory=list)
+    memory_budget_mb: int
+    resident_mb: float
+    evictions: int = 0
+
+
+class StatsResponse(BaseModel):
+    caches: Dict[str, Dict[str, int]] = Field(default_factory=dict)
+    counters: Dict[str, int] = Field(default_factory=dict)
+    generation_workers: List[Dict[str, Any]] = Field(default_factory=list)
+    embedding: Dict[str, Any] = Field(default_factory=dict)
+
+
+class ProfilingRequest(BaseModel):
+    sample_rate: float = Field(..., ge=0, le=1, description="Fraction of analysis requests to profile (0 turns profiling off)")
+
+
+class ProfilingStatus(BaseModel):
+    sample_rate: float
+    directory: str
+    captured: int
+    skipped: int
@@ -0,0 +1,189 @@
+import logging
+import re
+import threading
+import time
+from typing import Any, Dict, Iterator, List
+
+from config import (
+    GENERATION_WORKERS, MODEL_CONTEXT_TOKENS, OUTPUT_MODE, OUTPUT_EXPLANATION_TOKENS, CONTEXT_CHUNK_MAX_TOKENS,
+    STUB_PREFILL_TOKENS_PER_SECOND, STUB_DECODE_TOKENS_PER_SECOND, STUB_DELAY_MS
+)
+from prompt_budget import EXPLANATION_HEADER, PromptTooLongError, WorkersBusyError, output_budget, worker_wait_timeout
+from patches import CHANGES_HEADER, make_patch
+from metrics import STAGE_SECONDS, PROMPT_TOKENS, COMPLETION_TOKENS, DECODE_TOKENS_PER_SECOND, TOKENS
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Tokens of the system prompt and chat template around the code in the real prompt
+SYSTEM_PROMPT_TOKENS = 180
+REWRITES = {
+    "np.float(": "float(",
+    "np.int(": "int(",
+    "np.bool(": "bool(",
+    "np.object(": "object(",
+    "np.str(": "str(",
+    "np.asscalar(": "np.ndarray.item(",
+    "np.product(": "np.prod(",
+    "np.cumproduct(": "np.cumprod(",
+    "np.alltrue(": "np.all(",
+    "np.sometrue(": "np.any(",
+    "np.round_(": "np.round(",
+    "np.in1d(": "np.isin(",
+    "np.trapz(": "np.trapezoid(",
+    "np.row_stack(": "np.vstack(",
+}
+
+
+def count_tokens(text: str) -> int:
+    # Roughly what a BPE tokenizer makes of Python source: words, numbers and single punctuation marks
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+class StubModelService:
+    # Stands in for ModelService without GGUF weights. Answers are deterministic (a fixed table of
+    # rewrites) and take as long as the configured prefill and decode speeds, so the rest of the
+    # server can be load-tested on any machine. Generations queue on GENERATION_WORKERS slots
+
+    def __init__(self, model_name: str = "stub", workers: int = GENERATION_WORKERS):
+        self.model_name = model_name
+        self.output_mode = OUTPUT_MODE
+        self.n_workers = max(1, workers)
+        self._slots = threading.Semaphore(self.n_workers)
+        self._lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.jobs = 0
+        self.tokens = 0
+        self.busy_seconds = 0.0
+        self.busy = 0
+        logger.info(f"Stub model: {STUB_PREFILL_TOKENS_PER_SECOND:g} prefill / {STUB_DECODE_TOKENS_PER_SECOND:g} decode tokens/s, "
+                    f"{STUB_DELAY_MS:g} ms fixed delay, {self.n_workers} worker(s)")
+
+    def _answer(self, code: str, output_mode: str | None, explain: bool) -> str:
+        modernized = code
+        for old, new in REWRITES.items():
+            modernized = modernized.replace(old, new)
+        if (output_mode or self.output_mode) == "diff":
+            answer = f"{CHANGES_HEADER}\n{make_patch(code, modernized)}\n"
+        else:
+            answer = f"### Refactored Code\n```python\n{modernized.rstrip(chr(10))}\n```\n"
+        return answer + (f"{EXPLANATION_HEADER}\n{self._explanation(code, modernized)}\n" if explain else "")
+
+    def _explanation(self, code: str, modernized: str) -> str:
+        if code == modernized:
+            return "No deprecated functionality found"
+        used = [old.rstrip("(") for old in REWRITES if old in code]
+        return f"{', '.join(used)} {'is' if len(used) == 1 else 'are'} deprecated; replaced with the current equivalent."
+
+    def _usage(self, code: str, ctx: Dict[str, List[Dict[str, Any]]] | None, explain: bool) -> Dict[str, int]:
+        code_tokens = count_tokens(code)
+        max_tokens = output_budget(code_tokens)
+        bare = SYSTEM_PROMPT_TOKENS + code_tokens
+        if bare + max_tokens > MODEL_CONTEXT_TOKENS:
+            raise PromptTooLongError(bare + max_tokens, MODEL_CONTEXT_TOKENS)
+        context_tokens = 0
+        for chunks in (ctx or {}).values():
+            if chunks:
+                context_tokens += min(count_tokens(chunks[0]['content']), CONTEXT_CHUNK_MAX_TOKENS)
+        context_tokens = min(context_tokens, MODEL_CONTEXT_TOKENS - bare - max_tokens)
+        return {
+            "prompt_tokens": bare + context_tokens,
+            "completion_tokens": 0,
+            "code_tokens": code_tokens,
+            "context_tokens": context_tokens,
+            "max_tokens": max_tokens if explain else output_budget(code_tokens, explain=False),
+            "n_ctx": MODEL_CONTEXT_TOKENS,
+        }
+
+    def _generate(self, answer: str, counts: Dict[str, int]) -> Iterator[str]:
+        # Yields the answer a few characters per simulated token after the simulated prefill
+        pieces = re.findall(r"\w+\s*|[^\w]\s*", answer)[:counts["max_tokens"]]
+        timeout = worker_wait_timeout()
+        with tracing.stage("worker_wait"):
+            if not self._slots.acquire(timeout=timeout):
+                raise WorkersBusyError(timeout)
+        started = time.perf_counter()
+        with self._lock:
+            self.busy += 1
+        try:
+            with tracing.span("generate", model=self.model_name):
+                prefill = STUB_DELAY_MS / 1000
+                if STUB_PREFILL_TOKENS_PER_SECOND > 0:
+                    prefill += counts["prompt_tokens"] / STUB_PREFILL_TOKENS_PER_SECOND
+                time.sleep(prefill)
+                decode_started = time.perf_counter()
+                step = 1 / STUB_DECODE_TOKENS_PER_SECOND if STUB_DECODE_TOKENS_PER_SECOND > 0 else 0
+                for i, piece in enumerate(pieces):
+                    # Sleeps against the schedule rather than per token, so timer overshoot does not add up
+                    delay = decode_started + (i + 1) * step - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    yield piece
+                counts["completion_tokens"] = len(pieces)
+                tracing.record("prefill", prefill)
+                tracing.record("decode", time.perf_counter() - decode_started, tokens=len(pieces))
+        finally:
+            seconds = time.perf_counter() - started
+            with self._lock:
+                self.busy -= 1
+                self.jobs += 1
+                self.tokens += counts["completion_tokens"]
+                self.busy_seconds += seconds
+            self._slots.release()
+        STAGE_SECONDS.observe(seconds, stage="generate")
+        PROMPT_TOKENS.observe(counts["prompt_tokens"], model=self.model_name)
+        COMPLETION_TOKENS.observe(counts["completion_tokens"], model=self.model_name)
+        TOKENS.inc(counts["prompt_tokens"], model=self.model_name, kind="prompt")
+        TOKENS.inc(counts["completion_tokens"], model=self.model_name, kind="completion")
+        decode = time.perf_counter() - decode_started
+        if counts["completion_tokens"] and decode > 0:
+            DECODE_TOKENS_PER_SECOND.observe(counts["completion_tokens"] / decode, model=self.model_name)
+
+    def call_model(self, code: str, version: str, funcs: List[str], ctx: Dict[str, List[Dict[str, Any]]] | None = None,
+                   usage: Dict[str, int] | None = None, output_mode: str | None = None, explain: bool = True) -> str:
+        with tracing.stage("prompt"):
+            counts = self._usage(code, ctx, explain)
+        output = "".join(self._generate(self._answer(code, output_mode, explain), counts)).strip()
+        if usage is not None:
+            usage.update(counts)
+        return output
+
+    def call_model_stream(self, code: str, version: str, funcs: List[str], ctx: Dict[str, List[Dict[str, Any]]] | None = None,
+                          usage: Dict[str, int] | None = None, explain: bool = True) -> Iterator[str]:
+        with tracing.stage("prompt"):
+            counts = self._usage(code, ctx, explain)
+        yield from self._generate(self._answer(code, None, explain), counts)
+        if usage is not None:
+            usage.update(counts)
+
+    def explain(self, code: str, ctx: Dict[str, List[Dict[str, Any]]] | None, partial: str,
+                output_mode: str | None = None, usage: Dict[str, int] | None = None) -> str:
+        counts = self._usage(code, ctx, True)
+        counts["prompt_tokens"] += count_tokens(partial)
+        counts["max_tokens"] = OUTPUT_EXPLANATION_TOKENS
+        modernized = code
+        for old, new in REWRITES.items():
+            modernized = modernized.replace(old, new)
+        output = "".join(self._generate(self._explanation(code, modernized), counts)).strip()
+        if usage is not None:
+            usage.update(counts)
+        return output
+
+    def worker_stats(self) -> List[Dict[str, Any]]:
+        uptime = max(time.monotonic() - self.started_at, 1e-9)
+        return [{
+            "worker": "stub",
+            "jobs": self.jobs,
+            "busy": self.busy > 0,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "utilization": round(self.busy_seconds / (uptime * self.n_workers), 4),
+            "tokens": self.tokens,
+            "tokens_per_second": round(self.tokens / self.busy_seconds, 2) if self.busy_seconds else 0.0,
+            "prefix_restores": 0,
+        }]
+
+    def is_available(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        pass
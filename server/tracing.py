@@ -0,0 +1,200 @@
+import cProfile
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List
+
+from config import TRACE_DIR, PROFILE_SAMPLE_RATE, PROFILE_DIR
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Per-request span tree and profile target. Context variables follow the request into executor
+# threads because AnalysisExecutor runs every call inside a copy of the request's context
+_current: ContextVar['Span | None'] = ContextVar("libsmart_span", default=None)
+_profile_path: ContextVar[Path | None] = ContextVar("libsmart_profile", default=None)
+
+SERVER_TIMING_MAX_ENTRIES = 50
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    end: float | None = None
+    attrs: Dict[str, Any] = field(default_factory=dict)
+    children: List['Span'] = field(default_factory=list)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end if self.end is not None else time.perf_counter()) - self.start) * 1000
+
+    def to_dict(self, origin: float | None = None) -> Dict[str, Any]:
+        origin = self.start if origin is None else origin
+        return {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration_ms, 3),
+            **({"attrs": self.attrs} if self.attrs else {}),
+            **({"children": [child.to_dict(origin) for child in self.children]} if self.children else {}),
+        }
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Span | None]:
+    # No-op outside a traced request
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, time.perf_counter(), attrs=attrs)
+    parent.children.append(child)
+    token = _current.set(child)
+    try:
+        yield child
+    finally:
+        child.end = time.perf_counter()
+        _current.reset(token)
+
+
+@contextmanager
+def stage(name: str, **attrs: Any) -> Iterator[None]:
+    # A pipeline stage: always timed into libsmart_stage_seconds, and a span when the request is traced
+    with STAGE_SECONDS.time(stage=name), span(name, **attrs):
+        yield
+
+
+def record(name: str, seconds: float, **attrs: Any) -> None:
+    # Stage timed elsewhere (e.g. llama.cpp's prefill), ending now
+    STAGE_SECONDS.observe(seconds, stage=name)
+    parent = _current.get()
+    if parent is not None:
+        end = time.perf_counter()
+        parent.children.append(Span(name, end - seconds, end, attrs))
+
+
+class Profiling:
+
+    def __init__(self, sample_rate: float, directory: Path):
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.captured = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def sample(self) -> bool:
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "directory": str(self.directory),
+            "captured": self.captured,
+            "skipped": self.skipped,
+        }
+
+
+PROFILING = Profiling(PROFILE_SAMPLE_RATE, PROFILE_DIR)
+
+
+def _file_name(name: str) -> str:
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_')}-{uuid.uuid4().hex[:8]}"
+
+
+@contextmanager
+def request(name: str, trace: bool, profile: bool, end: bool = True) -> Iterator[Span | None]:
+    # With end=False the root span stays open after a successful block and the caller ends it with finish()
+    root = Span(name, time.perf_counter()) if trace else None
+    span_token = _current.set(root)
+    profile_token = _profile_path.set(PROFILING.directory / f"{_file_name(name)}.prof" if profile else None)
+    try:
+        yield root
+    except BaseException:
+        end = True
+        raise
+    finally:
+        _profile_path.reset(profile_token)
+        _current.reset(span_token)
+        if root is not None and end:
+            finish(root)
+
+
+def finish(root: Span) -> None:
+    root.end = time.perf_counter()
+    if TRACE_DIR:
+        _write_trace(root)
+
+
+async def finish_after(root: Span, body: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    # Passes a response body through and ends the request once it has been sent, so streamed responses
+    # are covered to their last event
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        finish(root)
+
+
+def _write_trace(root: Span) -> None:
+    try:
+        directory = Path(TRACE_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / f"{_file_name(root.name)}.json").write_text(json.dumps(root.to_dict(), indent=2))
+    except OSError as e:
+        logger.warning(f"Could not write trace: {e}")
+
+
+def call(fn: Callable[..., Any], *args: Any) -> Any:
+    # Runs fn on the current thread, under cProfile if the request was sampled for profiling
+    path = _profile_path.get()
+    if path is None:
+        return fn(*args)
+    profiler = cProfile.Profile()
+    with PROFILING._lock:
+        try:
+            profiler.enable()
+        except ValueError:
+            # Only one profiler can be active at a time on Python 3.12+
+            PROFILING.skipped += 1
+            profiler = None
+    if profiler is None:
+        return fn(*args)
+    try:
+        return fn(*args)
+    finally:
+        profiler.disable()
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(str(path))
+            PROFILING.captured += 1
+            logger.info(f"Wrote profile {path}")
+        except OSError as e:
+            logger.warning(f"Could not write profile: {e}")
+
+
+def server_timing(root: Span) -> str:
+    # Depth-first "name;desc=...;dur=ms" entries; desc carries the span's path and attributes
+    entries = [f"total;dur={root.duration_ms:.1f}"]
+
+    def walk(node: Span, path: str) -> None:
+        for child in node.children:
+            if len(entries) >= SERVER_TIMING_MAX_ENTRIES:
+                return
+            label = f"{path}/{child.name}" if path else child.name
+            desc = " ".join([label] + [f"{k}={v}" for k, v in child.attrs.items()]).replace('"', "'")
+            entry = re.sub(r"[^A-Za-z0-9_.-]", "_", child.name)
+            if desc != child.name:
+                entry += f';desc="{desc}"'
+            entries.append(f"{entry};dur={child.duration_ms:.1f}")
+            walk(child, label)
+
+    walk(root, "")
+    return ", ".join(entries)
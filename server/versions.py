@@ -0,0 +1,24 @@
+import re
+from typing import Optional, Tuple
+
+# Release versions accepted by the API: "2.0", "1.24.0", "1.26.0rc1", "2.1.0.dev0"
+VERSION_PATTERN = r'^\d+(\.\d+){0,2}((a|b|rc)\d+)?(\.?(post|dev)\d*)*$'
+
+
+def version_tuple(version: str) -> Tuple[int, int, int]:
+    parts = [int(p) for p in re.findall(r'\d+', version)[:3]]
+    while len(parts) < 3:
+        parts.append(0)
+    return parts[0], parts[1], parts[2]
+
+
+def version_at_least(version: str, minimum: str) -> bool:
+    return version_tuple(version) >= version_tuple(minimum)
+
+
+def version_number(version: str) -> Optional[int]:
+    # Comparable integer form stored in chunk metadata, e.g. "1.25.0" -> 1025000
+    if not re.search(r'\d', version or ''):
+        return None
+    major, minor, patch = version_tuple(version)
+    return major * 1_000_000 + minor * 1_000 + patch
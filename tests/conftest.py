@@ -0,0 +1,21 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# The server modules import each other as top-level modules, as when running python server/main.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server"))
+# The stub model answers without simulated prefill or decode time
+os.environ.setdefault("LIBSMART_ENABLE_STUB", "1")
+os.environ.setdefault("LIBSMART_STUB_PREFILL_TPS", "0")
+os.environ.setdefault("LIBSMART_STUB_DECODE_TPS", "0")
+
+
+@pytest.fixture
+def service(monkeypatch, tmp_path):
+    # RAGService on the stub model with the real deprecation index, no vector store and an on-disk response cache
+    import rag_service
+    monkeypatch.setattr(rag_service.RAGService, "_init_chroma", lambda self: None)
+    monkeypatch.setattr(rag_service, "RESPONSE_CACHE_DB", str(tmp_path / "responses.db"))
+    return rag_service.RAGService("stub")
@@ -0,0 +1,33 @@
+from fastapi.testclient import TestClient
+
+from main import app
+
+
+def test_unparseable_numpy_version_is_rejected():
+    client = TestClient(app)
+    for path in ("/analyze", "/analyze/stream", "/analyze/file"):
+        response = client.post(path, json={"code": "x = np.float(a)\n", "numpy_version": "garbage"})
+        assert response.status_code == 422
+    response = client.post("/analyze/batch", json={"items": [{"code": "x = 1\n", "numpy_version": "1.x"}]})
+    assert response.status_code == 422
+
+
+def test_busy_workers_answer_503(service, monkeypatch):
+    import main
+    import stub_model
+
+    monkeypatch.setattr(stub_model, "worker_wait_timeout", lambda: 0.01)
+    monkeypatch.setattr(main, "rag", service)
+    monkeypatch.setattr(main, "executor", main.AnalysisExecutor(1, 1))
+    monkeypatch.setattr(main, "require_ready", lambda: None)
+    with service.models.use() as stub:
+        for _ in range(stub.n_workers):
+            stub._slots.acquire()
+        try:
+            response = TestClient(app).post("/analyze", json={"code": "def f(a, b):\n    return np.in1d(a, b)\n",
+                                                              "numpy_version": "2.0.0"})
+        finally:
+            for _ in range(stub.n_workers):
+                stub._slots.release()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
@@ -0,0 +1,23 @@
+from cache import ResponseCache
+
+
+def test_disk_tier_is_pruned_to_the_newest_entries(tmp_path):
+    cache = ResponseCache(0, str(tmp_path / "responses.db"), max_disk_entries=10)
+    for i in range(11):
+        cache.put(f"k{i}", "v")
+    # Pruning waits for a tenth over the cap
+    assert cache.stats()["disk_size"] == 11
+    cache.put("k11", "v")
+    assert cache.stats()["disk_size"] == 10
+    assert cache.get("k1") is None
+    assert cache.get("k2") == "v" and cache.get("k11") == "v"
+
+
+def test_disk_row_count_survives_a_restart(tmp_path):
+    path = str(tmp_path / "responses.db")
+    cache = ResponseCache(0, path, max_disk_entries=10)
+    for i in range(11):
+        cache.put(f"k{i}", "v")
+    cache = ResponseCache(0, path, max_disk_entries=10)
+    cache.put("k11", "v")
+    assert cache.stats()["disk_size"] == 10
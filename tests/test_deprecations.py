@@ -0,0 +1,62 @@
+import json
+import re
+import textwrap
+from pathlib import Path
+
+import pytest
+
+from deprecations import heading_keywords, heading_symbols
+
+VALIDATION = Path(__file__).resolve().parent.parent / "data" / "datasets" / "validation_data.json"
+# Samples whose change is not a deprecation the notes record for that version: truth-testing an array,
+# ragged input to np.array and minlength=None have no symbol to index, arr.any() is restyled as np.any()
+# once the rules have handled the rest, np.random.random_integers is not listed, np.double was never
+# deprecated and np.cfloat only is from 2.0
+NOT_INDEXED = {9, 10, 11, 15, 41, 42, 43}
+
+
+def normalize(code):
+    return re.sub(r"\s+", "", textwrap.dedent(code))
+
+
+def test_keyword_headings_are_not_symbols():
+    assert heading_keywords('histogram "normed" keyword') == [("histogram", "normed")]
+    assert heading_symbols('histogram "normed" keyword') == []
+
+
+def test_usage_headings_are_not_symbols():
+    assert heading_symbols("np.linspace with non-integer num parameter") == []
+    assert heading_symbols("Inexact matches for np.convolve and np.correlate") == []
+    assert heading_symbols("np.finfo(None)") == []
+    assert heading_symbols("np.alterdot and np.restoredot functions") == ["alterdot", "restoredot"]
+    assert heading_symbols("Aliases of builtin types (np.int, np.float, etc.)") == ["int", "float"]
+
+
+def test_method_and_attribute_headings():
+    assert heading_symbols("ndincr method of ndindex") == ["ndindex.ndincr"]
+    assert heading_symbols("Custom string formatter with _format array attribute") == ["ndarray._format"]
+
+
+@pytest.mark.skipif(not VALIDATION.exists(), reason="validation set not available")
+def test_gate_sends_known_deprecations_to_model(service):
+    samples = json.loads(VALIDATION.read_text())
+    skipped = []
+    for i, sample in enumerate(samples):
+        if i in NOT_INDEXED:
+            continue
+        stage = service._rewrite(sample["input"], sample["version"])
+        if not stage.needs_model and normalize(stage.rewrite.code) != normalize(sample["output"]):
+            skipped.append(i)
+    assert skipped == []
+
+
+def test_current_api_skips_generation(service):
+    stage = service._rewrite("x = np.linspace(0, 1, 5)\ny = np.mean(np.zeros(3)) + np.array(x).sum()\n", "2.0.0")
+    assert stage.candidates == {}
+    assert not stage.needs_model
+
+
+def test_unknown_numpy_names_go_to_the_model(service):
+    stage = service._rewrite("mask = np.Setmember1d(a, b)\n", "1.4.0")
+    assert stage.candidates == {"np.Setmember1d": None}
+    assert stage.needs_model
@@ -0,0 +1,27 @@
+import asyncio
+import time
+
+from executor import AnalysisExecutor
+
+
+def test_batch_leaves_a_slot_for_single_requests():
+    finished = []
+
+    def work(name):
+        time.sleep(0.05)
+        finished.append(name)
+        return name
+
+    async def scenario():
+        executor = AnalysisExecutor(workers=4, max_in_flight=2)
+        batch = asyncio.ensure_future(executor.run_many(work, [(f"batch-{i}",) for i in range(6)], limit=4))
+        await asyncio.sleep(0.01)
+        assert await executor.run(work, "single") == "single"
+        assert executor.in_flight <= 2
+        results = await batch
+        executor.shutdown()
+        return results
+
+    results = asyncio.run(scenario())
+    assert results == [f"batch-{i}" for i in range(6)]
+    assert finished.index("single") < 2
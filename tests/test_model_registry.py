@@ -0,0 +1,96 @@
+import struct
+import sys
+import threading
+import types
+
+import model_registry
+from model_registry import ModelRegistry, context_bytes, gguf_metadata
+
+
+def gguf_string(text):
+    data = text.encode("utf-8")
+    return struct.pack("<Q", len(data)) + data
+
+
+def write_gguf(path, values):
+    # values: key -> str, int (uint32) or list of str
+    body = b""
+    for key, value in values.items():
+        body += gguf_string(key)
+        if isinstance(value, str):
+            body += struct.pack("<I", 8) + gguf_string(value)
+        elif isinstance(value, list):
+            body += struct.pack("<IIQ", 9, 8, len(value)) + b"".join(gguf_string(v) for v in value)
+        else:
+            body += struct.pack("<II", 4, value)
+    path.write_bytes(b"GGUF" + struct.pack("<IQQ", 3, 0, len(values)) + body)
+
+
+def test_context_bytes_from_gguf_header(tmp_path):
+    path = tmp_path / "tiny.gguf"
+    write_gguf(path, {
+        "general.architecture": "llama",
+        "llama.block_count": 2,
+        "llama.attention.head_count": 4,
+        "llama.attention.head_count_kv": 2,
+        "llama.embedding_length": 64,
+        "tokenizer.ggml.tokens": ["a", "b", "c"],
+    })
+    metadata = gguf_metadata(path)
+    assert metadata["tokenizer.ggml.tokens"] == 3
+    # 128 positions x 2 layers x 2 KV heads x (16 + 16) head dims x 2 bytes
+    assert context_bytes(metadata, 128) == 32768
+    assert context_bytes(metadata, 128, logits=True) == 32768 + 128 * 3 * 4
+
+
+class FakeService:
+    closing = threading.Event()
+    release = threading.Event()
+
+    def __init__(self, name):
+        self.name = name
+
+    def close(self):
+        FakeService.closing.set()
+        FakeService.release.wait(5)
+
+
+def make_registry(tmp_path, monkeypatch):
+    for name in ("a", "b"):
+        (tmp_path / f"{name}.gguf").write_bytes(b"")
+    monkeypatch.setitem(sys.modules, "model_service", types.SimpleNamespace(ModelService=FakeService))
+    registry = ModelRegistry(tmp_path, "a", memory_budget=100)
+    monkeypatch.setattr(registry, "estimate", lambda name: 100)
+    return registry
+
+
+def test_models_in_use_are_not_evicted(tmp_path, monkeypatch):
+    registry = make_registry(tmp_path, monkeypatch)
+    FakeService.release.set()
+    with registry.use("a"):
+        registry.load("b")
+        assert registry.is_resident("a") and registry.is_resident("b")
+    registry.load("a")
+    assert registry.evictions == 0
+
+
+def test_use_waits_for_an_eviction_to_finish(tmp_path, monkeypatch):
+    registry = make_registry(tmp_path, monkeypatch)
+    FakeService.closing.clear()
+    FakeService.release.clear()
+    registry.load("a")
+    first = registry._resident["a"]
+    loader = threading.Thread(target=registry.load, args=("b",))
+    loader.start()
+    assert FakeService.closing.wait(5)
+    # "a" is being closed; a request for it must not get the closing instance
+    got = []
+    user = threading.Thread(target=lambda: got.append(registry.load("a") or registry._resident.get("a")))
+    user.start()
+    user.join(0.2)
+    assert user.is_alive()
+    FakeService.release.set()
+    loader.join(5)
+    user.join(5)
+    assert got and got[0] is not first
+    assert registry.evictions >= 1
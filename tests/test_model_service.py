@@ -0,0 +1,63 @@
+import queue
+
+import numpy as np
+import pytest
+
+pytest.importorskip("llama_cpp")
+import model_service
+from model_service import GenerationWorker, ModelService, TrackingPromptLookup
+from prompt_budget import Prompt
+
+
+class FakeLlama:
+    # Answers create_completion calls with `output`, or raises it if it is an exception
+
+    def __init__(self, output):
+        self.output = output
+
+    def __call__(self, prompt, **kwargs):
+        if isinstance(self.output, Exception):
+            raise self.output
+        return self.output
+
+
+def make_service(llama, monkeypatch):
+    # A ModelService around one worker; no GGUF file is loaded
+    monkeypatch.setattr(model_service, "_reset_perf", lambda model: None)
+    monkeypatch.setattr(model_service, "_eval_seconds", lambda model: None)
+    service = ModelService.__new__(ModelService)
+    service.model_name = "gemma-2-2b-it"
+    service.output_mode = "full"
+    service.grammars = {}
+    service._prefix = None
+    service.workers = [GenerationWorker(0, llama)]
+    service._idle = queue.Queue()
+    service._idle.put(service.workers[0])
+    service.model = llama
+    service._build_prompt = lambda code, *args: Prompt("prompt", ["<end_of_turn>"], 10, 4, 0, 20, 1024)
+    return service
+
+
+def test_generation_error_is_raised(monkeypatch):
+    service = make_service(FakeLlama(RuntimeError("llama_decode returned -1")), monkeypatch)
+    with pytest.raises(RuntimeError, match="llama_decode"):
+        service.call_model("x = np.in1d(a, b)", "2.0.0", ["np.in1d"])
+    assert service._idle.qsize() == 1
+
+
+def test_empty_response_is_raised(monkeypatch):
+    service = make_service(FakeLlama({"choices": [], "usage": {"completion_tokens": 0}}), monkeypatch)
+    with pytest.raises(RuntimeError, match="empty response"):
+        service.call_model("x = np.in1d(a, b)", "2.0.0", ["np.in1d"])
+
+
+def test_prompt_lookup_counts_accepted_draft_tokens():
+    lookup = TrackingPromptLookup(num_pred_tokens=3)
+    lookup.begin()
+    # "1 2" occurred before, followed by "3 1 2"
+    draft = lookup(np.array([1, 2, 3, 1, 2]))
+    assert draft.tolist() == [3, 1, 2]
+    assert lookup.drafted == 3
+    # The model kept 3 and 1, then sampled 9 instead of the drafted 2
+    lookup(np.array([1, 2, 3, 1, 2, 3, 1, 9]))
+    assert lookup.accepted == 2
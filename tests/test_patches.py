@@ -0,0 +1,82 @@
+import pytest
+
+from patches import CHANGES_HEADER, Hunk, PatchError, apply_patch, make_patch, parse_patch
+
+
+CODE = "import numpy as np\n\nx = np.float(a)\ny = np.sum(x)\nz = np.asscalar(y)\n"
+
+
+def patch(code, modernized):
+    return parse_patch(f"{CHANGES_HEADER}\n{make_patch(code, modernized)}\n")
+
+
+def test_round_trip():
+    modernized = CODE.replace("np.float(", "float(").replace("np.asscalar(y)", "y.item()")
+    hunks = patch(CODE, modernized)
+    assert [hunk.line for hunk in hunks] == [3, 5]
+    assert apply_patch(CODE, hunks) == modernized
+
+
+def test_unchanged_code_round_trips_as_none():
+    assert make_patch(CODE, CODE) == "None"
+    assert patch(CODE, CODE) == []
+
+
+def test_wrong_line_number_is_relocated():
+    hunks = parse_patch(f"{CHANGES_HEADER}\n@@ 1\n- y = np.sum(x)\n+ y = x.sum()\n")
+    assert apply_patch(CODE, hunks) == CODE.replace("y = np.sum(x)", "y = x.sum()")
+
+
+def test_ambiguous_block_needs_the_right_line():
+    code = "a = np.float(x)\nb = 1\na = np.float(x)\n"
+    wrong = [Hunk(2, ["a = np.float(x)"], ["a = float(x)"])]
+    with pytest.raises(PatchError):
+        apply_patch(code, wrong)
+    right = [Hunk(3, ["a = np.float(x)"], ["a = float(x)"])]
+    assert apply_patch(code, right) == "a = np.float(x)\nb = 1\na = float(x)\n"
+
+
+def test_pure_insertion():
+    modernized = CODE.replace("y = np.sum(x)\n", "y = np.sum(x)\nassert y >= 0\n")
+    hunks = patch(CODE, modernized)
+    assert hunks == [Hunk(5, [], ["assert y >= 0"])]
+    assert apply_patch(CODE, hunks) == modernized
+
+
+def test_later_hunks_follow_earlier_line_changes():
+    hunks = [Hunk(1, ["import numpy as np"], ["import numpy as np", "import math"]),
+             Hunk(4, ["y = np.sum(x)"], ["y = math.fsum(x)"])]
+    assert apply_patch(CODE, hunks) == "import numpy as np\nimport math\n\nx = np.float(a)\ny = math.fsum(x)\nz = np.asscalar(y)\n"
+
+
+def test_patch_that_does_not_apply():
+    hunks = parse_patch(f"{CHANGES_HEADER}\n@@ 3\n- x = np.int(a)\n+ x = int(a)\n")
+    with pytest.raises(PatchError):
+        apply_patch(CODE, hunks)
+    with pytest.raises(PatchError):
+        parse_patch(f"{CHANGES_HEADER}\n@@ three\n- x\n")
+    with pytest.raises(PatchError):
+        apply_patch(CODE, [Hunk(40, [], ["tail()"])])
+
+
+def test_failed_patch_falls_back_to_the_input(service):
+    output = f"{CHANGES_HEADER}\n@@ 3\n- x = np.int(a)\n+ x = int(a)\n### Deprecation Context\nnp.int was removed.\n"
+    assert service.extract_changes(output, CODE)[0] == CODE
+
+
+def test_failed_patch_is_regenerated_in_full(service, monkeypatch):
+    calls = []
+    with service.models.use() as stub:
+        stub.output_mode = "diff"
+        answer = stub.call_model
+
+        def call_model(*args, **kwargs):
+            calls.append(kwargs.get("output_mode"))
+            if len(calls) == 1:
+                return f"{CHANGES_HEADER}\n@@ 2\n- return np.int(a)\n+ return int(a)\n"
+            return answer(*args, **kwargs)
+
+        monkeypatch.setattr(stub, "call_model", call_model)
+        result = service.analyze_code("def overlap(a, b):\n    return np.in1d(a, b)\n", "2.0.0")
+    assert calls == [None, "full"]
+    assert "np.isin(a, b)" in result.modernized_code
@@ -0,0 +1,142 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+CODE = "def overlap(a, b):\n    return np.in1d(a, b)\n"
+
+
+def test_failed_generation_is_not_cached(service, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("llama_decode returned -1")
+
+    with service.models.use() as stub, monkeypatch.context() as patch:
+        patch.setattr(stub, "call_model", fail)
+        result = service.analyze_code(CODE, "2.0.0")
+    assert result.error == "llama_decode returned -1"
+    assert service.response_cache.stats()["size"] == 0
+    assert service.response_cache.stats()["disk_size"] == 0
+
+    result = service.analyze_code(CODE, "2.0.0")
+    assert result.error is None
+    assert "np.isin(a, b)" in result.modernized_code
+    assert service.response_cache.stats()["disk_size"] == 1
+
+
+def test_batch_items_generate_independently(service):
+    items = [(CODE, "2.0.0", None), ("x = np.trapz(y)\n", "2.0.0", None), ("    " + CODE.replace("\n", "\n    "), "2.0.0", None)]
+    batch = service.prepare_batch(items)
+    assert len(batch.plans) == 2
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        list(pool.map(lambda key: service.generate_batch_item(batch, key), batch.plans))
+    results = service.batch_results(batch)
+    assert "np.isin(a, b)" in results[0].modernized_code
+    assert "np.trapezoid(y)" in results[1].modernized_code
+    assert results[2].modernized_code.startswith("    def overlap(a, b):")
+
+
+def test_retrieval_filters_on_function_metadata_in_one_query(service):
+    calls = []
+    chunks = [("np.in1d is deprecated", {"function:in1d": True}), ("np.trapz is deprecated", {"function:trapz": True})]
+
+    class Collection:
+        def query(self, query_embeddings, n_results, where, include):
+            calls.append((len(query_embeddings), n_results, where))
+            rows = len(query_embeddings)
+            return {"documents": [[doc for doc, _ in chunks]] * rows, "metadatas": [[meta for _, meta in chunks]] * rows,
+                    "distances": [[0.2, 0.3]] * rows}
+
+    service.collection = Collection()
+    service.embed_fn = lambda texts: [[float(len(text))] for text in texts]
+    ctx = service.query_many(["np.in1d", "np.trapz"], "2.0.0")
+    assert calls == [(6, 6, {"$and": [{"version_num": {"$lte": 2000000}},
+                                      {"$or": [{"function:in1d": True}, {"function:trapz": True}]}]})]
+    assert [chunk["content"] for chunk in ctx["np.in1d"]] == ["np.in1d is deprecated"]
+    assert [chunk["content"] for chunk in ctx["np.trapz"]] == ["np.trapz is deprecated"]
+
+
+def test_retrieval_without_function_filter_is_one_query(service, monkeypatch):
+    import rag_service
+
+    calls = []
+
+    class Collection:
+        def query(self, query_embeddings, n_results, where, include):
+            calls.append((len(query_embeddings), n_results, where))
+            rows = len(query_embeddings)
+            return {"documents": [["np.in1d is deprecated"]] * rows, "metadatas": [[{}]] * rows, "distances": [[0.2]] * rows}
+
+    monkeypatch.setattr(rag_service, "RETRIEVAL_FUNCTION_FILTER", False)
+    service.collection = Collection()
+    service.embed_fn = lambda texts: [[float(len(text))] for text in texts]
+    ctx = service.query_many(["np.in1d", "np.trapz"], "2.0.0")
+    assert calls == [(6, 3, {"version_num": {"$lte": 2000000}})]
+    assert [chunk["content"] for chunk in ctx["np.trapz"]] == ["np.in1d is deprecated"]
+
+
+def test_stub_model_needs_to_be_enabled(tmp_path):
+    from model_registry import ModelRegistry, UnknownModelError
+
+    with pytest.raises(UnknownModelError):
+        ModelRegistry(tmp_path, "stub", allow_stub=False).resolve(None)
+    assert ModelRegistry(tmp_path, "stub", allow_stub=True).resolve(None) == "stub"
+
+
+def test_stream_honours_explain(service):
+    events = list(service.analyze_code_stream(CODE, "2.0.0", explain=False))
+    assert "np.isin(a, b)" in "".join(e["data"]["text"] for e in events if e["event"] == "token")
+    result = events[-1]["data"]
+    assert result["explanation_handle"]
+    assert service.explain(result["explanation_handle"]).explanation
+
+
+def test_stream_emits_patch_lines_in_diff_mode(service):
+    with service.models.use() as stub:
+        stub.output_mode = "diff"
+    events = list(service.analyze_code_stream(CODE, "2.0.0"))
+    patch = "".join(e["data"]["text"] for e in events if e["event"] == "patch")
+    assert patch == "@@ 2\n-     return np.in1d(a, b)\n+     return np.isin(a, b)\n"
+    assert "np.isin(a, b)" in events[-1]["data"]["modernized_code"]
+
+
+def test_extraction_scales_linearly():
+    import ast
+    import time
+
+    from rag_service import NumpyFunctionExtractor
+
+    def seconds(lines):
+        tree = ast.parse("import numpy as np\n" + "".join(f"a{i} = np.zeros({i})\nb{i} = a{i}.sum()\n" for i in range(lines)))
+        best = float("inf")
+        for _ in range(3):
+            started = time.perf_counter()
+            NumpyFunctionExtractor().visit(tree)
+            best = min(best, time.perf_counter() - started)
+        return best
+
+    # 8x the input; a per-assignment cost that grows with the number of bound names makes this ~64x
+    assert seconds(4000) / seconds(500) < 24
+
+
+def test_response_key_follows_model_file_and_output_format(service, tmp_path, monkeypatch):
+    import os
+
+    import rag_service
+
+    model = tmp_path / "tiny.gguf"
+    model.write_bytes(b"weights")
+    monkeypatch.setattr(service.models, "models_dir", tmp_path)
+    key = service._response_key(CODE, "2.0.0", "tiny")
+    assert service._response_key(CODE, "2.0.0", "tiny") == key
+
+    os.utime(model, ns=(0, 10**9))
+    replaced = service._response_key(CODE, "2.0.0", "tiny")
+    assert replaced != key
+    monkeypatch.setattr(rag_service, "OUTPUT_MODE", "diff")
+    assert service._response_key(CODE, "2.0.0", "tiny") != replaced
+    monkeypatch.setattr(rag_service, "OUTPUT_MODE", "full")
+    monkeypatch.setattr(rag_service, "CONSTRAINED_DECODING", True)
+    assert service._response_key(CODE, "2.0.0", "tiny") != replaced
+    monkeypatch.setattr(rag_service, "CONSTRAINED_DECODING", False)
+    monkeypatch.setattr(rag_service, "RULES_VERSION", "changed")
+    assert service._response_key(CODE, "2.0.0", "tiny") != replaced
@@ -0,0 +1,44 @@
+from rules import applicable_rule
+
+
+def rewrite(service, code, version="2.0.0"):
+    return service._rewrite(code, version)
+
+
+def test_method_rule_skips_non_numpy_receivers(service):
+    code = "import xml.etree.ElementTree as ET\ndata = ET.tostring(root)\n"
+    stage = rewrite(service, code)
+    assert stage.rewrite.code == code
+    assert not stage.rewrite.applied
+    assert not stage.needs_model
+
+
+def test_method_rule_rewrites_numpy_arrays(service):
+    stage = rewrite(service, "import numpy as np\na = np.zeros(3)\nraw = a.tostring()\nraw = np.ones(2).tostring()\n")
+    assert stage.rewrite.code.count(".tobytes()") == 2
+
+
+def test_method_rule_leaves_unknown_receivers_to_the_model(service):
+    stage = rewrite(service, "def dump(arr):\n    return arr.tostring()\n")
+    assert not stage.rewrite.applied
+    assert stage.needs_model
+
+
+def test_np_bool_is_only_renamed_before_2_0(service):
+    assert applicable_rule("np.bool", "1.24.0")
+    assert applicable_rule("np.bool", "2.0.0") is None
+    stage = rewrite(service, "mask = np.zeros(3, dtype=np.bool)\n", "2.1.3")
+    assert stage.rewrite.code == "mask = np.zeros(3, dtype=np.bool)\n"
+    assert "np.bool" not in stage.candidates
+
+
+def test_call_rules_only_parenthesize_receivers(service):
+    code = "a = np.msort(x + y)\nb = np.alen(x + y)\nc = np.asscalar(x + y)\nd = np.asscalar(x[0])\n"
+    assert rewrite(service, code, "1.24.0").rewrite.code == (
+        "a = np.sort(x + y, axis=0)\nb = len(x + y)\nc = (x + y).item()\nd = x[0].item()\n"
+    )
+
+
+def test_call_rules_keep_arguments_valid(service):
+    code = "n = np.msort(v for v in x)\ndef f():\n    m = np.alen((yield))\n"
+    assert rewrite(service, code, "1.24.0").rewrite.code == "n = np.sort((v for v in x), axis=0)\ndef f():\n    m = len((yield))\n"
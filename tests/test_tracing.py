@@ -0,0 +1,35 @@
+import asyncio
+
+import tracing
+
+
+def test_streamed_body_is_inside_the_request_span():
+    async def body():
+        with tracing.span("generate"):
+            await asyncio.sleep(0.01)
+            yield b"event: result\n\n"
+
+    async def collect(stream):
+        return [chunk async for chunk in stream]
+
+    async def consume():
+        with tracing.request("POST /analyze/stream", True, False, end=False) as root:
+            # Like the app under the middleware, the body runs in a task that copied the request's context,
+            # and only after the response has been returned
+            task = asyncio.ensure_future(collect(tracing.finish_after(root, body())))
+        assert root.end is None
+        return root, await task
+
+    root, chunks = asyncio.run(consume())
+    assert chunks == [b"event: result\n\n"]
+    assert [child.name for child in root.children] == ["generate"]
+    assert root.end >= root.children[0].end
+
+
+def test_request_span_ends_on_error():
+    try:
+        with tracing.request("POST /analyze", True, False, end=False) as root:
+            raise RuntimeError("boom")
+    except RuntimeError:
+        pass
+    assert root.end is not None